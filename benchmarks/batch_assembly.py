@@ -0,0 +1,98 @@
+"""
+Time the batch assembly of gen_prob_maps against sess.run.
+
+For a synthetic normalized scan, assembles all batches of the 'z' view
+plane embedded in a net of `--net_shape`, once as before, one layer at a
+time into an embedded array rebuilt per view plane, and once with
+`embed_layers` and `fill_batch`, and checks that the batches are equal.
+With `--checkpoint_dir`, the batches are also run through the nodule
+segmentation net (needs tensorflow) to compare with the time of sess.run.
+
+    python3 benchmarks/batch_assembly.py --shape 320 300 360 --net_shape 400 --batch_size 16
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsb3.steps import gen_prob_maps
+
+def fill_layer(batch_img, img_array, layer_cnt):
+    """One layer of the batch as gen_prob_maps did before."""
+    n_channels = batch_img.shape[2]
+    min_z = max(0, int(layer_cnt - (n_channels - 1) / 2))
+    max_z = min(int(layer_cnt + (n_channels - 1) / 2) + 1, img_array.shape[2])
+    batch_idx_z = [n_channels - max(0, max_z - min_z), n_channels - min(0, max_z - min_z)]
+    batch_img[:, :, batch_idx_z[0]:batch_idx_z[1]] = img_array[:, :, min_z:max_z]
+
+def batches_loop(org_img_array, image_shape, batch_size):
+    img_array = (-0.25) * np.ones((image_shape[0], image_shape[1], org_img_array.shape[2]), dtype=np.float32)
+    offset_y = int((img_array.shape[0] - org_img_array.shape[0])/2)
+    offset_x = int((img_array.shape[1] - org_img_array.shape[1])/2)
+    img_array[offset_y : offset_y + org_img_array.shape[0],
+              offset_x : offset_x + org_img_array.shape[1], :] = org_img_array
+    batch = (-0.25) * np.ones(([batch_size] + image_shape), dtype=np.float32)
+    for batch_start in range(0, img_array.shape[2], batch_size):
+        batch[:] = -0.25
+        for cnt in range(min(batch_size, img_array.shape[2] - batch_start)):
+            fill_layer(batch[cnt], img_array, batch_start + cnt)
+        yield batch
+
+def batches_gather(org_img_array, image_shape, batch_size, buffers):
+    img_layers, _, _ = gen_prob_maps.embed_layers(org_img_array, image_shape[:2], buffers)
+    channel_indices = gen_prob_maps.get_channel_indices(org_img_array.shape[2], image_shape[2])
+    batch = gen_prob_maps.get_buffer(buffers, 'batch', [batch_size] + image_shape)
+    for batch_start in range(0, org_img_array.shape[2], batch_size):
+        n = min(batch_size, org_img_array.shape[2] - batch_start)
+        gen_prob_maps.fill_batch(batch, img_layers, channel_indices[batch_start : batch_start + n])
+        batch[n:] = -0.25
+        yield batch
+
+def time_batches(batches, sess_run=None):
+    """Seconds spent in assembly and in sess_run."""
+    assembly = run = 0
+    start = time.time()
+    for batch in batches:
+        assembly += time.time() - start
+        if sess_run is not None:
+            start = time.time()
+            sess_run(batch)
+            run += time.time() - start
+        start = time.time()
+    return assembly, run
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[320, 300, 360], help='z, y, x of the scan')
+    parser.add_argument('--net_shape', type=int, default=400, help='y = x of the net')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_channels', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--checkpoint_dir', type=str, default=None)
+    args = parser.parse_args()
+    rng = np.random.RandomState(0)
+    scan = rng.uniform(-0.25, 0.75, args.shape).astype(np.float32)
+    org_img_array = np.swapaxes(scan, 2, 0) # view plane 'z' -> x, y, z
+    image_shape = [args.net_shape, args.net_shape, args.n_channels]
+    buffers = {}
+    for batch, reference in zip(batches_gather(org_img_array, image_shape, args.batch_size, buffers),
+                                batches_loop(org_img_array, image_shape, args.batch_size)):
+        if not np.array_equal(batch, reference):
+            raise ValueError('batches differ')
+    sess_run = None
+    if args.checkpoint_dir is not None:
+        from dsb3 import tf_tools
+        sess, pred_ops, data = tf_tools.load_network(args.checkpoint_dir, image_shape=image_shape)
+        sess_run = lambda batch: sess.run(pred_ops, feed_dict={data['images']: batch})
+    n_batches = int(np.ceil(org_img_array.shape[2] / args.batch_size))
+    print('{} batches of shape {}'.format(n_batches, [args.batch_size] + image_shape))
+    print('{:<8} {:>14} {:>14}'.format('method', 'assembly ms', 'sess.run ms'))
+    for name, batches in [('loop', lambda: batches_loop(org_img_array, image_shape, args.batch_size)),
+                          ('gather', lambda: batches_gather(org_img_array, image_shape, args.batch_size, buffers))]:
+        times = [time_batches(batches(), sess_run) for _ in range(args.repeats)]
+        assembly, run = np.median(times, axis=0)
+        print('{:<8} {:>14.0f} {:>14}'.format(name, 1000 * assembly, '{:.0f}'.format(1000 * run) if sess_run else 'n/a'))
+
+if __name__ == '__main__':
+    main()
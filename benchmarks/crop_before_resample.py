@@ -0,0 +1,90 @@
+"""
+Compare the lung boxes of resample_lungs with and without crop_before_resample.
+
+Resamples synthetic chest scans of `--shape` with random raw spacings to
+`--spacing` as resample_lungs does: the whole scan with `--kernel`, and, as
+with crop_before_resample, the whole scan with each of `--box_kernels` and
+then only the lung box with `--kernel`. The lung box is found with
+`get_lung_box_threshold`, the lung wing net needs tensorflow. Reports per
+scan and box kernel whether `bound_box_coords_yx_px` are the same, the
+maximal absolute difference of the value histograms and of the saved int16
+arrays, and the wall time of both ways.
+
+    python3 benchmarks/crop_before_resample.py --n_scans 5 --box_kernels cubic linear
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsb3 import resample
+from dsb3.steps import resample_lungs
+
+HU_tissue_range = [-1000, 400]
+bounding_box_buffer_yx_px = [12, 12]
+
+def gen_chest(shape, seed=0):
+    """Air, a body ellipse of soft tissue, two lung wings and some vessels, with noise."""
+    import scipy.ndimage
+    rng = np.random.RandomState(seed)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    z, y, x = z / float(shape[0]), y / float(shape[1]), x / float(shape[2])
+    body = ((y - 0.5) / 0.38)**2 + ((x - 0.5) / 0.45)**2 < 1
+    scan = np.where(body & (z >= 0), 40, -1000).astype(np.float32)
+    for center_x in [0.5 - rng.uniform(0.15, 0.2), 0.5 + rng.uniform(0.15, 0.2)]:
+        lung = (((z - 0.5) / rng.uniform(0.4, 0.45))**2 + ((y - rng.uniform(0.45, 0.5)) / rng.uniform(0.2, 0.25))**2
+                + ((x - center_x) / rng.uniform(0.1, 0.13))**2 < 1)
+        scan[lung] = -850
+    vessels = scipy.ndimage.gaussian_filter(rng.rand(*shape).astype(np.float32), 2) > 0.53
+    scan[vessels & (scan < -800)] = 30
+    scan += 30 * rng.randn(*shape).astype(np.float32)
+    return scan.astype(np.int16)
+
+def get_box(img_array_zyx):
+    """Bounding box and value histogram as resample_lungs finds them on a resampling."""
+    prepared = {'patient': None, 'pa_json': {}, 'img_array_zyx': img_array_zyx,
+                'crop_coords_z_list_yx_px': [resample_lungs.get_lung_box_threshold(img_array_zyx)]}
+    if not prepared['crop_coords_z_list_yx_px'][0]:
+        prepared['crop_coords_z_list_yx_px'] = []
+    hist = resample_lungs.get_pre_normed_value_hist(img_array_zyx)[0]
+    return resample_lungs.get_bound_box(prepared, bounding_box_buffer_yx_px), hist
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[150, 512, 512], help='z, y, x')
+    parser.add_argument('--spacing', type=float, default=1, help='new spacing in mm')
+    parser.add_argument('--kernel', type=str, default='cubic', help='resampling_kernel')
+    parser.add_argument('--box_kernels', type=str, nargs='+', default=['cubic', 'linear'], help='lung_box_kernel')
+    parser.add_argument('--n_scans', type=int, default=5)
+    args = parser.parse_args()
+    print('{:>4} {:<8} {:<22} {:<6} {:>10} {:>10} {:>8} {:>8}'.format(
+        'scan', 'box', 'bound_box_coords_yx_px', 'same', 'hist diff', 'array diff', 's full', 's crop'))
+    n_same = 0
+    for seed in range(args.n_scans):
+        rng = np.random.RandomState(1000 + seed)
+        old_spacing = np.array([rng.uniform(1.25, 2.5)] + 2 * [rng.uniform(0.6, 0.8)])
+        scan = gen_chest(args.shape, seed)
+        shape = np.round(scan.shape * old_spacing / args.spacing)
+        start = time.time()
+        full = resample.zoom(scan, shape, args.kernel)
+        box, hist = get_box(full)
+        reference = resample_lungs.clip_HU_range(full, HU_tissue_range)[:, box[0]:box[1], box[2]:box[3]]
+        time_full = time.time() - start
+        del full
+        for box_kernel in args.box_kernels:
+            start = time.time()
+            crop_box, crop_hist = get_box(resample.zoom(scan, shape, box_kernel))
+            cropped = resample.zoom(scan, shape, args.kernel, box=[(0, shape[0]), crop_box[:2], crop_box[2:]])
+            cropped = resample_lungs.clip_HU_range(cropped, HU_tissue_range)
+            time_crop = time.time() - start
+            same = crop_box == box
+            n_same += same
+            array_diff = (np.abs(cropped.astype(np.int32) - reference).max() if same else float('nan'))
+            print('{:>4} {:<8} {:<22} {:<6} {:>10.2e} {:>10} {:>8.1f} {:>8.1f}'.format(
+                seed, box_kernel, str(crop_box), str(same), np.abs(crop_hist - hist).max(), array_diff,
+                time_full, time_crop))
+    print('same bound_box_coords_yx_px for {} of {}'.format(n_same, args.n_scans * len(args.box_kernels)))
+
+if __name__ == '__main__':
+    main()
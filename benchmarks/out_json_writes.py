@@ -0,0 +1,77 @@
+"""
+Compare the cost of writing out.json records junk by junk.
+
+    old   `pipe.save_json('out.json', junk, mode='a')` after each junk, which
+          reads and rewrites all previous records
+    new   `pipe.append_journal` for each patient of a junk, out.json is
+          written once from the journal at the end of the step
+
+Reports the mean time to write the last ten junks and the time to write
+out.json at the end for increasing numbers of patients; the new per-junk
+time stays flat.
+
+    python3 benchmarks/out_json_writes.py --n_patients 500 2000 8000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from collections import OrderedDict
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsb3 import pipeline as pipe
+
+def gen_record(patient):
+    """Record with the fields of resample_lungs."""
+    return OrderedDict([('raw_scan_spacing_zyx_mm', [2.5, 0.703125, 0.703125]),
+                        ('raw_scan_shape_zyx_px', [134, 512, 512]),
+                        ('resampled_scan_spacing_zyx_mm', [1.0, 1.0, 1.0]),
+                        ('resampled_scan_shape_zyx_px', [335, 360, 360]),
+                        ('acquisition_exception', None),
+                        ('bound_box_coords_yx_px', [41, 312, 18, 340]),
+                        ('bound_box_shape_yx_px', [272, 323]),
+                        ('basename', patient + '_img.npy'),
+                        ('pathname', '/data/LUNA16_0/resample_lungs/arrays/' + patient + '_img.npy')])
+
+def write_junks(patients, junk_size, append):
+    junk_times = []
+    for junk_start in range(0, len(patients), junk_size):
+        junk = patients[junk_start:junk_start+junk_size]
+        start = time.time()
+        if append:
+            for patient in junk:
+                pipe.append_journal(patient, gen_record(patient))
+        else:
+            pipe.save_json('out.json', OrderedDict([(p, gen_record(p)) for p in junk]),
+                           mode='w' if junk_start == 0 else 'a')
+        junk_times.append(time.time() - start)
+    start = time.time()
+    if append:
+        pipe._rebuild_out_json_from_journal()
+    return 1000 * sum(junk_times[-10:]) / len(junk_times[-10:]), 1000 * (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_patients', type=int, nargs='+', default=[500, 2000, 8000])
+    parser.add_argument('--junk_size', type=int, default=8, help='patients per junk, n_CPUs in resample_lungs')
+    parser.add_argument('--tmp_dir', type=str, default=None, help='directory on the file system to benchmark')
+    args = parser.parse_args()
+    pipe.write_basedir = tempfile.mkdtemp(dir=args.tmp_dir) + '/'
+    pipe.dataset_name = 'bench'
+    setattr(pipe, '__run', 0)
+    setattr(pipe, '__step_dir_suffix', '')
+    print('{:>10} {:<4} {:>14} {:>16}'.format('patients', 'mode', 'ms per junk', 'ms at step end'))
+    try:
+        for n_patients in args.n_patients:
+            pipe.patients = ['patient{:06}'.format(i) for i in range(n_patients)]
+            for mode in ['old', 'new']:
+                setattr(pipe, '__step_name', 'bench_' + mode + str(n_patients))
+                os.makedirs(pipe.get_step_dir())
+                result = write_junks(pipe.patients, args.junk_size, append=mode == 'new')
+                print('{:>10} {:<4} {:>14.2f} {:>16.1f}'.format(n_patients, mode, *result))
+    finally:
+        shutil.rmtree(pipe.write_basedir)
+
+if __name__ == '__main__':
+    main()
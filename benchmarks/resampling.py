@@ -0,0 +1,80 @@
+"""
+Compare `scipy.ndimage.zoom` with the resampling of dsb3/resample.py.
+
+Resamples a synthetic int16 scan of `--shape` with `--spacing` to isotropic
+target spacings as resample_lungs does and reports the wall time of zoom and
+of each kernel and number of threads. For the cubic and linear kernels, the
+maximal absolute difference to the int16 zoom output of the same order and
+mode, see `get_zoom_mode`, and the fraction of differing voxels are reported,
+too.
+
+    python3 benchmarks/resampling.py --targets 1 0.7 0.5 --n_threads 1 4
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsb3 import resample
+
+zoom_orders = {'cubic': 3, 'linear': 1}
+
+def get_zoom_mode(kernel):
+    """Mode of zoom that the kernel matches, the cubic kernel mirrors as zoom with 'nearest' before scipy 1.6."""
+    import scipy
+    if kernel == 'cubic' and tuple(int(v) for v in scipy.__version__.split('.')[:2]) >= (1, 6):
+        return 'mirror'
+    return 'nearest'
+
+def gen_scan(shape, seed=0):
+    """Air, a body ellipse of soft tissue with noise and some bright spots."""
+    import scipy.ndimage
+    rng = np.random.RandomState(seed)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    body = ((y - shape[1] / 2) / (0.4 * shape[1]))**2 + ((x - shape[2] / 2) / (0.45 * shape[2]))**2 < 1
+    scan = np.where(body, 40, -1000).astype(np.float32) + 30 * rng.randn(*shape).astype(np.float32)
+    spots = scipy.ndimage.gaussian_filter(rng.rand(shape[0] // 4, shape[1] // 4, shape[2] // 4).astype(np.float32), 1)
+    scan += 1000 * (scipy.ndimage.zoom(spots, 4, order=0) > 0.6)
+    return scan.astype(np.int16)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[300, 512, 512], help='z, y, x')
+    parser.add_argument('--spacing', type=float, nargs=3, default=[1.25, 0.7, 0.7], help='z, y, x in mm')
+    parser.add_argument('--targets', type=float, nargs='+', default=[1, 0.7, 0.5], help='spacing in mm')
+    parser.add_argument('--kernels', type=str, nargs='+', default=resample.kernels)
+    parser.add_argument('--n_threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--skip_zoom', action='store_true', help='no timing of and comparison with zoom')
+    args = parser.parse_args()
+    import scipy.ndimage
+    scan = gen_scan(args.shape)
+    print('{:>6} {:<16} {:<8} {:>7} {:>10} {:>8} {:>12}'.format(
+        'mm', 'shape', 'method', 'threads', 'ms', 'max diff', 'frac differ'))
+    for target in args.targets:
+        shape = [int(n) for n in np.round(np.array(scan.shape) * args.spacing / target)]
+        shape_str = 'x'.join(str(n) for n in shape)
+        out = np.empty(shape, dtype=np.int16)
+        for kernel in args.kernels:
+            reference = None
+            if kernel in zoom_orders and not args.skip_zoom:
+                start = time.time()
+                reference = scipy.ndimage.zoom(scan, np.array(shape) / scan.shape,
+                                               order=zoom_orders[kernel], mode=get_zoom_mode(kernel))
+                print('{:>6} {:<16} {:<8} {:>7} {:>10.0f}'.format(
+                    target, shape_str, 'zoom' + str(zoom_orders[kernel]), 1, 1000 * (time.time() - start)))
+            for n_threads in args.n_threads:
+                start = time.time()
+                resample.zoom(scan, shape, kernel, out=out, n_threads=n_threads)
+                line = '{:>6} {:<16} {:<8} {:>7} {:>10.0f}'.format(
+                    target, shape_str, kernel, n_threads, 1000 * (time.time() - start))
+                if reference is not None:
+                    differ = out != reference
+                    max_diff = np.abs(out[differ].astype(np.int32) - reference[differ]).max() if differ.any() else 0
+                    line += ' {:>8} {:>12.2e}'.format(max_diff, np.mean(differ))
+                    del differ
+                print(line)
+            del reference
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Measure the startup time of the command-line utility and of the step modules.
+
+Runs `python dsb3.py --help` and imports each step module in a fresh
+interpreter, reports the median wall time and lists the slowest imports of
+`--help`, timed by a hook on `__import__` in the child process instead of
+`python -X importtime`, which needs Python 3.7. Steps whose dependencies
+are not installed are reported as failed.
+
+    python3 benchmarks/startup.py --repeats 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+from dsb3 import pipeline as pipe
+
+# runs a script with its arguments and writes the cumulative time of the
+# first import of each module as json to the last line of stderr
+import_timer = """
+import builtins, json, runpy, sys, time
+times = {}
+original_import = builtins.__import__
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if not name or name in sys.modules:
+        return original_import(name, globals, locals, fromlist, level)
+    start = time.time()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        times.setdefault(name, time.time() - start)
+builtins.__import__ = timed_import
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write('\\n' + json.dumps(times) + '\\n')
+"""
+
+def time_command(command, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        process = subprocess.Popen(command, cwd=root_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        times.append(time.time() - start)
+        if process.returncode != 0:
+            return None, stderr.decode().strip().split('\n')[-1]
+    return np.median(times), ''
+
+def get_slowest_imports(command, n=10):
+    """Modules with the highest cumulative import time in seconds."""
+    process = subprocess.Popen([sys.executable, '-c', import_timer] + command[1:], cwd=root_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    times = json.loads(stderr.decode().strip().split('\n')[-1])
+    return sorted(((t, name) for name, t in times.items()), reverse=True)[:n]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    commands = [('dsb3.py --help', [sys.executable, 'dsb3.py', '--help'])]
+    for step_name in pipe.avail_steps.values():
+        commands.append(('import ' + step_name, [sys.executable, '-c', 'import dsb3.steps.' + step_name]))
+    print('{:<36} {:>8}'.format('command', 'ms'))
+    for name, command in commands:
+        median, error = time_command(command, args.repeats)
+        if median is None:
+            print('{:<36} {:>8} {}'.format(name, 'failed', error))
+        else:
+            print('{:<36} {:>8.0f}'.format(name, 1000 * median))
+    print('\nslowest imports of dsb3.py --help (cumulative ms)')
+    for cumulative, name in get_slowest_imports(commands[0][1]):
+        print('{:<36} {:>8.1f}'.format(name, 1000 * cumulative))
+
+if __name__ == '__main__':
+    main()
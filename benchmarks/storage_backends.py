@@ -0,0 +1,89 @@
+"""
+Compare the storage backends of dsb3/storage.py.
+
+Writes and reads a synthetic int16 CT volume and a uint8 prob map with each
+backend and reports write throughput, read latency and disk footprint.
+
+    python3 benchmarks/storage_backends.py --shape 320 300 360
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsb3 import storage
+
+def gen_ct_volume(shape, seed=0):
+    """Air around an ellipsoidal body with two lungs, smooth tissue and noise, in HU."""
+    rng = np.random.RandomState(seed)
+    z, y, x = np.ogrid[-1:1:shape[0]*1j, -1:1:shape[1]*1j, -1:1:shape[2]*1j]
+    volume = np.full(shape, -1000, dtype=np.int16)
+    body = (y / 0.8)**2 + (x / 0.95)**2 < 1
+    body = np.broadcast_to(body, shape)
+    volume[body] = 40
+    for x0 in [-0.4, 0.4]:
+        lung = ((z / 0.95)**2 + ((y + 0.05) / 0.6)**2 + ((x - x0) / 0.35)**2) < 1
+        volume[lung] = -850
+    volume += (rng.normal(0, 20, shape)).astype(np.int16)
+    return np.clip(volume, -1000, 400).astype(np.int16)
+
+def gen_prob_map(shape, n_blobs=30, seed=0):
+    """Mostly zero with some gaussian blobs in [0, 255]."""
+    rng = np.random.RandomState(seed)
+    prob_map = np.zeros(shape, dtype=np.float32)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    for _ in range(n_blobs):
+        c = [rng.randint(0, s) for s in shape]
+        r = rng.uniform(2, 8)
+        sl = tuple(slice(max(0, ci - 3*int(r)), ci + 3*int(r) + 1) for ci in c)
+        prob_map[sl] = np.maximum(prob_map[sl], np.exp(-((z[sl[0]] - c[0])**2 + (y[:, sl[1]] - c[1])**2
+                                                        + (x[:, :, sl[2]] - c[2])**2) / (2 * r**2)))
+    return (255 * prob_map).astype(np.uint8)
+
+def benchmark(name, array, backend_name, tmp_dir, repeats):
+    backend = storage.get_backend(backend_name)
+    path = tmp_dir + name + '.npy'
+    write_times, read_times = [], []
+    for _ in range(repeats):
+        start = time.time()
+        path_written = storage.save(path, array, backend)
+        write_times.append(time.time() - start)
+        # reads are warm as the page cache cannot be dropped without privileges
+        start = time.time()
+        loaded = storage.load(path, backend)
+        np.asarray(loaded).sum() # touch all data, also for memory maps
+        read_times.append(time.time() - start)
+    if not np.array_equal(np.asarray(loaded), array):
+        raise ValueError(backend_name + ' did not reproduce the array')
+    n_bytes = os.path.getsize(path_written)
+    os.remove(path_written)
+    return (array.nbytes / 2**20 / np.median(write_times), 1000 * np.median(read_times),
+            n_bytes / 2**20, array.nbytes / n_bytes)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=3, default=[320, 300, 360], help='shape z y x of the volumes')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--backends', type=str, default=','.join(storage.avail_backends))
+    parser.add_argument('--tmp_dir', type=str, default=None, help='directory on the file system to benchmark')
+    args = parser.parse_args()
+    arrays = [('ct_int16', gen_ct_volume(args.shape)), ('prob_map_uint8', gen_prob_map(args.shape))]
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir) + '/'
+    print('{:<16} {:<6} {:>12} {:>10} {:>10} {:>7}'.format('array', 'backend', 'write MB/s', 'read ms', 'disk MB', 'ratio'))
+    try:
+        for name, array in arrays:
+            for backend_name in args.backends.split(','):
+                try:
+                    result = benchmark(name, array, backend_name, tmp_dir, args.repeats)
+                except ImportError as e:
+                    print('{:<16} {:<6} skipped: {}'.format(name, backend_name, e))
+                    continue
+                print('{:<16} {:<6} {:>12.0f} {:>10.1f} {:>10.1f} {:>7.1f}'.format(name, backend_name, *result))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
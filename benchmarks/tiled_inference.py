@@ -0,0 +1,107 @@
+"""
+Compare the tiled inference of gen_prob_maps with the per-size nets.
+
+Predicts the 'z' view plane of scans with `predict_view`, embedded in the
+smallest of `--image_shapes` that fits as gen_prob_maps does, and with
+`predict_view_tiled` for each tile overlap and blending, and reports the
+wall time, the pixels fed to the net, the maximal and mean absolute
+difference of the predictions and the fraction of voxels on which they
+disagree at a threshold of 0.5.
+
+Without `--checkpoint_dir`, a stand-in net is used: the sigmoid of a box
+filter over the center channel with zero padding, whose border effects are
+those of a convolutional net of that receptive field. With it, the nodule
+segmentation net is loaded once per shape (needs tensorflow).
+
+    python3 benchmarks/tiled_inference.py --shapes 300 380 420 --tile 256 --overlaps 32 64
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dsb3.steps import gen_prob_maps
+
+image_shapes = [304, 320, 352, 384, 400, 416, 432, 448, 480, 512, 560, 1024]
+
+class StandInSession:
+    """Mimics sess.run of a net with `receptive_field` for probs."""
+
+    def __init__(self, receptive_field):
+        self.receptive_field = receptive_field
+        self.n_pixels = 0
+
+    def run(self, pred_ops, feed_dict):
+        import scipy.ndimage
+        batch = list(feed_dict.values())[0]
+        self.n_pixels += batch.shape[0] * batch.shape[1] * batch.shape[2]
+        center = batch[:, :, :, batch.shape[3] // 2]
+        smooth = scipy.ndimage.uniform_filter(center, (1, self.receptive_field, self.receptive_field),
+                                              mode='constant', cval=0)
+        return {'probs': 1 / (1 + np.exp(-20 * (smooth - 0.1)))}
+
+def gen_scan(shape, n_nodules=40, seed=0):
+    """Normalized scan of shape (y, x, layers) with lungs and spherical nodules."""
+    rng = np.random.RandomState(seed)
+    y, x, z = np.ogrid[-1:1:shape[0]*1j, -1:1:shape[1]*1j, -1:1:shape[2]*1j]
+    scan = np.full(shape, 0.0, dtype=np.float32)
+    for x0 in [-0.45, 0.45]:
+        scan[((y / 0.7)**2 + ((x - x0) / 0.4)**2 + (z / 0.95)**2) < 1] = -0.2
+    for _ in range(n_nodules):
+        c = [rng.uniform(-0.8, 0.8) for _ in range(3)]
+        r = rng.uniform(0.01, 0.05)
+        scan[((y - c[0])**2 + (x - c[1])**2 + (z - c[2])**2) < r**2] = 0.3
+    scan += rng.normal(0, 0.02, shape).astype(np.float32)
+    return scan
+
+def get_net(checkpoint_dir, receptive_field, image_shape):
+    if checkpoint_dir is None:
+        return StandInSession(receptive_field), None, {'images': 'images'}
+    from dsb3 import tf_tools
+    return tf_tools.load_network(checkpoint_dir, image_shape=image_shape)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shapes', type=int, nargs='+', default=[300, 380, 420], help='y = x of the scans')
+    parser.add_argument('--n_layers', type=int, default=64)
+    parser.add_argument('--tile', type=int, default=256, help='y = x of the tiles')
+    parser.add_argument('--overlaps', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--blendings', type=str, nargs='+', default=['gaussian', 'linear'])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_channels', type=int, default=5)
+    parser.add_argument('--receptive_field', type=int, default=31, help='of the stand-in net')
+    parser.add_argument('--checkpoint_dir', type=str, default=None)
+    args = parser.parse_args()
+    gen_prob_maps.pipe.log = logging.getLogger('tiled_inference')
+    print('{:>6} {:<22} {:>8} {:>10} {:>9} {:>10} {:>10}'.format(
+        'shape', 'method', 'ms', 'Mpixels', 'max diff', 'mean diff', 'frac 0.5'))
+    for n in args.shapes:
+        scan = gen_scan((n, n, args.n_layers))
+        net_shape = [s for s in image_shapes if n < 0.95 * s or s == image_shapes[-1]][0]
+        image_shape = [net_shape, net_shape, args.n_channels]
+        tf_net = get_net(args.checkpoint_dir, args.receptive_field, image_shape)
+        start = time.time()
+        reference = gen_prob_maps.predict_view(tf_net, scan, image_shape, args.batch_size, [0], 'scan')
+        n_pixels = getattr(tf_net[0], 'n_pixels', args.n_layers * net_shape**2)
+        print('{:>6} {:<22} {:>8.0f} {:>10.1f}'.format(n, 'net ' + str(net_shape), 1000 * (time.time() - start), n_pixels / 1e6))
+        image_shape = [args.tile, args.tile, args.n_channels]
+        tf_net = get_net(args.checkpoint_dir, args.receptive_field, image_shape)
+        for overlap in args.overlaps:
+            for blending in args.blendings:
+                weights = gen_prob_maps.get_tile_weights(image_shape[:2], overlap, blending)
+                n_pixels = getattr(tf_net[0], 'n_pixels', 0)
+                start = time.time()
+                prediction = gen_prob_maps.predict_view_tiled(tf_net, scan, image_shape, args.batch_size, [0], 'scan',
+                                                              overlap, weights)
+                elapsed = time.time() - start
+                n_tiles = len(gen_prob_maps.get_tile_starts(max(n, args.tile), args.tile, overlap))**2
+                n_pixels = getattr(tf_net[0], 'n_pixels', n_pixels + args.n_layers * n_tiles * args.tile**2) - n_pixels
+                diff = np.abs(prediction - reference)
+                print('{:>6} {:<22} {:>8.0f} {:>10.1f} {:>9.4f} {:>10.2e} {:>10.2e}'.format(
+                    n, 'tiles {} {}'.format(overlap, blending), 1000 * elapsed, n_pixels / 1e6,
+                    diff.max(), diff.mean(), np.mean((prediction > 0.5) != (reference > 0.5))))
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,9 @@ def init_pipeline(run,
                   random_seed=17,
                   n_CPUs=1,
                   GPU_ids=None,
-                  GPU_memory_fraction=0.85):
+                  GPU_memory_fraction=0.85,
+                  storage_backend='npy',
+                  storage_lru_bytes=0):
     """
     Initialize pipeline.
     """
@@ -44,6 +46,7 @@ def init_pipeline(run,
     pipe.n_CPUs = n_CPUs
     pipe.GPU_memory_fraction = GPU_memory_fraction
     pipe.GPU_ids = GPU_ids
+    pipe._init_storage(storage_backend, storage_lru_bytes)
     print('with GPUs_ids', GPU_ids)
     # --------------------------------------------------------------------------
     # environment variables
@@ -4,13 +4,17 @@ The DSB3 Pipeline.
 This is the general-purpose command-line utility.
 """
 
-import os, sys, shutil
+import os, sys
+import time
+import subprocess
 import argparse
 import logging
 import getpass
+import importlib.machinery
 from collections import OrderedDict
 from . import init_pipeline
 from . import utils
+from . import hrjson
 from . import pipeline as pipe
 
 def main():
@@ -23,8 +27,7 @@ def main():
     if not os.path.exists(params_user):
         raise FileNotFoundError('Provide file ' + params_user
                                 + ' in the root of the repository.')
-    shutil.copyfile(params_user, 'dsb3/params.py')
-    from . import params
+    params = import_params(params_user)
     # --------------------------------------------------------------------------
     # command line parameters
     parser = argparse.ArgumentParser(description=__doc__,
@@ -44,15 +47,36 @@ def main():
     aa('-h', '--help', action='help',
        help='Show this help message and exit.')
     aa('-s', '--step_dir_suffix', type=str, default=None, metavar='s',
-       help='Provide suffix for step output directory name.')
+       help='Provide suffix for step output directory name. With "--dag", a comma-separated list of suffixes.')
     aa('-n', '--n_patients', type=int, default=None, metavar='n',
        help='Choose the number of patients to process to test the pipeline (default: read from params file).')
     aa('--patient', type=str, default=None,
        help='provide id of a single patient')
     aa('--fromto', type=str, default=None, nargs=2,
-       help='provide range of patients, e.g. "0 400" to compute patients [0, 1, ..., 399]')
+       help='provide range of patients, e.g. "0 400" to compute patients [0, 1, ..., 399]; deprecated, use "--lease"')
     aa('--merge', action='store_const', default=False, const=True,
-       help='merge step directories produced with "--fromto"')
+       help='merge step directories produced with "--fromto"; deprecated, use "--lease"')
+    aa('--lease', action='store_const', default=False, const=True,
+       help='process the step as one of several workers, e.g., on several hosts sharing the write directory; '
+            'workers claim patients through lease files and write into the same step directory')
+    aa('--lease_timeout', type=int, default=600, metavar='s',
+       help='seconds after which the patients of a worker that stopped renewing its leases are reassigned (default: 600)')
+    aa('--no_cache', action='store_const', default=False, const=True,
+       help='recompute all patients, also those whose params and inputs did not change')
+    aa('--resume', action='store_const', default=False, const=True,
+       help='only process patients that are not yet in the journal of the step, e.g., after a crash')
+    aa('--dag', action='store_const', default=False, const=True,
+       help='run all combinations of "steps" and suffixes that have a params dict in parallel, '
+            'each as soon as the steps it reads from are finished')
+    aa('--cpu_budget', type=int, default=None, metavar='n',
+       help='number of CPUs shared by the steps run with "--dag" (default: all CPUs of the machine)')
+    aa('--stream', action='store_const', default=False, const=True,
+       help='run all "steps" at once, each processes patients as soon as the steps it reads from '
+            'finished them, e.g., "0,1,3,4 --stream"; GPU steps split "GPU_memory_fraction" among them')
+    aa('--stream_queue', type=int, default=None, metavar='n',
+       help='number of patients a step in "--stream" may run ahead of the steps reading from it (default: 2 * n_CPUs)')
+    aa('--stream_child', action='store_const', default=False, const=True,
+       help=argparse.SUPPRESS)
     aa('-ds', '--dataset_name', type=str, default=None, metavar='d',
        help='Choose dataset_name "dsb3" (default: read from params file).')
     aa('--gpu', type=str, default=None, metavar='gpu',
@@ -79,6 +103,8 @@ def main():
         #                     + step_name + ' in params_ ' + user_first_name + '!')
         if not os.path.exists('./dsb3/steps/' + step_name + '.py'):
             raise ValueError('Do not know any step called ' + step_name +'.')
+        if (args.stream or args.lease) and step_name not in pipe.journaled_steps:
+            raise ValueError('"--stream" and "--lease" require one of the steps ' + ', '.join(pipe.journaled_steps) + '.')
     # --------------------------------------------------------------------------
     # overwrite default parameters
     if args.n_patients is not None:
@@ -100,6 +126,8 @@ def main():
     init_pipeline(args.run, args.descr, args.patient, fromto_patients, **params.pipe)
     # now we can import `pipeline` from anywhere and use its attributes
     # --> plays the role of a class with only a single instance across the module
+    if args.dag or args.stream and not args.stream_child:
+        sys.exit(run_dag(step_names, args, params))
     for step_name in step_names:
         if args.merge:
             pipe._init_step(step_name)
@@ -135,9 +163,156 @@ def main():
             params_dict = getattr(params, step_name+args.step_dir_suffix)
         except AttributeError:
             raise AttributeError('Your params file needs to contain a dictionary "' + step_name + args.step_dir_suffix + '".')
-        pipe._run_step(step_name, params_dict, args.step_dir_suffix)
+        if args.stream_child:
+            pipe._run_step_streaming(step_name, params_dict, args.step_dir_suffix)
+        elif args.lease:
+            pipe._run_step_leased(step_name, params_dict, args.step_dir_suffix, lease_timeout=args.lease_timeout)
+        else:
+            pipe._run_step(step_name, params_dict, args.step_dir_suffix, use_cache=not args.no_cache, resume=args.resume)
         #pipe._visualize_step(step_name)
 
+def run_dag(step_names, args, params):
+    """Run step nodes in subprocesses as soon as all their upstream nodes are finished.
+
+    A node is a combination of a step and a suffix for which the params file
+    contains a dict. Node A depends on node B if A reads from B, see
+    `pipe.get_step_dependencies`. If the suffixed directory of an unsuffixed
+    upstream node does not exist, a link to the unsuffixed directory is created.
+    At most `cpu_budget` CPUs are used at a time, where each node counts with
+    `n_CPUs`, and each GPU runs a single step at a time.
+
+    With `--stream`, all nodes are started at once and stream patients from
+    their upstream nodes, see `pipe._run_step_streaming`. The budgets do not
+    apply then and all nodes are stopped as soon as one fails.
+    """
+    suffixes = (args.step_dir_suffix if args.step_dir_suffix is not None else '').split(',')
+    nodes = [(step_name, suffix) for step_name in step_names for suffix in suffixes
+             if hasattr(params, step_name + suffix)]
+    for step_name in step_names:
+        if step_name not in [n[0] for n in nodes]:
+            raise AttributeError('Your params file needs to contain a dictionary "' + step_name
+                                 + '" with one of the suffixes ' + str(suffixes) + '.')
+    upstream_nodes = OrderedDict()
+    upstream_step_names = OrderedDict()
+    for node in nodes:
+        upstream_nodes[node] = []
+        upstream_step_names[node] = []
+        for dep_step_name, dep_suffix in pipe.get_step_dependencies(node[0], getattr(params, node[0] + node[1])):
+            if dep_suffix is not None:
+                candidates = [(dep_step_name, dep_suffix)]
+            else:
+                candidates = [(dep_step_name, node[1]), (dep_step_name, '')]
+                upstream_step_names[node].append(dep_step_name)
+            for candidate in candidates:
+                if candidate in nodes and candidate != node:
+                    upstream_nodes[node].append(candidate)
+                    break
+    cpu_budget = args.cpu_budget if args.cpu_budget is not None else os.cpu_count()
+    gpu_budget = len(params.pipe['GPU_ids'])
+    cpu_cost = min(pipe.n_CPUs, cpu_budget)
+    # command line parameters that are passed to each node
+    node_args = ['-r', str(pipe.__run)]
+    for option, value in [('--init_run', args.init_run if args.init_run > -1 else None),
+                          ('-n', args.n_patients), ('--patient', args.patient),
+                          ('-ds', args.dataset_name), ('--gpu', args.gpu)]:
+        if value is not None:
+            node_args += [option, str(value)]
+    if args.fromto is not None:
+        node_args += ['--fromto'] + args.fromto
+    node_args += ['--no_cache'] if args.no_cache else []
+    node_args += ['--resume'] if args.resume else []
+    if args.stream:
+        node_args += ['--stream_child']
+        init_streaming(nodes, upstream_nodes, args)
+    pipe.log_pipe.info(('stream' if args.stream else 'dag') + ' with nodes '
+                       + ', '.join(step_name + suffix for step_name, suffix in nodes))
+    finished, failed, running = set(), set(), OrderedDict()
+    while True:
+        for node, (process, stdout) in list(running.items()):
+            if process.poll() is not None:
+                stdout.close()
+                del running[node]
+                (finished if process.returncode == 0 else failed).add(node)
+                print('finished' if process.returncode == 0 else 'failed', node[0] + node[1])
+        # streamed nodes wait for each other, stop all of them
+        if args.stream and failed and running:
+            for node, (process, stdout) in running.items():
+                print('stopping', node[0] + node[1], 'as a streamed step failed')
+                process.terminate()
+            for node, (process, stdout) in running.items():
+                process.wait()
+                stdout.close()
+                failed.add(node)
+            running.clear()
+        pending = [n for n in nodes if n not in finished | failed and n not in running]
+        # nodes downstream of failed nodes are never run
+        for node in pending:
+            if any(n in failed for n in upstream_nodes[node]):
+                failed.add(node)
+                print('skipping', node[0] + node[1], 'as an upstream step failed')
+        pending = [n for n in pending if n not in failed]
+        if not pending and not running:
+            break
+        for node in pending:
+            if not args.stream and not all(n in finished for n in upstream_nodes[node]):
+                continue
+            n_gpus_used = len([n for n in running if n[0] in pipe.gpu_steps])
+            if running and not args.stream and (cpu_cost * (len(running) + 1) > cpu_budget
+                            or (node[0] in pipe.gpu_steps and n_gpus_used >= gpu_budget)):
+                continue
+            step_name, suffix = node
+            for upstream_step_name in upstream_step_names[node]:
+                link_upstream_step_dir(upstream_step_name, suffix)
+            step_dir = pipe.get_write_dir() + step_name + suffix + '/'
+            utils.ensure_dir(step_dir)
+            stdout = open(step_dir + 'stdout.txt', 'w')
+            command = [sys.executable, sys.argv[0], step_name, '-s', suffix] + node_args
+            print('starting', step_name + suffix, 'writing stdout to', step_dir + 'stdout.txt')
+            running[node] = (subprocess.Popen(command, stdout=stdout, stderr=subprocess.STDOUT), stdout)
+        time.sleep(1)
+    msg = 'dag finished {} nodes'.format(len(finished)) + (', failed: ' + ', '.join(n[0] + n[1] for n in failed) if failed else '')
+    print(msg)
+    pipe.log_pipe.info(msg)
+    return 1 if failed else 0
+
+def init_streaming(nodes, upstream_nodes, args):
+    """Write the upstream and downstream step directories of each node to `stream.json`.
+
+    The nodes of GPU steps run on the same GPUs at once, each with an equal
+    share of `GPU_memory_fraction`.
+    """
+    nodes_json = OrderedDict()
+    for node in nodes:
+        nodes_json[node[0] + node[1]] = OrderedDict([
+            ('upstream', [n[0] + n[1] for n in upstream_nodes[node]]),
+            ('downstream', [n[0] + n[1] for n in nodes if node in upstream_nodes[n]])])
+    max_queue_size = args.stream_queue if args.stream_queue is not None else 2 * pipe.n_CPUs
+    n_gpu_nodes = max(1, len([n for n in nodes if n[0] in pipe.gpu_steps]))
+    stream_json = OrderedDict([('max_queue_size', max_queue_size),
+                               ('GPU_memory_fraction', pipe.GPU_memory_fraction / n_gpu_nodes),
+                               ('nodes', nodes_json)])
+    utils.replace_file(pipe.get_write_dir() + 'stream.json',
+                       lambda f: hrjson.dump(stream_json, f, indent=4, indent_to_level=1))
+    pipe._init_streaming(nodes_json.keys(), resume=args.resume)
+
+def import_params(params_user):
+    """Import the params file as module `dsb3.params`.
+
+    The file is executed in place instead of being copied into the package, so
+    that concurrently starting workers do not write to the repository.
+    """
+    # load_module also registers the module in sys.modules, module_from_spec needs Python 3.5
+    params = importlib.machinery.SourceFileLoader(__package__ + '.params', params_user).load_module()
+    setattr(sys.modules[__package__], 'params', params)
+    return params
+
+def link_upstream_step_dir(step_name, suffix):
+    """Link `step_name + suffix` to the directory `step_name`, so that a suffixed step finds its input."""
+    link = pipe.get_write_dir() + step_name + suffix
+    if suffix != '' and not os.path.exists(link) and os.path.exists(pipe.get_write_dir() + step_name):
+        os.symlink(step_name, link)
+        print('linked', link, 'to', step_name)
+
 def steps_descr():
     descr = 'Choices for "steps":'
     for key, value in pipe.avail_steps.items():
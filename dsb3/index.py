@@ -0,0 +1,126 @@
+"""
+SQLite index of the out.json records of a step.
+
+`out.json.sqlite` in the step directory stores one row per patient. It is
+rebuilt from out.json and the journal of the step whenever these changed, so
+steps keep writing out.json and the journal as before. Looking up a patient
+is then a single query instead of parsing the whole out.json, and the index
+is passed to joblib workers by its filename instead of pickling all records.
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from . import utils
+from . import hrjson as json
+
+class PatientsIndex(Mapping):
+    """Read-only mapping from patient to out.json record, in the order of out.json."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._connections = {}
+
+    def __getitem__(self, patient):
+        row = self._execute('SELECT record FROM records WHERE patient = ?', (patient,)).fetchone()
+        if row is None:
+            raise KeyError(patient)
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def __contains__(self, patient):
+        return self._execute('SELECT 1 FROM records WHERE patient = ?', (patient,)).fetchone() is not None
+
+    def __iter__(self):
+        for row in self._iterate('SELECT patient FROM records ORDER BY position'):
+            yield row[0]
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def items(self):
+        """Iterate over all patients and records with a single query."""
+        for patient, record in self._iterate('SELECT patient, record FROM records ORDER BY position'):
+            yield patient, json.loads(record, object_pairs_hook=OrderedDict)
+
+    def close(self):
+        """Close the connections of this process."""
+        for key, (connection, inode) in list(self._connections.items()):
+            # connections of the parent of a forked worker are left to the parent
+            if key[0] == os.getpid():
+                connection.close()
+            del self._connections[key]
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def _execute(self, query, args=()):
+        # connections can neither be shared with forked workers nor with other threads
+        key = (os.getpid(), threading.get_ident())
+        # reconnect if the index was rebuilt, e.g., while streaming
+        inode = os.stat(self.filename).st_ino
+        if key in self._connections and self._connections[key][1] != inode:
+            # release the replaced file
+            self._connections.pop(key)[0].close()
+        if key not in self._connections:
+            # closed by `close` from any thread
+            self._connections[key] = (self._connect(), inode)
+        return self._connections[key][0].execute(query, args)
+
+    def _iterate(self, query):
+        # a connection of its own, which lookups while iterating do not close
+        connection = self._connect()
+        try:
+            yield from connection.execute(query)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect('file:' + self.filename + '?mode=ro', uri=True, check_same_thread=False)
+
+def is_stale(step_dir):
+    """Whether out.json, the journal or the manifests changed since the index was built."""
+    filename = step_dir + 'out.json.sqlite'
+    if not os.path.exists(filename):
+        return True
+    connection = sqlite3.connect('file:' + filename + '?mode=ro', uri=True)
+    try:
+        sources = connection.execute('SELECT value FROM meta WHERE key = ?', ('sources',)).fetchone()
+    except sqlite3.DatabaseError:
+        return True
+    finally:
+        connection.close()
+    return sources is None or sources[0] != get_sources(step_dir)
+
+def get_sources(step_dir):
+    stats = []
+    for name in ['out.json', 'out.json.journal', 'manifests']:
+        try:
+            stat = os.stat(step_dir + name)
+            stats.append([name, stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            pass
+    return json.dumps(stats)
+
+def build(step_dir, records, sources):
+    """Write the index for records atomically. `sources` is the result of
+    `get_sources` before the records were read."""
+    filename = step_dir + 'out.json.sqlite'
+    def write(f):
+        f.close()
+        connection = sqlite3.connect(f.name)
+        connection.execute('CREATE TABLE records (patient TEXT PRIMARY KEY, position INTEGER, record TEXT)')
+        connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        connection.executemany('INSERT INTO records VALUES (?, ?, ?)',
+                               ((patient, position, json.dumps(record))
+                                for position, (patient, record) in enumerate(records.items())))
+        connection.execute('INSERT INTO meta VALUES (?, ?)', ('sources', sources))
+        connection.commit()
+        connection.close()
+    utils.replace_file(filename, write)
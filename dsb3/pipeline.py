@@ -2,12 +2,20 @@
 Pipeline variables and functions.
 """
 import os, sys
+import ast
+import shutil
 import logging
 import time
+import hashlib
+import socket
+import threading
 import numpy as np
+from contextlib import contextmanager
 from importlib import import_module
 from collections import OrderedDict
 from . import utils
+from . import storage
+from . import index
 from . import visualize as vis
 from . import hrjson as json
 
@@ -32,6 +40,17 @@ avail_steps = OrderedDict([
     ('9', 'pred_cancer_per_candidate'),
 ])
 
+per_patient_steps = ['resample_lungs', 'gen_prob_maps', 'gen_nodule_masks']
+"""Steps that write one record per patient to out.json and only process the
+patients in `patients`. Their results are cached per patient, see `_run_step`."""
+
+journaled_steps = ['resample_lungs', 'gen_prob_maps', 'gen_candidates', 'interpolate_candidates']
+"""Steps that journal each finished patient, see `append_journal`. They can be
+resumed, streamed and run by several workers."""
+
+gpu_steps = ['resample_lungs', 'gen_prob_maps', 'filter_candidates', 'gen_submission', 'pred_cancer_per_candidate']
+"""Steps that run a tensorflow network on the GPU."""
+
 avail_runs = OrderedDict([])
 """Stores optimization runs. Is read from file at startup."""
 
@@ -86,6 +105,12 @@ GPU_ids = None
 GPU_memory_fraction = 0.85
 """Fraction of memory attributed to GPU computation."""
 
+storage_backend = 'npy'
+"""Backend for arrays, or dict of backends by step name, see `storage`."""
+
+__storage_lru = None
+"""In-memory tier for arrays, see `storage.LRUTier`."""
+
 # track pipeline runs
 __step_name = None
 """Name of the step that is currently processed."""
@@ -99,6 +124,23 @@ __step_dir_suffix = ''
 __run = 0
 """Integer that identifies the current run of the pipeline."""
 
+__loaded_steps = set()
+"""Names of the upstream steps whose json files or arrays the current step loaded."""
+
+__manifests = False
+"""Write journal records as one manifest file per patient, see `_run_step_leased`."""
+
+__loaded_indexes = set()
+"""Step directories whose index the current step loaded, see `load_index`."""
+
+__stream = None
+"""Upstream and downstream step directories, queue size and pulled patients of
+a streamed step, see `_run_step_streaming`."""
+
+__leases = None
+"""Worker, lease timeout, leased and done patients of a step that shares its
+step directory with other workers, see `_run_step_leased`."""
+
 __init_run = -1
 """Integer that identifies the run that is used to initialize the current run.
 
@@ -125,13 +167,17 @@ def get_step_dir(step_name=None, run=None):
     return get_write_dir(run) + step_name + __step_dir_suffix + '/'
 
 def save_json(basename, dictionary, step_name=None, mode='w'):
+    """Write dictionary to a json file in the step directory.
+
+    With mode='a', the existing file is read and rewritten as a whole; steps
+    that finish patients one after another use `append_journal` instead.
+    """
     filename = get_step_dir(step_name) + basename
     if mode == 'a' and os.path.exists(filename):
         old_d = load_json(basename, step_name)
         old_d.update(dictionary)
         dictionary = old_d
-    with open(filename, 'w') as f:
-        json.dump(dictionary, f, indent=4, indent_to_level=1)
+    utils.replace_file(filename, lambda f: json.dump(dictionary, f, indent=4, indent_to_level=1))
 
 def load_json_troll(filename):
     with open(filename) as f:
@@ -140,19 +186,186 @@ def load_json_troll(filename):
 
 
 def load_json(basename, step_name=None):
+    _register_loaded_step(step_name)
     step_dir = _get_step_dir_for_load(step_name)
     with open(step_dir + basename) as f:
         dictionary = json.load(f, object_pairs_hook=OrderedDict)
+    if basename == 'out.json' and step_dir == get_step_dir(step_name):
+        # add patients that are finished but not yet in out.json, e.g., while streaming
+        dictionary.update(_load_journal_dir(step_dir))
     return dictionary
 
-def save_array(basename, array, step_name=None):
+def load_index(step_name=None):
+    """Read-only mapping from patient to the out.json record of a step, see dsb3/index.py.
+
+    Use instead of `load_json('out.json', step_name)` to look up single patients;
+    records are read from disk on each lookup and are not cached.
+    """
+    _register_loaded_step(step_name)
+    step_dir = _get_step_dir_for_load(step_name)
+    _update_index(step_dir)
+    __loaded_indexes.add(step_dir)
+    return index.PatientsIndex(step_dir + 'out.json.sqlite')
+
+def iter_patients(patients_subset):
+    """Iterate over `patients` or a subset of them, e.g., a split, in a step.
+
+    While the step is streamed, see `_run_step_streaming`, each patient is
+    yielded as soon as all upstream steps have journaled it. While it shares
+    its step directory with other workers, see `_run_step_leased`, each
+    patient is claimed when it is taken.
+    """
+    for patients_chunk in iter_patient_chunks(patients_subset, 1):
+        yield from patients_chunk
+
+def iter_patient_chunks(patients_subset, chunk_size):
+    """Lists of the patients in `patients` or a subset of them, e.g., a split.
+
+    Yields all patients in a single list, unless the step is streamed, see
+    `_run_step_streaming`. Then, each list holds the next patient that all
+    upstream steps have journaled and up to `chunk_size - 1` further patients
+    that are ready without waiting. While the step shares its step directory
+    with other workers, see `_run_step_leased`, each list holds up to
+    `chunk_size` patients claimed by this worker.
+    """
+    if __leases is not None:
+        yield from _iter_leased_chunks(patients_subset, chunk_size)
+        return
+    if __stream is None:
+        if len(patients_subset) > 0:
+            yield list(patients_subset)
+        return
+    # upstream steps do not wait for this step to pull the other patients
+    patients_wanted = [p for p in patients_subset if p not in __stream['patients_wanted']]
+    __stream['patients_wanted'].update(patients_wanted)
+    with open(get_step_dir() + 'stream_wanted.lst', 'a') as f:
+        f.write(''.join(p + '\n' for p in patients_wanted))
+    patients_yielded = set()
+    while True:
+        patients_chunk = []
+        while len(patients_chunk) < chunk_size:
+            patient = _pull_stream(patients_subset, patients_yielded, wait=not patients_chunk)
+            if patient is None:
+                break
+            patients_chunk.append(patient)
+            patients_yielded.add(patient)
+        if not patients_chunk:
+            return
+        yield patients_chunk
+
+def append_journal(patient, record, step_name=None):
+    """Append the out.json record of a finished patient to the journal of the step.
+
+    The journal is append-only and flushed to disk after each patient. It is
+    used to rebuild out.json when a step is resumed after a crash, see `_run_step`.
+    Workers that share a step directory write a manifest file per patient instead.
+    """
+    if __manifests:
+        filename = get_step_dir(step_name) + 'manifests/' + patient + '.json'
+        utils.replace_file(filename, lambda f: f.write(json.dumps(OrderedDict([(patient, record)]))))
+        if __leases is not None and patient in __leases['patients_leased']:
+            _write_lease(patient, __leases['worker'], done=True)
+            __leases['patients_leased'].discard(patient)
+        return
+    with open(_get_journal_filename(step_name), 'a') as f:
+        f.write(json.dumps(OrderedDict([(patient, record)])) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def load_journal(step_name=None):
+    """Records of all patients in the journal of the step in the order of completion.
+
+    Manifests of patients written by several workers follow the journal records."""
+    return _load_journal_dir(get_step_dir(step_name))
+
+def save_array(basename, array, step_name=None, mmap=False):
+    """Save array with the storage backend of the step, return the written path.
+
+    With mmap, the array is saved as .npy with any backend, so that
+    `load_array(..., mmap=True)` reads only the touched parts of it.
+    """
     step_dir = get_step_dir(step_name) + 'arrays/'
-    np.save(step_dir + basename, array)
-    return step_dir + basename
+    backend = storage.NpyBackend() if mmap else _get_storage_backend(step_name)
+    return storage.save(step_dir + basename, array, backend, __storage_lru)
+
+def load_array(basename, step_name=None, mmap=False):
+    """Load an array saved with `save_array`.
 
-def load_array(basename, step_name=None):
+    With `mmap=True`, a read-only memory map is returned for arrays stored as
+    .npy, so that only the pages that are touched are read from disk.
+    """
+    _register_loaded_step(step_name)
     step_dir = _get_step_dir_for_load(step_name) + 'arrays/'
-    return np.load(step_dir + basename)
+    return storage.load(step_dir + basename, _get_storage_backend(step_name), __storage_lru, mmap=mmap)
+
+def get_step_dependencies(step_name, params=None):
+    """Upstream steps read by a step as list of (step_name, suffix) pairs.
+
+    Parsed from calls like `load_json('out.json', 'resample_lungs')` in the
+    source of the step module and from params values that either name a step or
+    a path into a step directory. Suffix None means that the suffix of the step
+    itself applies, as `get_step_dir` appends it to all step names.
+    """
+    import re
+    step_names = sorted(avail_steps.values(), key=len, reverse=True)
+    dependencies = []
+    with open(os.path.dirname(os.path.abspath(__file__)) + '/steps/' + step_name + '.py') as f:
+        source = f.read()
+    for name in re.findall(r"(?:load_json|load_index|load_array|get_step_dir)\([^)]*'(\w+)'\)", source):
+        if name in step_names:
+            dependencies.append((name, None))
+    values = []
+    for value in (params.values() if params is not None else []):
+        values += value if isinstance(value, (list, tuple)) else [value]
+    for value in values:
+        if not isinstance(value, str):
+            continue
+        if value in step_names:
+            dependencies.append((value, None))
+            continue
+        for dirname in value.split('/')[:-1]:
+            for name in step_names:
+                if dirname == name or dirname.startswith(name + '_'):
+                    dependencies.append((name, dirname[len(name):]))
+                    break
+    return [d for i, d in enumerate(dependencies)
+            if d not in dependencies[:i] and d != (step_name, None)]
+
+@contextmanager
+def timing(phase, patient=None, overlapped=False):
+    """Record wall time, bytes read and written and peak RSS of a phase of a step.
+
+        with pipe.timing('load', patient):
+            img_array = pipe.load_array(basename, 'resample_lungs')
+
+    Records of all processes of the step are collected in `metrics.json` in the
+    step directory when the step is finished, with percentiles by phase. Bytes
+    include reads from the page cache and count all threads of the process.
+    The time of `overlapped` phases, which run in a thread alongside the
+    others, does not add to the time of the patient. A phase shared by
+    several patients, e.g., a batch of a net, is split among them if
+    `patient` is a dict of patient -> share, the shares adding up to one.
+    Records without a patient count only in the totals of the phases.
+    """
+    io_start = _get_io_bytes()
+    start = time.time()
+    yield
+    io_end = _get_io_bytes()
+    values = [time.time() - start, io_end[0] - io_start[0], io_end[1] - io_start[1]]
+    shares = patient if isinstance(patient, dict) else {patient: 1}
+    lines = []
+    for patient, share in shares.items():
+        record = OrderedDict([('patient', patient),
+                              ('phase', phase),
+                              ('time_s', share * values[0]),
+                              ('read_bytes', int(round(share * values[1]))),
+                              ('written_bytes', int(round(share * values[2]))),
+                              ('peak_rss_bytes', _get_peak_rss_bytes())])
+        if overlapped:
+            record['overlapped'] = True
+        lines.append(json.dumps(record) + '\n')
+    with open(get_step_dir() + 'metrics.journal', 'a') as f:
+        f.write(''.join(lines))
 
 # ------------------------------------------------------------------------------
 # Helper functions
@@ -169,6 +382,277 @@ def _get_step_dir_for_load(step_name=None):
             return step_dir
     raise FileNotFoundError('Did not find ' + step_dir + ' in runs ' + str(trial_runs) + '.')
 
+def _init_storage(backend, lru_bytes=0):
+    global storage_backend, __storage_lru
+    for name in (backend.values() if isinstance(backend, dict) else [backend]):
+        storage.get_backend(name) # check that the backend is available
+    storage_backend = backend
+    __storage_lru = storage.LRUTier(lru_bytes) if lru_bytes > 0 else None
+
+def _get_storage_backend(step_name=None):
+    step_name = __step_name if step_name is None else step_name
+    if isinstance(storage_backend, dict):
+        return storage.get_backend(storage_backend.get(step_name, 'npy'))
+    return storage.get_backend(storage_backend)
+
+def _get_journal_filename(step_name=None):
+    return get_step_dir(step_name) + 'out.json.journal'
+
+def _remove_journal(step_dir):
+    """Remove the journal, manifests and leases of a previous run of a step."""
+    if os.path.exists(step_dir + 'out.json.journal'):
+        os.remove(step_dir + 'out.json.journal')
+    for dirname in ['manifests/', 'leases/']:
+        if os.path.exists(step_dir + dirname):
+            shutil.rmtree(step_dir + dirname)
+
+def _update_index(step_dir):
+    if index.is_stale(step_dir):
+        sources = index.get_sources(step_dir)
+        with open(step_dir + 'out.json') as f:
+            records = json.load(f, object_pairs_hook=OrderedDict)
+        records.update(_load_journal_dir(step_dir))
+        index.build(step_dir, records, sources)
+
+def _load_journal_dir(step_dir):
+    patients_json = OrderedDict()
+    if os.path.exists(step_dir + 'out.json.journal'):
+        with open(step_dir + 'out.json.journal') as f:
+            for line in f:
+                try:
+                    patients_json.update(json.loads(line, object_pairs_hook=OrderedDict))
+                except ValueError: # the last line might be incomplete after a crash
+                    break
+    if os.path.exists(step_dir + 'manifests/'):
+        for basename in sorted(os.listdir(step_dir + 'manifests/')):
+            if basename.endswith('.json'):
+                with open(step_dir + 'manifests/' + basename) as f:
+                    patients_json.update(json.load(f, object_pairs_hook=OrderedDict))
+    return patients_json
+
+def _rebuild_out_json_from_journal():
+    """Update out.json with all records in the journal.
+
+    Steps in `per_patient_steps` only journal their patients, out.json is
+    written once by the pipeline when the step is finished."""
+    patients_json = load_journal()
+    if not patients_json:
+        return
+    out_json = OrderedDict()
+    if os.path.exists(get_step_dir() + 'out.json'):
+        out_json = load_json('out.json')
+    out_json.update(patients_json)
+    patients_set = set(patients)
+    save_json('out.json', OrderedDict([(p, out_json[p]) for p in patients if p in out_json]
+                                      + [(p, r) for p, r in out_json.items() if p not in patients_set]))
+
+def _get_io_bytes():
+    """Bytes read and written by the process so far, zero where /proc is not available."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError):
+        return 0, 0
+
+def _get_peak_rss_bytes():
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else 1024 * peak_rss # kilobytes on linux
+
+def _write_metrics():
+    """Summarize `metrics.journal` by patient and by phase in `metrics.json`."""
+    filename = get_step_dir() + 'metrics.journal'
+    if not os.path.exists(filename):
+        return False
+    records = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError: # incomplete line of a killed process
+                pass
+    if not records:
+        return False
+    patients_json = OrderedDict()
+    unattributed_s = OrderedDict() # by phase, of records without a patient
+    for record in records:
+        if record['patient'] is None:
+            unattributed_s[record['phase']] = unattributed_s.get(record['phase'], 0) + record['time_s']
+            continue
+        patient = str(record['patient'])
+        if patient not in patients_json:
+            patients_json[patient] = OrderedDict([('time_s', 0), ('read_bytes', 0), ('written_bytes', 0),
+                                                  ('peak_rss_bytes', 0), ('phases', OrderedDict())])
+        patient_json = patients_json[patient]
+        for key in ['time_s', 'read_bytes', 'written_bytes']:
+            if not (key == 'time_s' and record.get('overlapped')):
+                patient_json[key] += record[key]
+        patient_json['peak_rss_bytes'] = max(patient_json['peak_rss_bytes'], record['peak_rss_bytes'])
+        patient_json['phases'][record['phase']] = patient_json['phases'].get(record['phase'], 0) + record['time_s']
+    phases_json = OrderedDict()
+    for phase in OrderedDict((r['phase'], None) for r in records):
+        # a phase can be entered several times per patient
+        times = np.array([p['phases'][phase] for p in patients_json.values() if phase in p['phases']])
+        phases_json[phase] = OrderedDict([('n_patients', len(times)),
+                                          ('total_s', float(times.sum()) + unattributed_s.get(phase, 0))])
+        if len(times) > 0:
+            phases_json[phase].update([('p' + str(q) + '_s', float(np.percentile(times, q))) for q in [50, 90, 99]]
+                                      + [('max_s', float(times.max()))])
+    slowest = sorted(patients_json, key=lambda p: patients_json[p]['time_s'], reverse=True)[:10]
+    metrics_json = OrderedDict([('phases', phases_json),
+                                ('slowest_patients', slowest),
+                                ('peak_rss_bytes', max(r['peak_rss_bytes'] for r in records)),
+                                ('patients', patients_json)])
+    utils.replace_file(get_step_dir() + 'metrics.json',
+                       lambda f: json.dump(metrics_json, f, indent=4, indent_to_level=1))
+    return True
+
+def _register_loaded_step(step_name):
+    if step_name is not None and step_name != __step_name:
+        __loaded_steps.add(step_name)
+
+def _get_step_module_version(step):
+    """Hash of the source of the step module and of the dsb3 modules it imports."""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    version = hashlib.sha1()
+    for filename in sorted(_get_imported_sources(os.path.abspath(step.__file__), package_dir)):
+        with open(filename, 'rb') as f:
+            version.update(os.path.relpath(filename, package_dir).encode() + f.read())
+    return version.hexdigest()
+
+def _get_imported_sources(filename, package_dir, sources=None):
+    """Source files of package_dir that filename imports, directly or not,
+    also within functions, including filename."""
+    sources = set() if sources is None else sources
+    sources.add(filename)
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom):
+            if node.level > 0:
+                base_dir = os.path.dirname(filename)
+                for _ in range(node.level - 1):
+                    base_dir = os.path.dirname(base_dir)
+            elif node.module is not None and node.module.split('.')[0] == 'dsb3':
+                base_dir = os.path.dirname(package_dir)
+            else:
+                continue
+            module_path = os.path.join(base_dir, *(node.module.split('.') if node.module else []))
+            # from .. import module or from ..module import name
+            paths = [module_path] + [os.path.join(module_path, alias.name) for alias in node.names]
+        elif isinstance(node, ast.Import):
+            paths = [os.path.join(os.path.dirname(package_dir), *alias.name.split('.'))
+                     for alias in node.names if alias.name.split('.')[0] == 'dsb3']
+        else:
+            continue
+        for path in paths:
+            for source in [path + '.py', os.path.join(path, '__init__.py')]:
+                if source.startswith(package_dir + os.sep) and os.path.isfile(source) and source not in sources:
+                    _get_imported_sources(source, package_dir, sources)
+    return sources
+
+def _get_patients_cache_keys(patients, step, upstream_steps):
+    """Hash params, step module version and the upstream artifacts of each patient.
+
+    For each upstream step, the patient's record in out.json, the params.json of
+    the step and size and modification time of the array that the record
+    references via 'basename' enter the key. For the raw data, it's the path and
+    the number, sizes and newest modification time of its files.
+    """
+    with open(get_step_dir() + 'params.json') as f:
+        key_base = hashlib.sha1((f.read() + _get_step_module_version(step)).encode())
+    upstream_jsons = OrderedDict()
+    for step_name in sorted(upstream_steps):
+        try:
+            upstream_jsons[step_name] = (load_json('out.json', step_name),
+                                         json.dumps(load_json('params.json', step_name), sort_keys=True),
+                                         _get_step_dir_for_load(step_name) + 'arrays/')
+        except FileNotFoundError:
+            upstream_jsons[step_name] = (OrderedDict(), '', '')
+    keys = OrderedDict()
+    for patient in patients:
+        key = key_base.copy()
+        raw_data_path = patients_raw_data_paths[patient]
+        key.update((raw_data_path + str(_get_raw_data_stat(raw_data_path))).encode())
+        for step_name, (out_json, params_str, arrays_dir) in upstream_jsons.items():
+            record = out_json.get(patient)
+            key.update((step_name + params_str + json.dumps(record, sort_keys=True)).encode())
+            if isinstance(record, dict) and 'basename' in record:
+                key.update(str([_get_file_stat(arrays_dir + record['basename'] + suffix)
+                                for suffix in storage.avail_suffixes]).encode())
+        keys[patient] = key.hexdigest()
+    return keys
+
+def _get_raw_data_stat(path):
+    """Number of files, total size and newest modification time of a DICOM
+    directory, or of an .mhd file and its .raw file."""
+    if os.path.isdir(path):
+        filenames = [os.path.join(path, name) for name in os.listdir(path)]
+    else:
+        filenames = [path] + ([path[:-len('.mhd')] + '.raw'] if path.endswith('.mhd') else [])
+    stats = [stat for stat in map(_get_file_stat, filenames) if stat is not None]
+    if not stats:
+        return None
+    return len(stats), sum(size for size, _ in stats), max(mtime for _, mtime in stats)
+
+def _get_file_stat(filename):
+    try:
+        stat = os.stat(filename)
+        return stat.st_size, stat.st_mtime
+    except FileNotFoundError:
+        return None
+
+def _load_cached_patients(step):
+    """Records in out.json of all patients whose cache key did not change."""
+    manifest_filename = get_step_dir() + 'cache_manifest.json'
+    out_filename = get_step_dir() + 'out.json'
+    if not os.path.exists(manifest_filename) or not os.path.exists(out_filename):
+        return OrderedDict()
+    manifest = load_json('cache_manifest.json')
+    out_json = load_json('out.json')
+    keys = _get_patients_cache_keys(patients, step, manifest['upstream_steps'])
+    return OrderedDict([(patient, out_json[patient]) for patient in patients
+                        if patient in out_json and manifest['keys'].get(patient) == keys[patient]])
+
+def _update_cache(step, patients_cached, upstream_steps):
+    """Merge cached records into out.json and write the cache manifest."""
+    out_json = OrderedDict()
+    if len(patients_cached) < len(patients) and os.path.exists(get_step_dir() + 'out.json'):
+        out_json = load_json('out.json')
+    patients_json = OrderedDict()
+    for patient in patients:
+        if patient in patients_cached:
+            patients_json[patient] = patients_cached[patient]
+        elif patient in out_json:
+            patients_json[patient] = out_json[patient]
+    for patient, record in out_json.items():
+        if patient not in patients_json:
+            patients_json[patient] = record
+    save_json('out.json', patients_json)
+    keys = _get_patients_cache_keys([p for p in patients if p in patients_json], step, upstream_steps)
+    manifest = OrderedDict([('upstream_steps', sorted(upstream_steps)),
+                            ('hits', list(patients_cached.keys())),
+                            ('misses', [p for p in keys if p not in patients_cached]),
+                            ('keys', keys)])
+    save_json('cache_manifest.json', manifest)
+
+@contextmanager
+def _restrict_patients(patients_subset):
+    """Temporarily restrict `patients` and `patients_by_split` to a subset."""
+    global patients, n_patients, patients_by_split
+    patients_save, n_patients_save, patients_by_split_save = patients, n_patients, patients_by_split
+    patients_subset_set = set(patients_subset)
+    patients = [p for p in patients if p in patients_subset_set]
+    n_patients = len(patients)
+    if patients_by_split is not None:
+        patients_by_split = OrderedDict([(split, [p for p in split_patients if p in patients_subset_set])
+                                         for split, split_patients in patients_by_split.items()])
+    try:
+        yield
+    finally:
+        patients, n_patients, patients_by_split = patients_save, n_patients_save, patients_by_split_save
+
 def _init_run(run=-1, run_descr='', init_run=-1):
     runs_filename = write_basedir + dataset_name + '_runs.json'    
     # case run == -1 and the step has already been run before
@@ -190,7 +674,7 @@ def _init_run(run=-1, run_descr='', init_run=-1):
     if avail_runs and run_descr == '':
         run_descr = avail_runs[str(run)][1]
     avail_runs[str(run)] = [time.strftime('%Y-%m-%d %H:%M', time.localtime()), run_descr]
-    json.dump(avail_runs, open(runs_filename, 'w'), indent=4, indent_to_level=0)
+    utils.replace_file(runs_filename, lambda f: json.dump(avail_runs, f, indent=4, indent_to_level=0))
     # update global variables
     global __run, __init_run, write_dir
     __run = run
@@ -214,8 +698,8 @@ def _init_step(step_name, mode='w', suffix=''):
     # init step logger
     _init_log_step(step_name, mode=mode)
 
-def _run_step(step_name, params, suffix=''):
-    _init_step(step_name, suffix=suffix)
+def _start_step(step_name, params, suffix='', mode='w'):
+    _init_step(step_name, mode=mode, suffix=suffix)
     info = 'run ' + str(__run) + ' (' + avail_runs[str(__run)][1] + ')' \
            + ' / step ' + str(__step) + ' (' + __step_name + ')' \
            + (' with init ' + str(__init_run) if __init_run > -1 else '')
@@ -229,9 +713,11 @@ def _run_step(step_name, params, suffix=''):
     log.info(params_info)
     log.info('start step with ' + ('init_run=' + str(__init_run)) if __init_run > -1 else 'default init_run (most recent run)')
     # saving params dict
-    json.dump(params, open(get_step_dir() + 'params.json', 'w'), indent=4, indent_to_level=0)
+    utils.replace_file(get_step_dir() + 'params.json', lambda f: json.dump(params, f, indent=4, indent_to_level=0))
     # import step module
-    step = import_module('.steps.' + step_name, 'dsb3')
+    return import_module('.steps.' + step_name, 'dsb3')
+
+def _call_step(step, params):
     try:
         step.run(**params)
     except TypeError as e:
@@ -239,13 +725,289 @@ def _run_step(step_name, params, suffix=''):
             raise TypeError(str(e) + '\n Provide one of the valid parameters\n' + step.run.__doc__)
         else:
             raise e
+
+def _finish_step():
     # generate an html that compiles all figures written to `step_dir + 'figs/'`
     if _visualize_step():
         log.info('... wrote ' +  get_step_dir() + 'figs' + '.html')
+    if _write_metrics():
+        log.info('... wrote ' + get_step_dir() + 'metrics.json')
     finish_msg = '... finished the step'
     log.info(finish_msg)
     log_pipe.info(finish_msg)
 
+def _run_step(step_name, params, suffix='', use_cache=True, resume=False):
+    step = _start_step(step_name, params, suffix)
+    # skip patients whose params and upstream artifacts did not change
+    use_cache = use_cache and step_name in per_patient_steps
+    patients_cached = _load_cached_patients(step) if use_cache else OrderedDict()
+    if use_cache:
+        log.info('cache: ' + str(len(patients_cached)) + ' hits, '
+                 + str(n_patients - len(patients_cached)) + ' misses')
+    # skip patients that have been completed before a crash, start a new journal otherwise
+    if resume:
+        patients_journaled = load_journal()
+        log.info('resume: ' + str(len([p for p in patients if p in patients_journaled])) + ' patients found in journal')
+    else:
+        patients_journaled = OrderedDict()
+        _remove_journal(get_step_dir())
+    patients_done = set(patients_cached) | (set(patients_journaled) if step_name in per_patient_steps else set())
+    __loaded_steps.clear()
+    step_is_run = len([p for p in patients if p not in patients_done]) > 0
+    if step_is_run:
+        if not resume and step_name in per_patient_steps:
+            # drop the records of the previous run, out.json is rebuilt from the journal below
+            save_json('out.json', patients_cached)
+        with _restrict_patients([p for p in patients if p not in patients_done]):
+            _call_step(step, params)
+    if step_name in per_patient_steps:
+        _rebuild_out_json_from_journal()
+    if use_cache:
+        upstream_steps = set(__loaded_steps)
+        if not step_is_run and os.path.exists(get_step_dir() + 'cache_manifest.json'): # keep the upstream steps of the previous run
+            upstream_steps = set(load_json('cache_manifest.json')['upstream_steps'])
+        _update_cache(step, patients_cached, upstream_steps)
+        log.info('... wrote ' + get_step_dir() + 'cache_manifest.json')
+    _finish_step()
+
+def _run_step_streaming(step_name, params, suffix=''):
+    """Run a step once while its upstream steps are still finishing patients.
+
+    The step iterates over its patients with `iter_patients` or
+    `iter_patient_chunks`. They append the patients to `stream_wanted.lst`
+    and pull each of them as soon as all upstream steps have journaled it,
+    appending it to `stream_pulled.lst`. The upstream and downstream step
+    directories, the queue size and the GPU memory fraction of the streamed
+    GPU steps are read from `stream.json` in the write directory. No patient
+    is pulled while a downstream step has `max_queue_size` or more journaled
+    patients that it wants, or before it iterates any, left to pull. Patients
+    that an upstream step did not journal, e.g., as it failed on them, are
+    skipped once it is finished. When the step is done, `stream_finished` is
+    written to the step directory.
+    """
+    global __stream, GPU_memory_fraction
+    stream_json = load_json_troll(get_write_dir() + 'stream.json')
+    node = stream_json['nodes'][step_name + suffix]
+    if step_name in gpu_steps:
+        GPU_memory_fraction = stream_json['GPU_memory_fraction']
+    step = _start_step(step_name, params, suffix)
+    patients_journaled = load_journal()
+    log.info('stream: {} patients done before, upstream {}, downstream {}'.format(
+             len([p for p in patients if p in patients_journaled]), node['upstream'], node['downstream']))
+    patients_todo = [p for p in patients if p not in patients_journaled]
+    __stream = {'upstream_dirs': [get_write_dir() + d + '/' for d in node['upstream']],
+                'downstream_dirs': [get_write_dir() + d + '/' for d in node['downstream']],
+                'max_queue_size': stream_json['max_queue_size'],
+                'patients_pulled': [],
+                'patients_wanted': set()}
+    try:
+        with _restrict_patients(patients_todo):
+            _call_step(step, params)
+        n_pulled = len(__stream['patients_pulled'])
+    finally:
+        __stream = None
+    if step_name in per_patient_steps:
+        _rebuild_out_json_from_journal()
+    open(get_step_dir() + 'stream_finished', 'w').close()
+    log.info('stream: pulled {} of {} patients'.format(n_pulled, len(patients_todo)))
+    _finish_step()
+
+def _pull_stream(patients_subset, patients_exclude, wait):
+    """Next patient of patients_subset not in patients_exclude, pulled before or now.
+
+    Returns None if there is none ready, with wait only once all upstream
+    steps are finished.
+    """
+    patients_subset_set = set(patients_subset)
+    for patient in __stream['patients_pulled']:
+        if patient in patients_subset_set and patient not in patients_exclude:
+            return patient
+    while True:
+        # check this before reading the upstream journals, which are then complete
+        upstream_finished = all(os.path.exists(d + 'stream_finished') for d in __stream['upstream_dirs'])
+        patients_ready = patients_subset_set - set(__stream['patients_pulled']) - patients_exclude
+        for d in __stream['upstream_dirs']:
+            patients_ready &= set(_load_journal_dir(d))
+        patients_journaled = set(load_journal())
+        n_queued = 0
+        for d in __stream['downstream_dirs']:
+            patients_queued = patients_journaled - _load_stream_lst(d + 'stream_pulled.lst') - set(_load_journal_dir(d))
+            if os.path.exists(d + 'stream_wanted.lst'):
+                patients_queued &= _load_stream_lst(d + 'stream_wanted.lst')
+            n_queued = max(n_queued, len(patients_queued))
+        if patients_ready and n_queued < __stream['max_queue_size']:
+            patient = [p for p in patients_subset if p in patients_ready][0]
+            __stream['patients_pulled'].append(patient)
+            with open(get_step_dir() + 'stream_pulled.lst', 'a') as f:
+                f.write(patient + '\n')
+            # the indexes loaded by the step need the records of the patient
+            for step_dir in __loaded_indexes:
+                _update_index(step_dir)
+            return patient
+        if not wait or upstream_finished and not patients_ready:
+            return None
+        time.sleep(1)
+
+def _init_streaming(step_dirnames, resume=False):
+    """Remove the stream files of a previous run, keep the journals if resuming."""
+    for dirname in step_dirnames:
+        step_dir = get_write_dir() + dirname + '/'
+        utils.ensure_dir(step_dir)
+        for filename in ['stream_finished', 'stream_pulled.lst', 'stream_wanted.lst']:
+            if os.path.exists(step_dir + filename):
+                os.remove(step_dir + filename)
+        if not resume:
+            _remove_journal(step_dir)
+            # downstream steps read the journal merged into out.json while streaming, see `load_json`
+            utils.replace_file(step_dir + 'out.json', lambda f: f.write('{}'))
+
+def _load_stream_lst(filename):
+    if not os.path.exists(filename):
+        return set()
+    with open(filename) as f:
+        return set(line.strip() for line in f if line.endswith('\n'))
+
+def _run_step_leased(step_name, params, suffix='', lease_timeout=600):
+    """Process the patients of a step together with other workers that share the step directory.
+
+    The step is run once per worker. It iterates over its patients with
+    `iter_patients` or `iter_patient_chunks`, which claim each patient by
+    creating a lease file in `step_dir/leases/` when it is taken; the worker
+    renews its leases until the patients are journaled. Leases that have not
+    been renewed for `lease_timeout` seconds, e.g., of a dead worker, are taken
+    over. When no patient is left to claim, idle workers also take over leases
+    claimed more than `3 * lease_timeout` seconds ago to catch up with
+    stragglers, and wait until all patients are done. Records are written as
+    per-patient manifests, from which each worker rebuilds out.json. Start the
+    same command on several processes or hosts to add workers; remove
+    `leases/` and `manifests/` to start over.
+    """
+    global __manifests, __leases
+    __manifests = True
+    step = _start_step(step_name, params, suffix, mode='a')
+    worker = socket.gethostname() + '_' + str(os.getpid())
+    utils.ensure_dir(get_step_dir() + 'leases/')
+    utils.ensure_dir(get_step_dir() + 'manifests/')
+    log.info('worker ' + worker + ' with lease timeout ' + str(lease_timeout) + ' s')
+    patients_journaled = load_journal()
+    patients_todo = [p for p in patients if p not in patients_journaled]
+    leases = {'worker': worker,
+              'lease_timeout': lease_timeout,
+              'patients_leased': set(), # claimed and not yet journaled
+              'patients_done': set(patients_journaled),
+              'n_claimed': 0}
+    stop_renewing = threading.Event()
+    renew_thread = threading.Thread(target=_renew_leases,
+                                    args=(leases['patients_leased'], worker, lease_timeout, stop_renewing))
+    renew_thread.start()
+    __leases = leases
+    try:
+        with _restrict_patients(patients_todo):
+            _call_step(step, params)
+    except:
+        for patient in list(leases['patients_leased']):
+            _release_lease(patient, worker)
+        raise
+    finally:
+        __leases = None
+        stop_renewing.set()
+        renew_thread.join()
+    # patients that the step skipped, e.g., as it failed on them
+    for patient in leases['patients_leased']:
+        _write_lease(patient, worker, done=True)
+    if step_name in per_patient_steps:
+        _rebuild_out_json_from_journal()
+    log.info('worker {} claimed {} patients'.format(worker, leases['n_claimed']))
+    _finish_step()
+
+def _iter_leased_chunks(patients_subset, chunk_size):
+    """Lists of up to `chunk_size` patients of patients_subset claimed by the worker.
+
+    Waits while other workers hold the leases of the remaining patients.
+    """
+    patients_yielded = set()
+    while True:
+        patients_todo = [p for p in patients_subset if p not in patients_yielded and p not in __leases['patients_done']]
+        if not patients_todo:
+            return
+        patients_chunk = _claim_leases(patients_todo, __leases['worker'], __leases['lease_timeout'], chunk_size,
+                                       __leases['patients_done'])
+        if not patients_chunk:
+            if any(p not in __leases['patients_done'] for p in patients_todo):
+                time.sleep(min(10, __leases['lease_timeout'] / 10))
+            continue
+        __leases['patients_leased'].update(patients_chunk)
+        __leases['n_claimed'] += len(patients_chunk)
+        patients_yielded.update(patients_chunk)
+        log.info('worker {} claimed {} patients, {} patients left'.format(
+                 __leases['worker'], len(patients_chunk), len(patients_todo) - len(patients_chunk)))
+        yield patients_chunk
+
+def _claim_leases(patients_todo, worker, lease_timeout, n_max, patients_done):
+    """Claim up to `n_max` patients that are not leased or whose lease expired,
+    add the patients whose lease is done to `patients_done`."""
+    batch = []
+    for take_over_stragglers in [False, True]:
+        for patient in patients_todo:
+            if len(batch) == n_max:
+                return batch
+            if patient in patients_done:
+                continue
+            filename = get_step_dir() + 'leases/' + patient
+            try:
+                fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                _write_lease(patient, worker)
+                batch.append(patient)
+                continue
+            except FileExistsError:
+                pass
+            lease = _read_lease(patient)
+            if lease.get('done'):
+                patients_done.add(patient)
+            if not lease or lease.get('done') or lease['worker'] == worker:
+                continue
+            now = time.time()
+            if (now - lease['renewed'] > lease_timeout
+                or take_over_stragglers and now - lease['claimed'] > 3 * lease_timeout):
+                _write_lease(patient, worker)
+                # another worker might have taken over at the same time
+                if _read_lease(patient).get('worker') == worker:
+                    log.info('took over ' + patient + ' from ' + lease['worker'])
+                    batch.append(patient)
+        if batch:
+            break
+    return batch
+
+def _read_lease(patient):
+    filename = get_step_dir() + 'leases/' + patient
+    try:
+        with open(filename) as f:
+            content = f.read()
+        renewed = os.path.getmtime(filename)
+    except FileNotFoundError:
+        return {}
+    try:
+        lease = json.loads(content)
+    except ValueError: # just being created, or the worker died while creating it
+        lease = OrderedDict([('worker', None), ('claimed', renewed), ('done', False)])
+    lease['renewed'] = renewed
+    return lease
+
+def _write_lease(patient, worker, done=False):
+    lease = OrderedDict([('worker', worker), ('claimed', time.time()), ('done', done)])
+    utils.replace_file(get_step_dir() + 'leases/' + patient, lambda f: json.dump(lease, f))
+
+def _release_lease(patient, worker):
+    if _read_lease(patient).get('worker') == worker:
+        os.remove(get_step_dir() + 'leases/' + patient)
+
+def _renew_leases(patients_leased, worker, lease_timeout, stop_renewing):
+    while not stop_renewing.wait(lease_timeout / 4):
+        for patient in list(patients_leased):
+            if _read_lease(patient).get('worker') == worker:
+                os.utime(get_step_dir() + 'leases/' + patient)
+
 def _visualize_step(step_name=None):
     if step_name is None:
         step_name = __step_name
@@ -278,7 +1040,7 @@ def _init_patients(_n_patients=0, single_patient_id=None, fromto_patients=None):
             patients = [p.split('/')[-2] for p in patient_paths]
         patients_raw_data_paths = OrderedDict(zip(patients, patient_paths))
         utils.ensure_dir(filename)
-        json.dump(patients_raw_data_paths, open(filename, 'w'), indent=4)
+        utils.replace_file(filename, lambda f: json.dump(patients_raw_data_paths, f, indent=4))
     global __step_dir_suffix
     __step_dir_suffix = ''
     if _n_patients > 0:
@@ -400,6 +1162,8 @@ def _init_log_step(step_name, level=logging.DEBUG, mode='w'):
     global log_tf
     log_tf = step_dir + 'log_tf.txt'
     open(log_tf, mode).close()
+    # records of `timing`
+    open(step_dir + 'metrics.journal', mode).close()
 
 class LogFormatter(logging.Formatter):
     def __init__(self, fmt='%(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M', style='%', passed_time=False):
@@ -16,7 +16,7 @@ def run(num_augs_per_img,
         n_candidates,
         all_patients):
     # load some information json
-    gen_candidates_json = pipe.load_json('out.json', 'gen_candidates')
+    gen_candidates_json = pipe.load_index('gen_candidates')
     out_json = OrderedDict()
     # get some parameters
     net_config = {}
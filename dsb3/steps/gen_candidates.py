@@ -1,7 +1,6 @@
 import os, sys
 import numpy as np
 import json
-from sklearn.cluster import DBSCAN
 from functools import reduce
 from tqdm import tqdm
 from collections import OrderedDict
@@ -18,47 +17,62 @@ def run(n_candidates,
         threshold_prob_map,
         cube_shape,
         all_patients):
-    resample_lungs_json = pipe.load_json('out.json', 'resample_lungs')
-    gen_prob_maps_json  = pipe.load_json('out.json', ensemble_foldername_of_prob_maps[0])
+    resample_lungs_json = pipe.load_index('resample_lungs')
+    gen_prob_maps_json  = pipe.load_index(ensemble_foldername_of_prob_maps[0])
     gen_nodule_masks_json = None
     considered_patients = pipe.patients if all_patients else pipe.patients_by_split['va']
     if not ensemble_foldername_of_prob_maps:
         ensemble_foldername_of_prob_maps = ['gen_prob_maps']
     if pipe.dataset_name == 'LUNA16':
-        gen_nodule_masks_json = pipe.load_json('out.json', 'gen_nodule_masks')
-    patients_candidates_json = OrderedDict(Parallel(n_jobs=min(pipe.n_CPUs, len(considered_patients)), verbose=100)(
-                                           delayed(process_patient)(patient,
-                                                                    n_candidates,
-                                                                    sort_clusters_by,
-                                                                    threshold_prob_map,
-                                                                    cube_shape,
-                                                                    resample_lungs_json,
-                                                                    gen_prob_maps_json,
-                                                                    gen_nodule_masks_json,
-                                                                    ensemble_foldername_of_prob_maps)
-                                           for patient in considered_patients))
-    # write both patients and candidates list
-    patients_lst_path = pipe.get_step_dir() + 'patients.lst'
-    patients_lst = open(patients_lst_path, 'w')
-    # if pipe.dataset_name == 'LUNA16':
-    if 1:
-        candidates_lst_path = pipe.get_step_dir() + 'candidates.lst'
-        candidates_lst = open(candidates_lst_path, 'w')
-    for patient_cnt, patient in enumerate(tqdm(considered_patients)):
-        patients_lst.write(patients_candidates_json[patient]['patients_lst'])
+        gen_nodule_masks_json = pipe.load_index('gen_nodule_masks')
+    # patients completed before resuming the step are in the journal
+    patients_candidates_json = pipe.load_journal()
+    considered_patients = [p for p in considered_patients if p not in patients_candidates_json]
+    # a single chunk unless the step is streamed
+    for patients_chunk in pipe.iter_patient_chunks(considered_patients, pipe.n_CPUs):
+        patients_chunk_json = OrderedDict(Parallel(n_jobs=min(pipe.n_CPUs, len(patients_chunk)), verbose=100)(
+                                          delayed(process_patient)(patient,
+                                                                   n_candidates,
+                                                                   sort_clusters_by,
+                                                                   threshold_prob_map,
+                                                                   cube_shape,
+                                                                   resample_lungs_json,
+                                                                   gen_prob_maps_json,
+                                                                   gen_nodule_masks_json,
+                                                                   ensemble_foldername_of_prob_maps)
+                                          for patient in patients_chunk))
+        patients_candidates_json.update(patients_chunk_json)
+        # downstream steps read the lists of the patients in the journal while streaming, write them first
+        write_lsts(patients_candidates_json)
+        for patient, patient_json in patients_chunk_json.items():
+            pipe.append_journal(patient, patient_json)
+    # write both patients and candidates list for all patients in the journal
+    patients_candidates_json = pipe.load_journal()
+    write_lsts(patients_candidates_json)
+    for patient in patients_candidates_json:
         del patients_candidates_json[patient]['patients_lst']
         # if pipe.dataset_name == 'LUNA16':
         if 1:
-            for line in patients_candidates_json[patient]['candidates_lst']:
-                candidates_lst.write(line)
             del patients_candidates_json[patient]['candidates_lst']
-    patients_lst.close()
+    pipe.save_json('out.json', patients_candidates_json)
+
+def write_lsts(patients_candidates_json):
+    patients_lst_lines = []
+    candidates_lst_lines = []
+    for patient_cnt, patient in enumerate(tqdm(patients_candidates_json)):
+        patients_lst_lines.append(patients_candidates_json[patient]['patients_lst'])
+        # if pipe.dataset_name == 'LUNA16':
+        if 1:
+            candidates_lst_lines += patients_candidates_json[patient]['candidates_lst']
+    # replace the lists atomically as downstream steps might read them while streaming
+    patients_lst_path = pipe.get_step_dir() + 'patients.lst'
+    utils.replace_file(patients_lst_path, lambda f: f.write(''.join(patients_lst_lines)))
     print('wrote', patients_lst_path)
     # if pipe.dataset_name == 'LUNA16':
     if 1:
-        candidates_lst.close()
+        candidates_lst_path = pipe.get_step_dir() + 'candidates.lst'
+        utils.replace_file(candidates_lst_path, lambda f: f.write(''.join(candidates_lst_lines)))
         print('wrote', candidates_lst_path)
-    pipe.save_json('out.json', patients_candidates_json)
 
 def process_patient(patient,
                     n_candidates,
@@ -69,52 +83,62 @@ def process_patient(patient,
                     gen_prob_maps_json,
                     gen_nodule_masks_json,
                     ensemble_foldername_of_prob_maps):
-    try:
-        prob_map = pipe.load_array(gen_prob_maps_json[patient]['basename'], ensemble_foldername_of_prob_maps[0]).astype(np.int16)
-        for folder_name in ensemble_foldername_of_prob_maps[1:]:
-            prob_map += pipe.load_array(gen_prob_maps_json[patient]['basename'], folder_name).astype(np.int16)
-        prob_map = (prob_map/len(ensemble_foldername_of_prob_maps)).astype(np.uint8)
-    except:
-        prob_map = pipe.load_array(gen_prob_maps_json[patient]['basename'], 'gen_prob_maps')
-        pipe.log.warning('colud not ensemble prob_maps for patient {}. only consider prob_map from gen_prob_maps and continue.'.format(patient))
+    with pipe.timing('load', patient):
+        try:
+            prob_map = pipe.load_array(gen_prob_maps_json[patient]['basename'], ensemble_foldername_of_prob_maps[0], mmap=True)
+            # a single uint8 prob_map stays memory-mapped
+            if len(ensemble_foldername_of_prob_maps) > 1 or prob_map.dtype != np.uint8:
+                prob_map = prob_map.astype(np.int16)
+                for folder_name in ensemble_foldername_of_prob_maps[1:]:
+                    prob_map += pipe.load_array(gen_prob_maps_json[patient]['basename'], folder_name, mmap=True)
+                prob_map = (prob_map/len(ensemble_foldername_of_prob_maps)).astype(np.uint8)
+        except:
+            prob_map = pipe.load_array(gen_prob_maps_json[patient]['basename'], 'gen_prob_maps', mmap=True)
+            pipe.log.warning('colud not ensemble prob_maps for patient {}. only consider prob_map from gen_prob_maps and continue.'.format(patient))
 
-    if prob_map.dtype == np.float32:
-        prob_map = (255 * prob_map).astype(np.uint8)
-    elif prob_map.dtype == np.uint16:
-        raise ValueError('Data type uint16 for prob_map not implemented in gen_candidates.')
-    prob_map_avg = np.sum(prob_map) / 255 / prob_map.size
+    with pipe.timing('clustering', patient):
+        if prob_map.dtype == np.float32:
+            prob_map = (255 * prob_map).astype(np.uint8)
+        elif prob_map.dtype == np.uint16:
+            raise ValueError('Data type uint16 for prob_map not implemented in gen_candidates.')
+        prob_map_avg = np.sum(prob_map) / 255 / prob_map.size
 
-    prob_map_thresh = prob_map.copy()
-    prob_map_thresh[prob_map_thresh < threshold_prob_map * 255] = 0.0 # here prob_map is in units of 255
-    # the points in mm units, relative to dummy origin in pixels
-    prob_map_points_px = np.argwhere(prob_map_thresh)
-    prob_map_points_mm = prob_map_points_px * resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm']
-    try:
-        avg_n_points_per_cmm = int(np.round(reduce(lambda x, y: x*y, 
-                                                   [1/s for s in resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm']])))
-    except:
-        avg_n_points_per_cmm = 4
-        wrong_spacing_warning = ('Wrong resampled spacing data {} for patient {}.'.format(
-                                 resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm'], patient))
-        pipe.log.error(wrong_spacing_warning + ' Assuming per cmm ' + str(avg_n_points_per_cmm))
+        # non-zero points above threshold, here prob_map is in units of 255
+        # work slab by slab, so that no full-size copy of a memory-mapped prob_map is made
+        slab_size = 32
+        prob_map_points_px = np.concatenate([np.zeros((0, 3), dtype=np.int64)]
+                                            + [np.argwhere(prob_map[z:z+slab_size] >= max(1, threshold_prob_map * 255)) + [z, 0, 0]
+                                               for z in range(0, prob_map.shape[0], slab_size)])
+        # the points in mm units, relative to dummy origin in pixels
+        prob_map_points_mm = prob_map_points_px * resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm']
+        try:
+            avg_n_points_per_cmm = int(np.round(reduce(lambda x, y: x*y, 
+                                                       [1/s for s in resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm']])))
+        except:
+            avg_n_points_per_cmm = 4
+            wrong_spacing_warning = ('Wrong resampled spacing data {} for patient {}.'.format(
+                                     resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm'], patient))
+            pipe.log.error(wrong_spacing_warning + ' Assuming per cmm ' + str(avg_n_points_per_cmm))
 
-    prob_map_X_norm = prob_map[prob_map_points_px[:, 0], prob_map_points_px[:, 1], prob_map_points_px[:, 2]].astype('float32') / 255
-    dbscan_args = prob_map_points_mm, prob_map_points_px, prob_map_X_norm, avg_n_points_per_cmm
-    clusters = dbscan(*dbscan_args)
-    # the clusters might be overly large, split them if this is the case
-    clusters = split_clusters(clusters, cube_shape, prob_map.shape, dbscan_args,
-                              threshold=threshold_prob_map)
-    # now we are sure that the clusters are small enough to fit into the boxes
-    # get the boxes around the clusters and the corresponding arrays
-    clusters = get_clusters_box_coords(clusters, cube_shape)
-    clusters = get_clusters_array(clusters, cube_shape, prob_map, 'prob_map')
-    # sort clusters, trunkate clusters, clean the cluster dict
-    clusters = sort_clusters(clusters, key=sort_clusters_by)
-    clusters = clusters[:n_candidates]
-    clusters = remove_masks_from_clusters(clusters)
+        prob_map_X_norm = prob_map[prob_map_points_px[:, 0], prob_map_points_px[:, 1], prob_map_points_px[:, 2]].astype('float32') / 255
+        dbscan_args = prob_map_points_mm, prob_map_points_px, prob_map_X_norm, avg_n_points_per_cmm
+        clusters = dbscan(*dbscan_args)
+        # the clusters might be overly large, split them if this is the case
+        clusters = split_clusters(clusters, cube_shape, prob_map.shape, dbscan_args,
+                                  threshold=threshold_prob_map)
+        # now we are sure that the clusters are small enough to fit into the boxes
+        # get the boxes around the clusters and the corresponding arrays
+        clusters = get_clusters_box_coords(clusters, cube_shape)
+        clusters = get_clusters_array(clusters, cube_shape, prob_map, 'prob_map')
+        # sort clusters, trunkate clusters, clean the cluster dict
+        clusters = sort_clusters(clusters, key=sort_clusters_by)
+        clusters = clusters[:n_candidates]
+        clusters = remove_masks_from_clusters(clusters)
     # fill clusters with the original image data
-    img_array = pipe.load_array(resample_lungs_json[patient]['basename'], 'resample_lungs')
-    clusters = get_clusters_array(clusters, cube_shape, img_array.copy(), 'img')
+    # only the cropped cubes are read from disk
+    with pipe.timing('load', patient):
+        img_array = pipe.load_array(resample_lungs_json[patient]['basename'], 'resample_lungs', mmap=True)
+        clusters = get_clusters_array(clusters, cube_shape, img_array, 'img')
     patient_json = OrderedDict()
     if pipe.dataset_name == 'dsb3':
         # set cancer labels
@@ -157,13 +181,14 @@ def process_patient(patient,
         patient_json['clusters'].append(OrderedDict())
         cluster_json = patient_json['clusters'][cluster_cnt]
         # save candidate from img_array
-        cluster_json['img_basename'] = basename_img = patient + '_{:02}_img.npy'.format(cluster_cnt)
-        cluster_json['img_path'] = pipe.save_array(basename_img, clu['img_array'].astype(np.float32))
-        can_img_paths.append(cluster_json['img_path'])
-        # save candidate from prob_map
-        cluster_json['prob_map_basename'] = basename_prob_map = patient + '_{:02}_prob_map.npy'.format(cluster_cnt)
-        cluster_json['prob_map_path'] = pipe.save_array(basename_prob_map, clu['prob_map_array'].astype(np.uint8))
-        can_prob_map_paths.append(cluster_json['prob_map_path'])
+        with pipe.timing('save', patient):
+            cluster_json['img_basename'] = basename_img = patient + '_{:02}_img.npy'.format(cluster_cnt)
+            cluster_json['img_path'] = pipe.save_array(basename_img, clu['img_array'].astype(np.float32))
+            can_img_paths.append(cluster_json['img_path'])
+            # save candidate from prob_map
+            cluster_json['prob_map_basename'] = basename_prob_map = patient + '_{:02}_prob_map.npy'.format(cluster_cnt)
+            cluster_json['prob_map_path'] = pipe.save_array(basename_prob_map, clu['prob_map_array'].astype(np.uint8))
+            can_prob_map_paths.append(cluster_json['prob_map_path'])
         # check cluster_shape
         if clu['prob_map_array'].shape != tuple(cube_shape):
             raise ValueError('Wrong shape {} for patient  {}'.format(clu['prob_map_array'].shape, patient))
@@ -196,7 +221,7 @@ def process_patient(patient,
                 # overwrite the former candidate
                 nodule_box = get_cluster_box_coords(nodules[non_detect_cnt]['center_zyx_px'], cube_shape)
                 img_array_non_detect = utils.crop_and_embed(img_array, nodule_box, cube_shape)
-                pipe.save_array(basename_img, img_array.astype(np.float32))
+                pipe.save_array(basename_img, img_array_non_detect.astype(np.float32))
                 prob_map_array_non_detect = utils.crop_and_embed(prob_map, nodule_box, cube_shape)
                 pipe.save_array(basename_prob_map, prob_map_array_non_detect.astype(np.uint8))
             patient_json['candidates_lst'].append('{}_{}\t{}\t{}\t{}\t{}\n'.format(patient, cluster_cnt,
@@ -255,6 +280,7 @@ def dbscan(X_mm, X_px, weights, avg_n_points_per_cmm=1):
     # epsilon is in units mm, min_samples includes the point itself
     # on 1mm x 1mm x 1mm, we've seen prob_maps with just 4 high prob values that correspond to a nodule
     # only returns core_samples, therefore clusters might be smaller than min_nodule_size
+    from sklearn.cluster import DBSCAN
     db = DBSCAN(eps=1.03, min_samples=min_nodule_weight).fit(X_mm, sample_weight=weights)
     if not bool(db): return []
     labels = db.labels_
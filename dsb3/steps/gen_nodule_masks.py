@@ -1,7 +1,6 @@
 import os, sys
 import numpy as np
 import pandas as pd
-import cv2
 from joblib import Parallel, delayed
 from collections import OrderedDict
 from tqdm import tqdm
@@ -25,7 +24,7 @@ def run(LUNA16_annotations_csv_path,
     nodule_patients_set = set(annotations['seriesuid'].values.tolist()) & set(pipe.patients)
     # process nodule patients
     try:
-        resample_lungs_json = pipe.load_json('out.json', 'resample_lungs')
+        resample_lungs_json = pipe.load_index('resample_lungs')
     except FileNotFoundError:
         raise ValueError('Run step "resample_lungs" first!')
     pipe.log.info('process nodule patients')
@@ -47,7 +46,8 @@ def run(LUNA16_annotations_csv_path,
             patients_json[patient] = OrderedDict()
             patients_json[patient]['nodule_patient'] = False
             patients_json[patient]['nodules'] = [] # empty list
-            img_array = pipe.load_array(resample_lungs_json[patient]['basename'], 'resample_lungs')
+            # only the header is read to get the shape
+            img_array = pipe.load_array(resample_lungs_json[patient]['basename'], 'resample_lungs', mmap=True)
             mask_array = np.zeros(list(img_array.shape) + [2], dtype=np.uint8)
             patients_json[patient]['basename'] = basename = patient + '_mask.npy'
             patients_json[patient]['mask_path'] = pipe.save_array(basename, mask_array)
@@ -96,6 +96,7 @@ def process_nodule_patient(patient, annotations, resample_lungs_json,
         patient_json['nodules'].append(nodule_json)
         # show the center of the annotation
         for crop in []: # [False, True]:
+            import matplotlib.pyplot as plt
             color = 'r' if nodule_json['nodule_priority'] >= 3 else 'orange' if nodule_json['nodule_priority'] == 2 else 'green'
             level = 255 if nodule_json['nodule_priority'] >= 3 else 170 if nodule_json['nodule_priority'] == 2 else 85
             if crop:
@@ -205,6 +206,7 @@ def make_nodule(patient, nodule_annotations,
 
 def draw_ellipses_in_layers(nodule_annotations, new_mask_array_zyx, affected_layers, z_min_px, z_max_px, bound_box_offset_zyx_px, real_spacing_zyx, origin_zyx, thickness, nodule_priority_uint8, factor=1):
     """Draw into new_mask_array_zyx."""
+    import cv2
     if factor < 1:
         z_radius = factor * (z_max_px - z_min_px) / 2
         z_mean = (z_max_px + z_min_px) / 2
@@ -299,6 +301,7 @@ def get_bounding_box(array):
     return bbox
 
 def plot(mask, image):
+    import matplotlib.pyplot as plt
     plt.figure()
     plt.subplot(121)
     plt.imshow(image)
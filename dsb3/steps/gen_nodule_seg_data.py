@@ -8,7 +8,6 @@ import sys
 import numpy as np
 import pandas as pd
 import argparse
-import cv2
 import json
 from natsort import natsorted
 from tqdm import tqdm
@@ -40,8 +39,8 @@ def run(view_angles,
         raise ValueError('Wrong crop_size. Use format HeightxWidth')
         sys.exit()
 
-    gen_nodule_masks_json = pipe.load_json('out.json', 'gen_nodule_masks')
-    resample_lungs_json   = pipe.load_json('out.json', 'resample_lungs')
+    gen_nodule_masks_json = pipe.load_index('gen_nodule_masks')
+    resample_lungs_json   = pipe.load_index('resample_lungs')
 
     patients_lst = OrderedDict(pipe.patients_by_split)
     for lst_type in patients_lst.keys():
@@ -61,6 +60,26 @@ def run(view_angles,
                 view_planes,
                 num_negative_examples_per_nodule_free_patient_per_view_plane)
 
+class ScanMaskData:
+    """The normalized scan and the mask stacked along a last axis of length 3.
+
+    Behaves like the stacked uint8 array for slicing along the first three
+    axes, but only composes the requested region. With memory-mapped scan and
+    mask, only the corresponding pages are read.
+    """
+    def __init__(self, scan, mask, normalize):
+        self.scan = scan
+        self.mask = mask
+        self.normalize = normalize
+        self.shape = tuple(scan.shape) + (3,)
+
+    def __getitem__(self, key):
+        scan = self.scan[key]
+        data = np.zeros(list(scan.shape)+[3], dtype=np.uint8)
+        data[:, :, :, 0]   = self.normalize(scan)
+        data[:, :, :, 1:3] = self.mask[key]
+        return data
+
 def get_slice_from_zyx_array(array, slice_start, slice_end, axis):
     slice_start = max(0, slice_start)
     slice_end   = min(slice_end, array.shape[axis])
@@ -103,33 +122,32 @@ def generate_data_lsts(HU_tissue_range,
                 pipe.log.error('could not load gen_nodule_mask patient_json for patient {}!!!'.format(patient))
                 sys.exit()
             try:
-                scan = pipe.load_array(resample_lungs_json[patient]['basename'], 'resample_lungs')
+                scan = pipe.load_array(resample_lungs_json[patient]['basename'], 'resample_lungs', mmap=True)
             except:
                 pipe.log.error('could not load resample_lungs_array of patient {}. continue with next patient.'.format(patient))
                 continue
             try:
-                mask = pipe.load_array(gen_nodule_masks_json[patient]['basename'], 'gen_nodule_masks')
+                mask = pipe.load_array(gen_nodule_masks_json[patient]['basename'], 'gen_nodule_masks', mmap=True)
             except:
                 pipe.log.error('could not load mask-array of patient {}. Continue with next patient'.format(patient))
                 continue
 
             #normalize and zero_center scan and lab. Also checking dtyppe
             if scan.dtype == np.int16:
-                scan = ((scan/(float(HU_tissue_range[1]-HU_tissue_range[0])))*255).astype(np.uint8)
+                normalize = lambda scan: ((scan/(float(HU_tissue_range[1]-HU_tissue_range[0])))*255).astype(np.uint8)
             elif scan.dtype == np.float32:
-                scan = (scan*255).astype(np.uint8)
+                normalize = lambda scan: (scan*255).astype(np.uint8)
             elif scan.dtype == np.uint8:
-                scan = scan
+                normalize = lambda scan: scan
             else:
+                normalize = lambda scan: scan
                 pipe.log.error('dtype of scan for patient {} is NOT one of these [uint8, float32, int16]. Continue with next patient'.format(patient))
             if mask.dtype == np.uint8:
                 mask = mask
             else:
                 pipe.log.error('dtype of mask for patient {} is NOT uint8. Continue with next patient'.format(patient))
-            # combine scan and mask to data
-            data = np.zeros(list(scan.shape)+[3], dtype=np.uint8)
-            data[:, :, :, 0]   = scan
-            data[:, :, :, 1:3] = mask
+            # combine scan and mask to data, only for the regions that are cropped
+            data = ScanMaskData(scan, mask, normalize)
             # initialize some lists
             images_nodule_free = []
             nodules_extract_coords_lst = []
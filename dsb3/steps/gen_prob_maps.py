@@ -1,11 +1,18 @@
 import os, sys
 import numpy as np
 import json
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from .. import pipeline as pipe
 from .. import tf_tools
 
+# axes of z, y, x that give y, x, layers of the view plane
+view_plane_axes = {'x': (1, 0, 2), # -> y, z, x
+                   'y': (0, 2, 1), # -> z, x, y
+                   'z': (2, 1, 0)} # -> x, y, z
+
 def run(data_type,
         checkpoint_dir,
         batch_sizes,
@@ -13,145 +20,463 @@ def run(data_type,
         image_shape_max_ratio,
         view_planes,
         view_angles,
-        all_patients):
+        all_patients,
+        tile_shape_yx=None,
+        tile_overlap_px=64,
+        tile_blending='gaussian',
+        tile_batch_size=16,
+        rotate_volume=False,
+        prefetch=True):
     """
     Parameters
     ----------
     data_type : {unit8, int16, float32}
         Data type of prob maps.
+    tile_shape_yx : list of int, optional
+        Predict all scans with one net of this shape in overlapping tiles
+        instead of with the smallest net of `image_shapes` that fits the
+        scan; `image_shapes`, `batch_sizes` and `image_shape_max_ratio` are
+        then not used. view_angles other than 0 need `rotate_volume`,
+        as tiles rotated about their own centers miss the corners.
+    tile_overlap_px : int
+        Overlap of neighbouring tiles.
+    tile_blending : {'gaussian', 'linear'}
+        Weights of the tiles when stitching, see `get_tile_weights`.
+    tile_batch_size : int
+        Tiles per batch.
+    rotate_volume : bool
+        For view_angles other than 0, rotate the layers of a view plane once
+        per angle in float32 and its prediction back once, instead of each
+        batch and its prediction through uint8.
+    prefetch : bool
+        Load the scan of the next patient and fill the next batch in threads
+        while the net predicts, and write back predictions in another one.
     """
+    if tile_shape_yx is not None:
+        run_tiled(data_type, checkpoint_dir, tile_shape_yx, tile_overlap_px, tile_blending, tile_batch_size,
+                  view_planes, view_angles, all_patients, rotate_volume, prefetch)
+        return
     # check if enought batch_sizes given for image_shapes
     if len(image_shapes) != len(batch_sizes):
         raise ValueError('Need same number of batch_sizes and image_shapes for nodule_seg.')
-    if len(view_planes) == 0 or len([c for c in view_planes if c not in ['x', 'y', 'z']]) > 0:
-        raise ValueError('view_planes ' + str(view_planes) + 'must only contain x, y, z chars.')
-    resample_lungs_json = pipe.load_json('out.json', 'resample_lungs')
-    if isinstance(resample_lungs_json, FileNotFoundError):
-        raise FileNotFoundError(str(resample_lungs_json) + '\n--> Run step "resample_lungs" first.')
+    check_view_planes(view_planes)
+    resample_lungs_json = load_resample_lungs_index()
     HU_tissue_range = pipe.load_json('params.json', 'resample_lungs')['HU_tissue_range']
     # sort nets in ascending size y * x
     image_shapes = sorted(image_shapes, key=lambda shape: shape[0]*shape[1])
-    # split patients by scan_shape for the nodule_segmentation_nets with distinct image_shapes -> save computing time
-    patients_per_net = [[] for n in range(len(image_shapes))]
-    registered_patients = set()
     considered_patients = pipe.patients if all_patients else pipe.patients_by_split['va']
+    # nodule_segmentation_nets with distinct image_shapes -> save computing time,
+    # each is loaded for the first patient whose scan fits into it
+    nets = OrderedDict()
+    net_nums = OrderedDict() # patient -> net
+    buffers = {} # batch and embedded layers, reused for all patients
+    def predict(img_array, patient):
+        if patient not in net_nums:
+            net_nums[patient] = get_net_num(resample_lungs_json[patient], image_shapes, image_shape_max_ratio)
+        net_num = net_nums[patient]
+        if net_num not in nets:
+            net_shape = list(image_shapes[net_num])
+            config = json.load(open(checkpoint_dir + '/config.json'))
+            image_shape = net_shape + [config['image_shape'][2]]
+            pipe.log.info('loading net {} with x-y image shape {}'.format(net_num, net_shape))
+            nets[net_num] = (tf_tools.load_network(checkpoint_dir, image_shape=image_shape, reuse=True if nets else None),
+                             image_shape)
+        tf_net, image_shape = nets[net_num]
+        return predict_view(tf_net, img_array, image_shape, batch_sizes[net_num], view_angles,
+                            patient, buffers, rotate_volume, prefetch)
+    predict_patients(considered_patients, resample_lungs_json, HU_tissue_range, data_type, view_planes, predict, prefetch)
+    pipe.log.info('patients distribution on nets: ' + str([list(net_nums.values()).count(n) for n in range(len(image_shapes))]))
+    for tf_net, image_shape in nets.values():
+        tf_net[0].close()
+
+def get_net_num(patient_json, image_shapes, image_shape_max_ratio):
+    """Index of the smallest of the sorted image_shapes that the scan fits into."""
+    scan_shape_z = patient_json['resampled_scan_shape_zyx_px'][0]
+    bound_box_coords_yx_px = patient_json['bound_box_coords_yx_px']
+    scan_shape_yx = [bound_box_coords_yx_px[1] + 1 - bound_box_coords_yx_px[0],
+                     bound_box_coords_yx_px[3] + 1 - bound_box_coords_yx_px[2]]
+    scan_shape = [scan_shape_z] + scan_shape_yx
     for net_num, net_shape in enumerate(image_shapes):
         net_shape = [net_shape[0] for i in range(3)] # need three dimensions
-        ratio = 1 if net_num == len(image_shapes) - 1 else image_shape_max_ratio # for avoiding border effects net due to padding, ...        
-        for patient in considered_patients:
-            if patient in registered_patients:
-                continue
-            scan_shape_z = resample_lungs_json[patient]['resampled_scan_shape_zyx_px'][0]
-            bound_box_coords_yx_px = resample_lungs_json[patient]['bound_box_coords_yx_px']
-            scan_shape_yx = [bound_box_coords_yx_px[1] + 1 - bound_box_coords_yx_px[0], 
-                             bound_box_coords_yx_px[3] + 1 - bound_box_coords_yx_px[2]]
-            scan_shape = [scan_shape_z] + scan_shape_yx
-            # does the scan fit into the shrinked net? it needs to fit in all three directions if we use all planes
-            if np.all(np.array(scan_shape) < ratio * np.array(net_shape)):
-                patients_per_net[net_num].append(patient)
-                registered_patients.add(patient)
-    if len(registered_patients) != len(considered_patients):
-        raise ValueError('Registering patients for different nets is inconsistent.')
-    pipe.log.info('patients distribution on nets: ' + str([len(l) for l in patients_per_net]))
-    reuse_init = True
-    # loop over nodule_segmentation_nets with distinct image_shapes
-    for net_num, net_shape in enumerate(image_shapes):
-        if len(patients_per_net[net_num]) == 0:
-            continue
-        reuse = None if reuse_init else True
-        reuse_init = False
-        batch_size = batch_sizes[net_num]
-        config = json.load(open(checkpoint_dir + '/config.json'))
-        image_shape = net_shape + [config['image_shape'][2]]
-        label_shape = net_shape + [config['label_shape'][2]]
-        prediction = np.zeros([batch_size] + list(label_shape), dtype=np.float32)
-        prediction_rot = np.zeros_like(prediction)
-        sess, pred_ops, data = tf_tools.load_network(checkpoint_dir, image_shape=image_shape, reuse=reuse)
-        pipe.log.info('predicting ' + str(len(patients_per_net[net_num])) 
-                      + ' patients with net {} with x-y image shape {}'.format(net_num, net_shape))
-        # loop over patients in nets list
-        patients_json = OrderedDict()
-        for patient in tqdm(patients_per_net[net_num]):
-            org_img_array = pipe.load_array(resample_lungs_json[patient]['basename'], step_name='resample_lungs') # z, y, x
-            prob_map = np.zeros_like(org_img_array, dtype=np.float32)
-            for view_plane_cnt, view_plane in enumerate(view_planes):
-                if view_plane_cnt > 0: # reload
-                    org_img_array = pipe.load_array(resample_lungs_json[patient]['basename'], step_name='resample_lungs') # z, y, x
-                if org_img_array.dtype == np.int16: # [0, 1400] -> [-0.25, 0.75] normalized and zero_centered
-                    org_img_array = (org_img_array/(HU_tissue_range[1] - HU_tissue_range[0]) - 0.25).astype(np.float32)
-                if view_plane == 'x': # move z axis to position 1
-                    org_img_array = np.rollaxis(org_img_array, 0, 2) # z, y, x -> x, z, y
-                elif view_plane == 'y':
-                    org_img_array = np.swapaxes(org_img_array, 1, 2) # -> z, x, y
-                elif view_plane == 'z':
-                    org_img_array = np.swapaxes(org_img_array, 2, 0) # -> x, y, z
-                # for example, if view_plane == 'z', then the 'z' dimension becomes the third dimension in img_array
-                #              and the convolution is performed in the first two dimensions, here the y-x dimensions
-                img_array = (-0.25) * np.ones((image_shape[0], image_shape[1], org_img_array.shape[2]), dtype=np.float32) # 'black' array
-                # embed img in xy center in image_shape
-                offset_y = int((img_array.shape[0] - org_img_array.shape[0])/2)
-                offset_x = int((img_array.shape[1] - org_img_array.shape[1])/2)
-                img_array[offset_y : offset_y + org_img_array.shape[0],
-                          offset_x : offset_x + org_img_array.shape[1], :] = org_img_array
-                num_batches = int(np.ceil(img_array.shape[2] / batch_size))
-                batch = (-0.25) * np.ones(([batch_size] + image_shape), dtype=np.float32)
-                batch_rot = batch.copy()
-                for batch_cnt in range(num_batches):
-                    batch[:] = batch_rot[:] = -0.25 # reset to black
-                    prediction[:] = prediction_rot[:] = 0 # reset to 0
-                    for cnt in range(batch_size): # fill batch
-                        layer_cnt = batch_cnt * batch_size + cnt
-                        if layer_cnt >= img_array.shape[2]:
-                            break
-                        # leave some channels above empty at top and below at bottom
-                        min_z = max(0, int(layer_cnt - (image_shape[2] - 1) / 2))
-                        max_z = min(int(layer_cnt + (image_shape[2] - 1) / 2) + 1, img_array.shape[2])
-                        batch_idx_z = [image_shape[2] - max(0, max_z - min_z), image_shape[2] - min(0, max_z - min_z)]
-                        batch[cnt, :, :, batch_idx_z[0]:batch_idx_z[1]] = img_array[:, :, min_z:max_z]
-                    for view_angle in view_angles:
-                        if view_angle != 0:
-                            M = cv2.getRotationMatrix2D((batch.shape[2]//2, batch.shape[1]//2), view_angle, 1)
-                            for img_cnt in range(batch.shape[0]):
-                                batch_rot[img_cnt] = rotate_3d(((batch[img_cnt].copy() + 0.25) * 255).astype(np.uint8), M, 2)/255 - 0.25
-                        else:
-                            batch_rot = batch.copy()
-                        # get probability for nodules and reshape flat prediction to batchsize, z, x, 1
-                        prediction_rot = np.reshape(sess.run(pred_ops, feed_dict = {data['images']: batch_rot})['probs'], prediction.shape)
-                        # below, np.clip is called, shouldn't the prediction stay above zero and below one?
-                        if np.max(prediction_rot) > 1 or np.min(prediction_rot) < 0:
-                            pipe.log.warning('prediction not within [0, 1] for patient ' + patient)
-                        # rotate back prediction
-                        if view_angle != 0:
-                            M_back = cv2.getRotationMatrix2D((prediction_rot.shape[2]//2, prediction_rot.shape[1]//2), -view_angle, 1)
-                            for img_cnt in range(batch.shape[0]):
-                                prediction_rot[img_cnt] = np.clip(rotate_3d((prediction_rot[img_cnt] * 255).astype(np.uint8), M_back, 2) / 255, 0, 1)
-                        # mean over view_angles
-                        prediction += prediction_rot / len(view_angles)
-                    # crop from embedded layers
-                    prediction_embed = prediction[:, offset_y : offset_y + org_img_array.shape[0],
-                                                     offset_x : offset_x + org_img_array.shape[1]] / len(view_planes)
-                    layer_start = batch_size * batch_cnt
-                    layer_end = min(img_array.shape[2], batch_size + layer_start)
-                    # TODO: is the following correct?
-                    if view_plane == 'x':
-                        prob_map[:, :, layer_start:layer_end] += np.swapaxes(prediction_embed[:layer_end-layer_start, :, :, 0], 0, 2)
-                    elif view_plane == 'y':
-                        prob_map[:, layer_start:layer_end, :] += np.swapaxes(prediction_embed[:layer_end-layer_start, :, :, 0], 0, 1)
-                    elif view_plane == 'z':
-                        prob_map[layer_start:layer_end, :, :] +=  np.swapaxes(prediction_embed[:layer_end-layer_start, :, :, 0], 1, 2)
-            if np.min(prob_map) < 0 or np.max(prob_map) > 1:
-                 pipe.log.warning('nodule seg prob_map not in value range [0, 1] for patient ' + patient)
-            if data_type == 'uint8':
-                prob_map = (prob_map * 255).astype(np.uint8)
-            elif data_type == 'uint16':
-                prob_map = (prob_map * 65535).astype(np.uint16)
-            patients_json[patient] = OrderedDict()
-            patients_json[patient]['basename'] = basename = patient + '_prob_map.npy'
-            patients_json[patient]['pathname'] = pipe.save_array(basename, prob_map)
-        pipe.save_json('out.json', patients_json, mode='w' if reuse is None else 'a') # open in 'w' mode when something is written for the first time
-        sess.close()
+        ratio = 1 if net_num == len(image_shapes) - 1 else image_shape_max_ratio # for avoiding border effects net due to padding, ...
+        # does the scan fit into the shrinked net? it needs to fit in all three directions if we use all planes
+        if np.all(np.array(scan_shape) < ratio * np.array(net_shape)):
+            return net_num
+    raise ValueError('Scan of shape ' + str(scan_shape) + ' does not fit into any of the nets.')
+
+def run_tiled(data_type, checkpoint_dir, tile_shape_yx, tile_overlap_px, tile_blending, tile_batch_size,
+              view_planes, view_angles, all_patients, rotate_volume, prefetch):
+    if tile_blending not in ['gaussian', 'linear']:
+        raise ValueError('Invalid tile_blending. Use gaussian or linear.')
+    if not 0 <= tile_overlap_px < min(tile_shape_yx):
+        raise ValueError('tile_overlap_px needs to be smaller than the tiles.')
+    if not rotate_volume and any(view_angle != 0 for view_angle in view_angles):
+        raise ValueError('view_angles other than 0 need rotate_volume with tile_shape_yx.')
+    check_view_planes(view_planes)
+    resample_lungs_json = load_resample_lungs_index()
+    HU_tissue_range = pipe.load_json('params.json', 'resample_lungs')['HU_tissue_range']
+    considered_patients = pipe.patients if all_patients else pipe.patients_by_split['va']
+    config = json.load(open(checkpoint_dir + '/config.json'))
+    image_shape = list(tile_shape_yx) + [config['image_shape'][2]]
+    tf_net = tf_tools.load_network(checkpoint_dir, image_shape=image_shape)
+    weights = get_tile_weights(tile_shape_yx, tile_overlap_px, tile_blending)
+    buffers = {} # batch and embedded layers, reused for all patients
+    pipe.log.info('predicting ' + str(len(considered_patients)) + ' patients in tiles of x-y shape ' + str(tile_shape_yx))
+    predict_patients(considered_patients, resample_lungs_json, HU_tissue_range, data_type, view_planes,
+                     lambda img_array, patient: predict_view_tiled(tf_net, img_array, image_shape, tile_batch_size,
+                                                                   view_angles, patient, tile_overlap_px, weights, buffers,
+                                                                   rotate_volume, prefetch),
+                     prefetch)
+    tf_net[0].close()
+
+def check_view_planes(view_planes):
+    if len(view_planes) == 0 or len([c for c in view_planes if c not in ['x', 'y', 'z']]) > 0:
+        raise ValueError('view_planes ' + str(view_planes) + 'must only contain x, y, z chars.')
+
+def load_resample_lungs_index():
+    resample_lungs_json = pipe.load_index('resample_lungs')
+    if isinstance(resample_lungs_json, FileNotFoundError):
+        raise FileNotFoundError(str(resample_lungs_json) + '\n--> Run step "resample_lungs" first.')
+    return resample_lungs_json
+
+def normalize(img_array, HU_tissue_range):
+    """float32 img_array / (HU_tissue_range[1] - HU_tissue_range[0]) - 0.25 of
+    an int16 img_array, in one pass through a table of all int16 values."""
+    values = np.arange(2**16, dtype=np.uint16).view(np.int16)
+    table = (values/(HU_tissue_range[1] - HU_tissue_range[0]) - 0.25).astype(np.float32)
+    return np.take(table, img_array.view(np.uint16))
+
+def predict_patients(patients, resample_lungs_json, HU_tissue_range, data_type, view_planes, predict, prefetch):
+    """`predict_patient` for each of the patients, see `pipe.iter_patients`.
+
+    With prefetch, the next patient is taken and its scan loaded in a thread
+    while the current one is predicted, its load is recorded as overlapped
+    and the wait for it as 'wait_load'.
+    """
+    start_time = time.time()
+    patients_iter = pipe.iter_patients(patients)
+    def load_next():
+        patient = next(patients_iter, None)
+        if patient is None:
+            return None, None
+        return patient, load_scan(patient, resample_lungs_json[patient], HU_tissue_range, overlapped=prefetch)
+    n_predicted = 0
+    with ThreadPoolExecutor(1) as load_pool, tqdm(total=len(patients)) as progress:
+        loaded = load_pool.submit(load_next) if prefetch else None
+        while True:
+            if loaded is None:
+                patient, img_array = load_next()
+            else:
+                shares = {} # the patient is known once loaded, the record is written at the end of the phase
+                with pipe.timing('wait_load', shares):
+                    patient, img_array = loaded.result()
+                    if patient is not None:
+                        shares[patient] = 1
+                if patient is not None:
+                    loaded = load_pool.submit(load_next)
+            if patient is None:
+                break
+            predict_patient(patient, img_array, data_type, view_planes, predict)
+            n_predicted += 1
+            progress.update()
+    if n_predicted:
+        pipe.log.info('predicted {} patients in {:.0f} s, {:.1f} s per patient'.format(
+            n_predicted, time.time() - start_time, (time.time() - start_time) / n_predicted))
+
+def load_scan(patient, patient_json, HU_tissue_range, overlapped=False):
+    """Resampled scan of patient in z, y, x, normalized to float32."""
+    with pipe.timing('load', patient, overlapped):
+        img_array = pipe.load_array(patient_json['basename'], step_name='resample_lungs') # z, y, x
+        if img_array.dtype == np.int16: # [0, 1400] -> [-0.25, 0.75] normalized and zero_centered
+            img_array = normalize(img_array, HU_tissue_range)
+    return img_array
+
+def predict_patient(patient, img_array, data_type, view_planes, predict):
+    """Sum the predictions of the view planes of img_array and save the prob map.
+
+    `predict(img_array, patient)` maps an array of shape (y, x, layers) of
+    the view plane to the prediction of shape (layers, y, x).
+    """
+    prob_map = np.zeros(img_array.shape, dtype=np.float32)
+    with pipe.timing('inference', patient):
+        for view_plane in view_planes:
+            # for example, if view_plane == 'z', then the 'z' dimension becomes the third dimension in img_array
+            #              and the convolution is performed in the first two dimensions, here the y-x dimensions
+            axes = view_plane_axes[view_plane]
+            prediction = predict(img_array.transpose(axes), patient)
+            prediction /= len(view_planes)
+            # add in place to prob_map transposed to layers, y, x of the view plane
+            prob_map_view = prob_map.transpose(axes[2], axes[0], axes[1])
+            prob_map_view += prediction
+    if np.min(prob_map) < 0 or np.max(prob_map) > 1:
+         pipe.log.warning('nodule seg prob_map not in value range [0, 1] for patient ' + patient)
+    if data_type == 'uint8':
+        prob_map = (prob_map * 255).astype(np.uint8)
+    elif data_type == 'uint16':
+        prob_map = (prob_map * 65535).astype(np.uint16)
+    patient_json = OrderedDict()
+    patient_json['basename'] = basename = patient + '_prob_map.npy'
+    with pipe.timing('save', patient):
+        patient_json['pathname'] = pipe.save_array(basename, prob_map)
+    pipe.append_journal(patient, patient_json)
+
+def predict_view(tf_net, org_img_array, image_shape, batch_size, view_angles, patient, buffers=None,
+                 rotate_volume=False, prefetch=False):
+    """Prediction of shape (layers, y, x) for an array of shape (y, x, layers)
+    embedded in the xy center of a net of `image_shape`."""
+    buffers = {} if buffers is None else buffers
+    # embed img in xy center in image_shape
+    img_layers, offset_y, offset_x = embed_layers(org_img_array, image_shape[:2], buffers)
+    predict_layers = lambda layers, angles: predict_embedded(tf_net, layers, image_shape, batch_size, angles, patient, buffers,
+                                                             prefetch)
+    prediction_view = predict_angles(predict_layers, img_layers, view_angles, rotate_volume, buffers)
+    # crop from embedded layers
+    return prediction_view[:, offset_y : offset_y + org_img_array.shape[0], offset_x : offset_x + org_img_array.shape[1]]
+
+def predict_view_tiled(tf_net, org_img_array, image_shape, batch_size, view_angles, patient, overlap, weights,
+                       buffers=None, rotate_volume=False, prefetch=False):
+    """Prediction of shape (layers, y, x) for an array of shape (y, x, layers)
+    from overlapping tiles of `image_shape`, blended with `weights`.
+
+    As in `predict_view`, the array is embedded in black, with a margin of
+    at least half the overlap.
+    """
+    buffers = {} if buffers is None else buffers
+    shape_yx = [max(n + overlap, n_tile) for n, n_tile in zip(org_img_array.shape[:2], image_shape[:2])]
+    img_layers, offset_y, offset_x = embed_layers(org_img_array, shape_yx, buffers)
+    predict_layers = lambda layers, angles: predict_tiles(tf_net, layers, image_shape, batch_size, angles, patient,
+                                                          overlap, weights, buffers, prefetch)
+    prediction_view = predict_angles(predict_layers, img_layers, view_angles, rotate_volume, buffers)
+    return prediction_view[:, offset_y : offset_y + org_img_array.shape[0], offset_x : offset_x + org_img_array.shape[1]]
+
+def predict_angles(predict_layers, img_layers, view_angles, rotate_volume, buffers):
+    """Mean prediction of shape (layers, y, x) over the view_angles for
+    img_layers of `embed_layers`.
+
+    `predict_layers(layers, angles)` rotates each batch by the angles. With
+    `rotate_volume`, img_layers are rotated as a whole per angle instead, in
+    float32 and about their center, and the prediction is rotated back once.
+    """
+    if not rotate_volume:
+        return predict_layers(img_layers, view_angles)
+    prediction = np.zeros((img_layers.shape[0] - 1,) + img_layers.shape[1:], dtype=np.float32)
+    for view_angle in view_angles:
+        if view_angle == 0:
+            prediction_rot = predict_layers(img_layers, [0])
+        else:
+            img_layers_rot = rotate_layers(img_layers, view_angle, -0.25, get_buffer(buffers, 'img_layers_rot', img_layers.shape))
+            prediction_rot = rotate_layers(predict_layers(img_layers_rot, [0]), -view_angle, 0,
+                                           get_buffer(buffers, 'prediction_rot', prediction.shape))
+            np.clip(prediction_rot, 0, 1, out=prediction_rot)
+        prediction_rot /= len(view_angles)
+        prediction += prediction_rot
+    return prediction
+
+def rotate_layers(layers, angle, border_value, out):
+    """Rotate each of layers (layers, y, x) by angle in degrees about the
+    center into out, with cubic interpolation."""
+    import cv2
+    M = cv2.getRotationMatrix2D((layers.shape[2]//2, layers.shape[1]//2), angle, 1)
+    # cubic warps take at most 4 channels, so one warp per layer
+    for layer, layer_out in zip(layers, out):
+        cv2.warpAffine(layer, M, (layers.shape[2], layers.shape[1]), dst=layer_out, flags=cv2.INTER_CUBIC,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+    return out
+
+def predict_embedded(tf_net, img_layers, image_shape, batch_size, view_angles, patient, buffers, prefetch=False):
+    """Prediction of shape (layers, y, x) for img_layers of the shape of the net."""
+    n_layers = img_layers.shape[0] - 1
+    channel_indices = get_channel_indices(n_layers, image_shape[2])
+    prediction_view = np.zeros((n_layers,) + img_layers.shape[1:], dtype=np.float32)
+    def fill(batch, batch_cnt):
+        layer_start = batch_size * batch_cnt
+        layer_end = min(n_layers, batch_size + layer_start)
+        fill_batch(batch, img_layers, channel_indices[layer_start:layer_end])
+        batch[layer_end - layer_start:] = -0.25
+    def write(prediction, batch_cnt):
+        layer_start = batch_size * batch_cnt
+        layer_end = min(n_layers, batch_size + layer_start)
+        prediction_view[layer_start:layer_end] = prediction[:layer_end-layer_start]
+    run_batches(tf_net, int(np.ceil(n_layers / batch_size)), fill, write, [batch_size] + image_shape,
+                view_angles, patient, buffers, prefetch)
+    return prediction_view
+
+def predict_tiles(tf_net, img_layers, image_shape, batch_size, view_angles, patient, overlap, weights, buffers,
+                  prefetch=False):
+    """Prediction of shape (layers, y, x) for img_layers from overlapping tiles."""
+    n_layers = img_layers.shape[0] - 1
+    shape_yx = list(img_layers.shape[1:])
+    channel_indices = get_channel_indices(n_layers, image_shape[2])
+    starts_y, starts_x = [get_tile_starts(n, n_tile, overlap) for n, n_tile in zip(shape_yx, image_shape[:2])]
+    weight_sum = np.zeros(shape_yx, dtype=np.float32)
+    for y in starts_y:
+        for x in starts_x:
+            weight_sum[y : y + image_shape[0], x : x + image_shape[1]] += weights
+    # consecutive layers of a tile position can be filled at once
+    tiles = [(y, x, layer_cnt) for y in starts_y for x in starts_x for layer_cnt in range(n_layers)]
+    prediction_view = np.zeros([n_layers] + shape_yx, dtype=np.float32)
+    def fill(batch, batch_cnt):
+        cnt = 0
+        for y, x, layer_start, layer_end in get_tile_runs(tiles[batch_size * batch_cnt : batch_size * (batch_cnt + 1)]):
+            fill_batch(batch[cnt : cnt + layer_end - layer_start], img_layers[:, y : y + image_shape[0], x : x + image_shape[1]],
+                       channel_indices[layer_start:layer_end])
+            cnt += layer_end - layer_start
+        batch[cnt:] = -0.25
+    def write(prediction, batch_cnt):
+        for cnt, (y, x, layer_cnt) in enumerate(tiles[batch_size * batch_cnt : batch_size * (batch_cnt + 1)]):
+            prediction_view[layer_cnt, y : y + image_shape[0], x : x + image_shape[1]] += prediction[cnt] * weights
+    run_batches(tf_net, int(np.ceil(len(tiles) / batch_size)), fill, write, [batch_size] + image_shape,
+                view_angles, patient, buffers, prefetch)
+    prediction_view /= weight_sum
+    return prediction_view
+
+def run_batches(tf_net, n_batches, fill, write, batch_shape, view_angles, patient, buffers, prefetch):
+    """Predict n_batches filled by `fill(batch, batch_cnt)` and pass the mean
+    prediction over the view_angles to `write(prediction, batch_cnt)`.
+
+    With prefetch, one thread fills and rotates the next batch into the
+    other of two buffers and another one rotates back and writes the
+    predictions, while sess.run predicts the current batch.
+    """
+    sess, pred_ops, data = tf_net
+    def prepare(batch_cnt):
+        batch = get_buffer(buffers, 'batch' + str(batch_cnt % 2), batch_shape)
+        fill(batch, batch_cnt)
+        return rotate_batch(batch, view_angles)
+    def predict(batches_rot):
+        return [sess.run(pred_ops, feed_dict = {data['images']: batch_rot})['probs'] for batch_rot in batches_rot]
+    def finish(probs, batch_cnt):
+        write(mean_prediction(probs, batch_shape, view_angles, patient), batch_cnt)
+    if not prefetch:
+        for batch_cnt in range(n_batches):
+            finish(predict(prepare(batch_cnt)), batch_cnt)
+        return
+    with ThreadPoolExecutor(1) as prepare_pool, ThreadPoolExecutor(1) as write_pool:
+        prepared = prepare_pool.submit(prepare, 0) if n_batches > 0 else None
+        written = []
+        for batch_cnt in range(n_batches):
+            batches_rot = prepared.result()
+            # into the other buffer, whose batch is predicted already
+            if batch_cnt + 1 < n_batches:
+                prepared = prepare_pool.submit(prepare, batch_cnt + 1)
+            probs = predict(batches_rot)
+            if batch_cnt >= 2: # at most two predictions wait to be written
+                written[batch_cnt - 2].result()
+            written.append(write_pool.submit(finish, probs, batch_cnt))
+        for future in written:
+            future.result()
+
+def get_tile_runs(tiles):
+    """Runs of (y, x, layer_start, layer_end) of consecutive layers at a tile position."""
+    runs = []
+    for y, x, layer_cnt in tiles:
+        if runs and runs[-1][:2] == (y, x) and runs[-1][3] == layer_cnt:
+            runs[-1] = (y, x, runs[-1][2], layer_cnt + 1)
+        else:
+            runs.append((y, x, layer_cnt, layer_cnt + 1))
+    return runs
+
+def get_tile_starts(n, n_tile, overlap):
+    """Starts of tiles covering n pixels, the last one ends at n."""
+    starts = list(range(0, n - n_tile, n_tile - overlap))
+    return starts + [n - n_tile]
+
+def get_tile_weights(tile_shape_yx, overlap, blending):
+    """Weights of the pixels of a tile when stitching.
+
+    'gaussian' falls off from the center with a sigma of 1/8 of the tile,
+    'linear' ramps up over the overlap at each border. Both stay above zero,
+    so that the borders of the scan are covered.
+    """
+    weights_yx = []
+    for n in tile_shape_yx:
+        i = np.arange(n, dtype=np.float32)
+        if blending == 'gaussian':
+            w = np.exp(-0.5 * ((i - (n - 1) / 2) / (n / 8))**2)
+        else:
+            w = np.minimum(1, np.minimum(i + 1, n - i) / (overlap + 1))
+        weights_yx.append(np.maximum(w, 1e-3))
+    return np.outer(*weights_yx).astype(np.float32)
+
+def get_buffer(buffers, name, shape):
+    """float32 array of shape in the memory of buffers[name], which grows as needed."""
+    size = int(np.prod(shape))
+    if name not in buffers or buffers[name].size < size:
+        buffers[name] = np.empty(size, dtype=np.float32)
+    return buffers[name][:size].reshape(shape)
+
+def embed_layers(org_img_array, shape_yx, buffers):
+    """Layers of org_img_array (y, x, layers) in the center of black layers of
+    shape_yx, followed by one black layer, and the offsets of the center."""
+    n_layers, n_y, n_x = org_img_array.shape[2], org_img_array.shape[0], org_img_array.shape[1]
+    img_layers = get_buffer(buffers, 'img_layers', [n_layers + 1] + list(shape_yx))
+    offset_y = int((shape_yx[0] - n_y)/2)
+    offset_x = int((shape_yx[1] - n_x)/2)
+    # only the margins are set to black, the center is overwritten
+    img_layers[:, :offset_y] = img_layers[:, offset_y + n_y:] = -0.25
+    img_layers[:, :, :offset_x] = img_layers[:, :, offset_x + n_x:] = -0.25
+    img_layers[n_layers] = -0.25
+    img_layers[:n_layers, offset_y : offset_y + n_y, offset_x : offset_x + n_x] = np.moveaxis(org_img_array, 2, 0)
+    return img_layers, offset_y, offset_x
+
+def get_channel_indices(n_layers, n_channels):
+    """Layer of the input of each layer (rows) and channel (columns) of the
+    batch, n_layers for the black layer.
+
+    The layers around a layer are put into the last channels, so some
+    channels stay black at the top and the bottom.
+    """
+    layer_cnt = np.arange(n_layers)[:, None]
+    min_z = np.maximum(0, np.trunc(layer_cnt - (n_channels - 1) / 2)).astype(np.int64)
+    max_z = np.minimum(np.trunc(layer_cnt + (n_channels - 1) / 2).astype(np.int64) + 1, n_layers)
+    first_channel = n_channels - (max_z - min_z)
+    channel = np.arange(n_channels)[None, :]
+    return np.where(channel >= first_channel, min_z + channel - first_channel, n_layers)
+
+def fill_batch(batch, img_layers, channel_indices):
+    """Put the layers of img_layers given by channel_indices into the first
+    images of batch, one gather per channel."""
+    n = channel_indices.shape[0]
+    for channel in range(channel_indices.shape[1]):
+        batch[:n, :, :, channel] = img_layers[channel_indices[:, channel]]
+
+def rotate_batch(batch, view_angles):
+    """The batch rotated by each of the view_angles, through uint8."""
+    batches_rot = []
+    for view_angle in view_angles:
+        if view_angle != 0:
+            import cv2
+            M = cv2.getRotationMatrix2D((batch.shape[2]//2, batch.shape[1]//2), view_angle, 1)
+            batch_rot = np.empty_like(batch)
+            for img_cnt in range(batch.shape[0]):
+                batch_rot[img_cnt] = rotate_3d(((batch[img_cnt].copy() + 0.25) * 255).astype(np.uint8), M, 2)/255 - 0.25
+        else:
+            batch_rot = batch
+        batches_rot.append(batch_rot)
+    return batches_rot
+
+def mean_prediction(probs, batch_shape, view_angles, patient):
+    """Mean prediction of shape (batch_size, y, x) over the probs of the
+    batches of `rotate_batch`, rotated back."""
+    prediction = np.zeros(batch_shape[:3], dtype=np.float32)
+    for view_angle, probs_rot in zip(view_angles, probs):
+        # get probability for nodules and reshape flat prediction to batchsize, y, x
+        prediction_rot = np.reshape(probs_rot, tuple(batch_shape[:3]) + (-1,))[:, :, :, 0]
+        # below, np.clip is called, shouldn't the prediction stay above zero and below one?
+        if np.max(prediction_rot) > 1 or np.min(prediction_rot) < 0:
+            pipe.log.warning('prediction not within [0, 1] for patient ' + patient)
+        # rotate back prediction
+        if view_angle != 0:
+            import cv2
+            M_back = cv2.getRotationMatrix2D((prediction_rot.shape[2]//2, prediction_rot.shape[1]//2), -view_angle, 1)
+            for img_cnt in range(prediction_rot.shape[0]):
+                prediction_rot[img_cnt] = np.clip(rotate_3d((prediction_rot[img_cnt, :, :, None] * 255).astype(np.uint8), M_back, 2)[:, :, 0] / 255, 0, 1)
+        # mean over view_angles
+        prediction += prediction_rot / len(view_angles)
+    return prediction
 
 def rotate(in_tensor, M):
+    import cv2
     dst = cv2.warpAffine(in_tensor, M, (in_tensor.shape[1], in_tensor.shape[0]), 
                          flags=cv2.INTER_CUBIC)
     if len(dst) == 2:
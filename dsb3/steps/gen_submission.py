@@ -3,7 +3,6 @@ import numpy as np
 import pandas as pd
 import os
 from datetime import datetime
-import tensorflow as tf
 import json
 import glob
 import json
@@ -11,8 +10,6 @@ from collections import OrderedDict
 from .. import pipeline as pipe
 from .. import utils
 from .. import tf_tools
-
-import matplotlib.pyplot as plt
 from tqdm import tqdm 
 
 np.random.seed(17) # do NOT change
@@ -132,6 +129,7 @@ def run(splitting,
         sample_submission.to_csv(submission_path, index=False)
 
     elif splitting == 'validation':
+        import matplotlib.pyplot as plt
         labels = np.array(labels,dtype=np.float32)
         print('patients_predictions[:, 0].shape', patients_predictions[:, 0].shape)
         print('patients_losses[:, 0].shape', patients_losses[:, 0].shape)
@@ -1,10 +1,7 @@
 import numpy as np
 import json
 from collections import OrderedDict
-from scipy.spatial import distance
 from numpy.linalg import eigh
-from matplotlib import pyplot as plt
-import sklearn.metrics
 import xgboost as xgb
 from .. import pipeline as pipe
 import numpy.random as random
@@ -5,12 +5,10 @@ import os
 import sys
 import numpy as np
 import pandas as pd
-import cv2
 import json
 from tqdm import tqdm
 from collections import OrderedDict
 from joblib import Parallel, delayed
-from matplotlib import pyplot as plt
 from . import resample_lungs
 from .. import pipeline as pipe
 from .. import utils
@@ -35,57 +33,68 @@ def run(n_candidates,
     avail_data_types = ['uint8', 'int16', 'float32']
     if new_data_type not in avail_data_types:
         raise ValueError('Wrong data type, choose one of ' + str(avail_data_types))
-    gen_candidates_json = pipe.load_json('out.json', 'gen_candidates')
-    resample_lungs_json = pipe.load_json('out.json', 'resample_lungs')
-    input_lst = pd.read_csv(pipe.get_step_dir('gen_candidates') + 'patients.lst', sep = '\t', header=None)
-    img_lsts_dict = OrderedDict()
-    img_candidates_lsts_dict = OrderedDict()
-    for split_name, split in pipe.patients_by_split.items():
-        img_lsts_dict[split_name] = input_lst[input_lst[0].isin(split)]
-        img_lsts_dict[split_name].reset_index(drop=True, inplace=True)
-    # if pipe.dataset_name == 'LUNA16':
-    if 1:
-        input_lst_candidates = pd.read_csv(pipe.get_step_dir('gen_candidates') + 'candidates.lst', sep = '\t', header=None)
+    gen_candidates_json = pipe.load_index('gen_candidates')
+    resample_lungs_json = pipe.load_index('resample_lungs')
+    # ensure output files are overwritten, only keep patients completed before resuming the step
+    for lst_type in pipe.patients_by_split:
+        write_lsts_from_journal(lst_type, pipe.load_journal())
+    # a single chunk unless the step is streamed, the lists of gen_candidates then grow with each chunk
+    for patients_chunk in pipe.iter_patient_chunks(pipe.patients, pipe.n_CPUs):
+        input_lst = pd.read_csv(pipe.get_step_dir('gen_candidates') + 'patients.lst', sep = '\t', header=None)
+        img_lsts_dict = OrderedDict()
+        img_candidates_lsts_dict = OrderedDict()
         for split_name, split in pipe.patients_by_split.items():
-            truncated_first_column = pd.Series([name.split('_')[0] for name in input_lst_candidates[0]])
-            img_candidates_lsts_dict[split_name] = input_lst_candidates[truncated_first_column.isin(split)]
-            img_candidates_lsts_dict[split_name].reset_index(drop=True, inplace=True)
+            img_lsts_dict[split_name] = input_lst[input_lst[0].isin(split)]
+            img_lsts_dict[split_name].reset_index(drop=True, inplace=True)
+        # if pipe.dataset_name == 'LUNA16':
+        if 1:
+            input_lst_candidates = pd.read_csv(pipe.get_step_dir('gen_candidates') + 'candidates.lst', sep = '\t', header=None)
+            for split_name, split in pipe.patients_by_split.items():
+                truncated_first_column = pd.Series([name.split('_')[0] for name in input_lst_candidates[0]])
+                img_candidates_lsts_dict[split_name] = input_lst_candidates[truncated_first_column.isin(split)]
+                img_candidates_lsts_dict[split_name].reset_index(drop=True, inplace=True)
 
-    for lst_type in img_lsts_dict.keys():
-        if len(img_lsts_dict[lst_type]) == 0:
-            continue
-        img_lst_patients = img_lsts_dict[lst_type]
-        if img_candidates_lsts_dict is not None:
-            img_lst_candidates = img_candidates_lsts_dict[lst_type]
-        else:
-            img_lst_candidates = None
-        # ensure output files are overwritten
-        open(pipe.get_step_dir() + lst_type + '_patients.lst', 'w').close()
-        if pipe.dataset_name == 'LUNA16':
-            open(pipe.get_step_dir() + lst_type + '_candidates.lst', 'w').close()
-        #reduce imglist to n_patients
-        if pipe.n_patients > 0:
-            img_lst_patients = img_lst_patients[img_lst_patients[0].isin(list(pipe.patients_raw_data_paths.keys())) ]
-        pipe.log.info('processing lst {} with len {}'.format(lst_type, len(img_lst_patients)))
+        for lst_type in img_lsts_dict.keys():
+            patients_journaled = pipe.load_journal()
+            if len(img_lsts_dict[lst_type]) == 0:
+                continue
+            img_lst_patients = img_lsts_dict[lst_type]
+            if img_candidates_lsts_dict is not None:
+                img_lst_candidates = img_candidates_lsts_dict[lst_type]
+            else:
+                img_lst_candidates = None
+            #reduce imglist to the patients of the chunk, e.g., n_patients
+            img_lst_patients = img_lst_patients[img_lst_patients[0].isin(patients_chunk)
+                                                & ~img_lst_patients[0].isin(list(patients_journaled.keys()))]
+            img_lst_patients.reset_index(drop=True, inplace=True)
+            pipe.log.info('processing lst {} with len {}'.format(lst_type, len(img_lst_patients)))
 
-        gen_data(lst_type,
-                 img_lst_patients,
-                 img_lst_candidates,
-                 gen_candidates_json,
-                 resample_lungs_json,
-                 n_candidates,
-                 crop_raw_scan_buffer,
-                 new_data_type,
-                 new_candidates_shape_zyx,
-                 new_spacing_zyx)
+            gen_data(lst_type,
+                     img_lst_patients,
+                     img_lst_candidates,
+                     gen_candidates_json,
+                     resample_lungs_json,
+                     n_candidates,
+                     crop_raw_scan_buffer,
+                     new_data_type,
+                     new_candidates_shape_zyx,
+                     new_spacing_zyx)
+            write_lsts_from_journal(lst_type, pipe.load_journal())
+    # with the patients of all workers that share the step directory, see `pipe._run_step_leased`
+    for lst_type in pipe.patients_by_split:
+        write_lsts_from_journal(lst_type, pipe.load_journal())
     
     frame = []
     for lst_type in ['tr', 'va']:
-        #make correct lists
+        #make correct lists, the patients might not contain both splits
+        if os.path.getsize(pipe.get_step_dir() + lst_type + '_patients.lst') == 0:
+            continue
         data = pd.read_csv(pipe.get_step_dir() + lst_type + '_patients.lst', header=None, sep = '\t')
         number = 80 if lst_type == 'tr' else 20
         data.to_csv(pipe.get_step_dir() + lst_type + '_patients_'+str(number)+'.lst', header=None, sep = '\t', index=False)
         frame.append(data)
+    if not frame:
+        return
     full = pd.concat(frame, axis = 0)
     full.to_csv(pipe.get_step_dir() + 'tr_patients_100.lst', header=None, sep = '\t', index=False)
     full[:50].to_csv(pipe.get_step_dir() + 'va_patients_0.lst', header=None, sep = '\t', index=False)
@@ -138,25 +147,40 @@ def gen_data(lst_type,
                 images = (images / (float(HU_tissue_range[1] - HU_tissue_range[0])) - 0.25).astype(np.float32) # [-0.25, 0.75]
                 prob_maps = (prob_maps / 255).astype(np.float32) # [0.0, 1.0]
             images_and_prob_maps = np.concatenate([images, prob_maps], axis=4).astype(new_data_type)
-            path = pipe.save_array(patient + '.npy', images_and_prob_maps)
-            with open(pipe.get_step_dir() + lst_type + '_patients.lst', 'a') as f:
-                f.write('{}\t{}\t{}\n'.format(patient, patient_label, os.path.abspath(path)))
+            with pipe.timing('save', patient):
+                path = pipe.save_array(patient + '.npy', images_and_prob_maps)
+            patients_lst_line = '{}\t{}\t{}\n'.format(patient, patient_label, os.path.abspath(path))
+            candidates_lst_lines = []
             if pipe.dataset_name == 'LUNA16':
-                with open(pipe.get_step_dir() + lst_type + '_candidates.lst', 'a') as f:
-                    for cnt in range(images.shape[0]):
-                        cand = patient+'_'+str(cnt)
-                        img_lst_candidates[img_lst_candidates[0]==cand][1].values.tolist()
-                        cand_label = img_lst_candidates[img_lst_candidates[0]==cand][1].values.tolist()
-                        if len(cand_label)==0:
-                            cand_label=0
-                        else:
-                            cand_label=cand_label[0]
-                        if not cand.startswith(patient):
-                            raise ValueError(cand + ' needs to start with ' + patient)
-                        f.write('{}\t{}\t{}\n'.format(cand, cand_label, os.path.abspath(path)))
+                for cnt in range(images.shape[0]):
+                    cand = patient+'_'+str(cnt)
+                    img_lst_candidates[img_lst_candidates[0]==cand][1].values.tolist()
+                    cand_label = img_lst_candidates[img_lst_candidates[0]==cand][1].values.tolist()
+                    if len(cand_label)==0:
+                        cand_label=0
+                    else:
+                        cand_label=cand_label[0]
+                    if not cand.startswith(patient):
+                        raise ValueError(cand + ' needs to start with ' + patient)
+                    candidates_lst_lines.append('{}\t{}\t{}\n'.format(cand, cand_label, os.path.abspath(path)))
+            pipe.append_journal(patient, OrderedDict([('lst_type', lst_type),
+                                                      ('basename', patient + '.npy'),
+                                                      ('patients_lst', patients_lst_line),
+                                                      ('candidates_lst', candidates_lst_lines)]))
     
 
 
+def write_lsts_from_journal(lst_type, patients_journaled):
+    """Overwrite the lists of lst_type with the patients in the journal.
+
+    The lists are replaced atomically as several workers might write them.
+    """
+    patients_json = [r for r in patients_journaled.values() if r['lst_type'] == lst_type]
+    utils.replace_file(pipe.get_step_dir() + lst_type + '_patients.lst',
+                       lambda f: f.write(''.join(r['patients_lst'] for r in patients_json)))
+    if pipe.dataset_name == 'LUNA16':
+        utils.replace_file(pipe.get_step_dir() + lst_type + '_candidates.lst',
+                           lambda f: f.write(''.join(''.join(r['candidates_lst']) for r in patients_json)))
 
 def gen_patients_candidates(line_num,
                             img_lst_patients,
@@ -176,10 +200,15 @@ def gen_patients_candidates(line_num,
     resampled_scan_spacing_zyx_mm_px = resample_lungs_json[patient]['resampled_scan_spacing_zyx_mm']
     convert2raw_scan_spacing_factor = np.array(resampled_scan_spacing_zyx_mm_px, dtype='float32') / np.array(raw_scan_spacing_zyx_mm_px) #zyx
     convert2raw_scan_spacing_factor = [convert2raw_scan_spacing_factor[j] for j in range(3) for i in range(2)] #zzyyxx
-    if pipe.dataset_name == 'LUNA16':
-        raw_lung_array, old_spacing_zyx, _, _ = resample_lungs.get_img_array_mhd(pipe.patients_raw_data_paths[patient])
-    elif pipe.dataset_name == 'dsb3':
-        raw_lung_array, old_spacing_zyx, _, _ = resample_lungs.get_img_array_dcom(pipe.patients_raw_data_paths[patient])
+    with pipe.timing('load', patient):
+        if 'raw_basename' in resample_lungs_json[patient]:
+            # saved by resample_lungs, only the cropped regions are read from disk
+            raw_lung_array = pipe.load_array(resample_lungs_json[patient]['raw_basename'], 'resample_lungs', mmap=True)
+            old_spacing_zyx = raw_scan_spacing_zyx_mm_px
+        elif pipe.dataset_name == 'LUNA16':
+            raw_lung_array, old_spacing_zyx, _, _ = resample_lungs.get_img_array_mhd(pipe.patients_raw_data_paths[patient])
+        elif pipe.dataset_name == 'dsb3':
+            raw_lung_array, old_spacing_zyx, _, _ = resample_lungs.get_img_array_dcom(pipe.patients_raw_data_paths[patient])
     clusters = gen_candidates_json[patient]['clusters']
     images = []; prob_maps = []
     for clu_num, clu in enumerate(clusters[:min(len(clusters), n_candidates)]):
@@ -212,6 +241,7 @@ def gen_patients_candidates(line_num,
                                                        :new_candidates_shape_zyx[2]]
         # visualize
         if np.random.randint(0, 100) == 0:
+            from matplotlib import pyplot as plt
             old_image = pipe.load_array(clu['img_basename'], 'gen_candidates')
             plt.imshow(old_image[old_image.shape[0] // 2, :, :])
             plt.savefig(pipe.get_step_dir() + 'figs/' + patient + '_can' + str(clu_num) + '_imgold.png')
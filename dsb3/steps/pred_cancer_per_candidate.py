@@ -5,7 +5,6 @@ import os, sys
 import numpy as np
 import pandas as pd
 import json
-import cv2
 from tqdm import tqdm
 from collections import OrderedDict
 from .. import pipeline as pipe
@@ -18,7 +17,7 @@ def run(num_augs_per_img,
         all_patients,
         list_to_predict):
     # load some information json
-    gen_candidates_json = pipe.load_json('out.json', 'gen_candidates')
+    gen_candidates_json = pipe.load_index('gen_candidates')
     out_json = OrderedDict()
     # get some parameters
     net_config = {}
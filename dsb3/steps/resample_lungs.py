@@ -1,16 +1,13 @@
 import numpy as np
 import os, sys
-import cv2
-import SimpleITK as sitk
-import scipy.ndimage
-import dicom
 import json
 import math
-from joblib import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from .. import utils
 from .. import tf_tools
+from .. import resample
 from .. import pipeline as pipe
 
 def run(new_spacing_zyx,
@@ -19,7 +16,15 @@ def run(new_spacing_zyx,
         HU_tissue_range,
         checkpoint_dir,
         batch_size,
-        seg_max_shape_yx):
+        seg_max_shape_yx,
+        save_raw_volume=False,
+        resampling_kernel='zoom',
+        resampling_n_threads=1,
+        crop_before_resample=False,
+        lung_box_kernel=None,
+        lung_bbox_method='net',
+        lung_bbox_report_n_patients=0,
+        seg_slice_step=1):
     """
     Writes resized, interpolated and cropped CT scans to disk.
 
@@ -39,137 +44,443 @@ def run(new_spacing_zyx,
         Batch size for lung wings segmentation.
     seg_max_shape_yx : list of int
         [512, 512]
+    save_raw_volume : bool
+        Also save the decoded raw scan in HU as int16 .npy, so that later
+        steps, e.g., interpolate_candidates, read it memory-mapped instead of
+        decoding the raw data again. Its spacing and origin are in out.json.
+    resampling_kernel : {'cubic', 'linear', 'lanczos', 'zoom'}
+        'zoom' for scipy.ndimage.zoom of order 3, or a kernel of
+        dsb3/resample.py, which is faster but opt-in until validated on
+        the pinned versions; 'cubic' follows zoom of scipy 0.18.
+    resampling_n_threads : int
+        Threads per patient for resampling, patients run in n_CPUs processes.
+    crop_before_resample : bool
+        Find the lung wings and the value histogram on a resampling of the
+        whole scan with `lung_box_kernel` and resample only the bounding box
+        with `resampling_kernel`. Shape and coordinates of the output are the
+        same as without.
+    lung_box_kernel : {None, 'cubic', 'linear', 'lanczos'}
+        None for `resampling_kernel`, which gives the bounding box and
+        histogram of the run without crop_before_resample; the box is then
+        cropped from that resampling. A cheaper kernel, e.g., 'linear',
+        saves most of the resampling, but box and histogram can differ
+        slightly, see benchmarks/crop_before_resample.py.
+    lung_bbox_method : {'net', 'threshold'}
+        Bounding box of the lungs from the lung wings segmentation net or
+        from HU thresholds and morphology, see `get_lung_box_threshold`,
+        which needs neither tensorflow nor `checkpoint_dir`.
+    lung_bbox_report_n_patients : int
+        With 'net', compare the boxes of the first patients with the ones of
+        'threshold' in lung_bbox_agreement.json.
+    seg_slice_step : int
+        With 'net', segment only every seg_slice_step-th slice and refine near
+        the ends of the lungs and the extremes of the box, see `plan_slices`.
+        1 segments all slices.
 
     Returns
     -------
     out_dict : dict
         Result dictionary.
     """
-    params = locals()
     if data_type not in ['float32', 'int16']:
         raise ValueError('Invalid data_type. Use int16 or float32.')
-    if not os.path.exists(checkpoint_dir):
+    if resampling_kernel not in resample.kernels + ['zoom']:
+        raise ValueError('Invalid resampling_kernel. Use one of ' + str(resample.kernels + ['zoom']) + '.')
+    if crop_before_resample and resampling_kernel == 'zoom':
+        raise ValueError('crop_before_resample needs a resampling_kernel of dsb3/resample.py.')
+    if lung_box_kernel is not None and lung_box_kernel not in resample.kernels:
+        raise ValueError('Invalid lung_box_kernel. Use None or one of ' + str(resample.kernels) + '.')
+    # the kernel of the whole scan, only the lung box is resampled again with a different one
+    if not crop_before_resample or lung_box_kernel is None:
+        lung_box_kernel = resampling_kernel
+    crop_before_resample = lung_box_kernel != resampling_kernel
+    if lung_bbox_method not in ['net', 'threshold']:
+        raise ValueError('Invalid lung_bbox_method. Use net or threshold.')
+    if lung_bbox_method == 'net' and not os.path.exists(checkpoint_dir):
         raise ValueError('checkpoint_dir ' + checkpoint_dir + ' does not exist.')
-    # init out file with tissue_range info
-    n_threads = pipe.n_CPUs
-    n_junks = int(np.ceil(pipe.n_patients/ n_threads))
-    pipe.log.info('processing ' + str(n_junks) + ' junks with ' + str(n_threads) + ' patients each')
-    tf_net = tf_tools.load_network(checkpoint_dir)
-    for junk_cnt in range(n_junks):
-        patients_junk = []
-        for in_junk_cnt in range(n_threads):
-            patient_cnt = n_threads * junk_cnt + in_junk_cnt
-            if patient_cnt >= pipe.n_patients:
-                break
-            patients_junk.append(pipe.patients[patient_cnt])
-        pipe.log.info('processing junk ' + str(junk_cnt))
-        process_junk(junk_cnt, patients_junk, tf_net, **params)
-    with tf_tools.redirect_stdout():
-        tf_net[0].close()
-
-def process_junk(junk_cnt, patients_junk, tf_net,
-                 new_spacing_zyx,
-                 bounding_box_buffer_yx_px,
-                 data_type,
-                 HU_tissue_range,
-                 checkpoint_dir,
-                 batch_size,
-                 seg_max_shape_yx):
-    sess, pred_ops, data = tf_net
-    # resizing and interpolating scans: heterogenous spacing -> homogeneous spacing
-    patients_json = dict(Parallel(n_jobs=min(pipe.n_CPUs, len(patients_junk)), verbose=100)(
-                                  delayed(process_patient)(patient, new_spacing_zyx, data_type)
-                                  for patient in patients_junk))
-        
-    # segmenting lung wings and cropping the scan
-    for patient, pa_json in tqdm(patients_json.items()):
-        config = json.load(open(checkpoint_dir + '/config.json'))
-        img_array_zyx = pa_json['img_array_zyx']; del pa_json['img_array_zyx']
-        pre_norm_value_hist, value_range = get_pre_normed_value_hist(img_array_zyx)
-        pa_json['pre_normalized_zero-centered_value_histogram'] = [x for x in pre_norm_value_hist]
-        pa_json['pre_normalized_zero-centered_value_range'] = [x for x in value_range]
-        img_array_zyx = clip_HU_range(img_array_zyx, HU_tissue_range)
-        # lung wings segmentation (max width 512 due to embedding_shape of lungwings_segmentation training_data)
-        seg_max_shape_yx = [int(seg_max_shape_yx[0] / pa_json['resampled_scan_spacing_zyx_mm'][1]), 
-                            int(seg_max_shape_yx[1] / pa_json['resampled_scan_spacing_zyx_mm'][2])]
-        # value range [-1.0, 1.0] axis [z, y, x, 1]
-        scale_yx = [x for x in np.array(config['image_shape'][:2]) / seg_max_shape_yx[:2]] # config['image_shape'] is y, x
+    if seg_slice_step < 1:
+        raise ValueError('seg_slice_step needs to be at least 1.')
+    # resampling runs in n_workers processes while this process segments the
+    # lung wings of the patients that are ready, at most max_pending patients
+    # are resampled or waiting for the segmentation at a time
+    n_workers = max(1, min(pipe.n_CPUs, pipe.n_patients))
+    max_pending = 2 * n_workers
+    pipe.log.info('resampling with ' + str(n_workers) + ' processes while segmenting')
+    patients = enumerate(pipe.iter_patients(pipe.patients))
+    pending = OrderedDict() # future -> function called with its result
+    agreement_json = OrderedDict()
+    pulling, pulled_all = False, False
+    def pull():
+        # the next patient is taken and submitted in a thread, so that the
+        # results of finished patients are processed while a streamed step
+        # waits for its upstream steps
+        nonlocal pulling
+        if not pulling and not pulled_all and len(pending) < max_pending:
+            pending[puller.submit(submit)] = submitted
+            pulling = True
+    def submit():
+        for patient_cnt, patient in patients:
+            threshold_box = lung_bbox_method == 'threshold' or patient_cnt < lung_bbox_report_n_patients
+            return pool.submit(process_patient, patient, new_spacing_zyx, data_type, save_raw_volume,
+                               lung_box_kernel, resampling_n_threads,
+                               crop_before_resample, threshold_box)
+    def submitted(future):
+        nonlocal pulling, pulled_all
+        pulling = False
+        if future is None:
+            pulled_all = True
+            return
+        pending[future] = segment
+        pull()
+    def segment(result):
+        if lung_bbox_method == 'net':
+            batches.add(prepare_patient(*result, config=config, HU_tissue_range=HU_tissue_range,
+                                        seg_max_shape_yx=seg_max_shape_yx))
+        else:
+            prepared = prepare_patient(*result, config=None, HU_tissue_range=HU_tissue_range)
+            if prepared['lung_box_threshold_yx_px']:
+                prepared['crop_coords_z_list_yx_px'] = [prepared['lung_box_threshold_yx_px']]
+            finish(prepared)
+    def finish(prepared): # called by batches with segmented patients
+        if lung_bbox_method == 'net' and prepared['lung_box_threshold_yx_px'] is not None:
+            agreement_json[prepared['patient']] = get_box_agreement(prepared['crop_coords_z_list_yx_px'],
+                                                                    prepared['lung_box_threshold_yx_px'])
+        bound_box_coords_yx_px = get_bound_box(prepared, bounding_box_buffer_yx_px)
+        if crop_before_resample:
+            del prepared['img_array_zyx'], prepared['img_array_seg_zyx']
+            future = pool.submit(resample_lung_box, prepared['patient'], prepared.pop('raw_img_array_zyx'),
+                                 prepared['pa_json']['raw_scan_spacing_zyx_mm'], new_spacing_zyx,
+                                 bound_box_coords_yx_px, HU_tissue_range, resampling_kernel, resampling_n_threads)
+            pending[future] = lambda img_array_zyx: save(prepared, img_array_zyx)
+        else:
+            save(prepared, prepared['img_array_zyx'][:,
+                                                     bound_box_coords_yx_px[0]:bound_box_coords_yx_px[1],
+                                                     bound_box_coords_yx_px[2]:bound_box_coords_yx_px[3]])
+    def save(prepared, img_array_zyx):
+        save_patient(prepared['patient'], prepared['pa_json'], img_array_zyx)
+        progress.update()
+    # forks on linux, the workers start with the first submit
+    with ProcessPoolExecutor(n_workers) as pool, ThreadPoolExecutor(1) as puller:
+        pool.submit(int).result() # forks the workers before tensorflow starts its threads
+        pull()
+        batches = None
+        if lung_bbox_method == 'net':
+            config = json.load(open(checkpoint_dir + '/config.json'))
+            tf_net = tf_tools.load_network(checkpoint_dir)
+            # slices of several patients share the batches of the segmentation
+            batches = SegmentationBatches(tf_net, config, batch_size, finish, seg_slice_step)
+        with tqdm(total=pipe.n_patients) as progress:
+            while pending or (batches and batches.queue):
+                if not pending:
+                    batches.flush() # the last batch, can submit lung boxes
+                    continue
+                done = wait(pending, return_when=FIRST_COMPLETED).done
+                callbacks = [(future, pending.pop(future)) for future in done]
+                pull()
+                for future, callback in callbacks:
+                    callback(future.result())
+                pull()
+    if batches is not None:
+        with tf_tools.redirect_stdout():
+            tf_net[0].close()
+        pipe.log.info('segmented ' + str(batches.n_segmented) + ' of ' + str(batches.n_slices) + ' slices')
+    if agreement_json:
+        pipe.save_json('lung_bbox_agreement.json', agreement_json, mode='a')
+        ious = [a['iou'] for a in agreement_json.values()]
+        pipe.log.info('lung boxes of net and threshold: mean IoU {:.3f}, min IoU {:.3f} for {} patients'
+                      .format(np.mean(ious), np.min(ious), len(ious)))
+
+def prepare_patient(patient, pa_json, config, HU_tissue_range, seg_max_shape_yx=None):
+    """Clip the resampled scan and, unless config is None, downscale its slices
+    for the lung wing segmentation."""
+    img_array_zyx = pa_json['img_array_zyx']; del pa_json['img_array_zyx']
+    pre_norm_value_hist, value_range = get_pre_normed_value_hist(img_array_zyx)
+    pa_json['pre_normalized_zero-centered_value_histogram'] = [x for x in pre_norm_value_hist]
+    pa_json['pre_normalized_zero-centered_value_range'] = [x for x in value_range]
+    img_array_zyx = clip_HU_range(img_array_zyx, HU_tissue_range)
+    prepared = {'patient': patient,
+                'pa_json': pa_json,
+                'img_array_zyx': img_array_zyx,
+                'raw_img_array_zyx': pa_json.pop('raw_img_array_zyx', None), # for crop_before_resample
+                'lung_box_threshold_yx_px': pa_json.pop('lung_box_threshold_yx_px', None),
+                'img_array_seg_zyx': None,
+                'crop_coords_z_list_yx_px': [],
+                'slice_stage': None}
+    if config is None:
+        return prepared
+    # lung wings segmentation (max width 512 due to embedding_shape of lungwings_segmentation training_data)
+    seg_max_shape_yx = [int(seg_max_shape_yx[0] / pa_json['resampled_scan_spacing_zyx_mm'][1]), 
+                        int(seg_max_shape_yx[1] / pa_json['resampled_scan_spacing_zyx_mm'][2])]
+    # value range [-1.0, 1.0] axis [z, y, x, 1]
+    scale_yx = [x for x in np.array(config['image_shape'][:2]) / seg_max_shape_yx[:2]] # config['image_shape'] is y, x
+    with pipe.timing('preprocess', patient):
         img_array_seg_zyx, crop_coords_seg_yx = seg_preprocessing(img_array_zyx, config, scale_yx, HU_tissue_range)
-        # calculate rescaling factor for whole scan
-        inverse_scale_yx = [1.0/s for s in scale_yx] # y, x
-        # define crop_coords_seg_yx
-        crop_coords_z_list_yx_px = []
-        # lung_wings segmentation
-        n_batches = int(np.ceil(img_array_zyx.shape[0] / batch_size))
-        for batch_cnt in range(n_batches):
-            batch = (-1) * np.ones([batch_size] + config['image_shape'], dtype=np.float32)
-            z_crop_idx = [batch_cnt * batch_size, min((batch_cnt + 1) * batch_size, img_array_seg_zyx.shape[0])]
-            batch[:z_crop_idx[1] - z_crop_idx[0], :, :, :] = img_array_seg_zyx[z_crop_idx[0] : z_crop_idx[1], :, :, :]
-            # lung_wings segmentation
+    prepared['img_array_seg_zyx'] = img_array_seg_zyx
+    prepared['crop_coords_seg_yx'] = crop_coords_seg_yx
+    prepared['inverse_scale_yx'] = [1.0/s for s in scale_yx] # rescaling factor for whole scan, y, x
+    return prepared
+
+class SegmentationBatches:
+    """Feed the slices of consecutive patients to the lung wing segmentation in
+    full batches, only the last batch of the step is padded with -1 images.
+
+    `finish` is called with each prepared patient whose lung box is known, in
+    the order of `add`. Which slices are segmented is decided by
+    `plan_slices`, all of them for `slice_step` 1.
+    """
+
+    def __init__(self, tf_net, config, batch_size, finish, slice_step=1):
+        self.tf_net = tf_net
+        self.config = config
+        self.batch_size = batch_size
+        self.finish = finish
+        self.slice_step = slice_step
+        self.queue = deque() # patients whose lung box is not known
+        self.n_queued = 0 # slices in the queue that are not segmented
+        self.n_segmented = 0
+        self.n_slices = 0
+
+    def add(self, patient):
+        patient['todo'] = deque()
+        patient['crop_coords_by_z'] = OrderedDict()
+        patient['segmented_slices'] = set()
+        self.n_slices += patient['img_array_seg_zyx'].shape[0]
+        self.queue.append(patient)
+        self.schedule(patient)
+        while self.n_queued >= self.batch_size:
+            self.run_batch()
+        self.finish_segmented()
+
+    def flush(self):
+        while self.n_queued > 0:
+            self.run_batch()
+        self.finish_segmented()
+
+    def schedule(self, patient):
+        while not patient['todo'] and patient['slice_stage'] != 'done':
+            slices = plan_slices(patient, self.slice_step)
+            patient['todo'].extend(slices)
+            self.n_queued += len(slices)
+
+    def run_batch(self):
+        sess, pred_ops, data = self.tf_net
+        batch = (-1) * np.ones([self.batch_size] + self.config['image_shape'], dtype=np.float32)
+        parts = [] # patient, slices of the patient, first slice in the batch
+        n_filled = 0
+        for patient in self.queue:
+            if n_filled == self.batch_size:
+                break
+            slices = [patient['todo'].popleft() for _ in range(min(self.batch_size - n_filled, len(patient['todo'])))]
+            if not slices:
+                continue
+            batch[n_filled : n_filled + len(slices)] = patient['img_array_seg_zyx'][slices]
+            parts.append((patient, slices, n_filled))
+            n_filled += len(slices)
+        self.n_queued -= n_filled
+        self.n_segmented += n_filled
+        # the time of the batch is split among its patients by their slices
+        shares = OrderedDict()
+        for patient, slices, _ in parts:
+            shares[patient['patient']] = shares.get(patient['patient'], 0) + len(slices) / n_filled
+        with pipe.timing('inference', shares):
             with tf_tools.redirect_stdout():
                 prediction = sess.run(pred_ops, feed_dict = {data['images']: batch})['probs']
-            prediction = np.reshape(prediction, tuple([batch_size] + config['label_shape'][:2] + [1]))
-            prediction = seg_postprocessing(prediction)
-            # evaluate prediction -> get crop idx
-            for layer_in_batch_cnt in range(z_crop_idx[1] - z_crop_idx[0]):
-                layer_cnt = layer_in_batch_cnt + batch_size * batch_cnt
-                crop_coords_yx = get_crop_idx_yx(prediction[layer_in_batch_cnt, :, :, :], crop_coords_seg_yx, inverse_scale_yx)
-                if crop_coords_yx:
-                    crop_coords_z_list_yx_px += [crop_coords_yx]
-        # crop bounding_cube around lung wings and save
-        layers_coords = [[yx_coords[x] for yx_coords in crop_coords_z_list_yx_px] for x in range(4)]
-        if [True, True, True, True] == [True if len(x) > 0 else False for x in layers_coords]:
-            bound_box_coords_yx_px = [max(0, min(layers_coords[0]) - bounding_box_buffer_yx_px[0]),
-                                      min(img_array_zyx.shape[1], max(layers_coords[1]) + bounding_box_buffer_yx_px[0]),
-                                      max(0, min(layers_coords[2]) - bounding_box_buffer_yx_px[1]),
-                                      min(img_array_zyx.shape[2], max(layers_coords[3]) + bounding_box_buffer_yx_px[1])]
-        else:
-            pipe.log.warning('No lung wings found in scan of patient ' + patient + '. Taking the whole scan.')
-            bound_box_coords_yx_px = [0, img_array_zyx.shape[0], 0, img_array_zyx.shape[1]]
-        pa_json['bound_box_coords_yx_px'] = bound_box_coords_yx_px
-        # '+1': bounding box convention is the same as in gen_nodule_masks and interpolate_candidates
-        pa_json['bound_box_shape_yx_px'] = [bound_box_coords_yx_px[1] + 1 - bound_box_coords_yx_px[0], 
-                                            bound_box_coords_yx_px[3] + 1 - bound_box_coords_yx_px[2]]
-        pa_json['basename'] = basename = patient + '_img.npy'
-        pa_json['pathname'] = pipe.save_array(basename,
-                                              img_array_zyx[:,
-                                                            bound_box_coords_yx_px[0]:bound_box_coords_yx_px[1],
-                                                            bound_box_coords_yx_px[2]:bound_box_coords_yx_px[3]])
-        patients_json[patient] = pa_json
-    pipe.save_json('out.json', patients_json, mode='w' if junk_cnt == 0 else 'a')
-
-def process_patient(patient, new_spacing_zyx, data_type):
-    if pipe.dataset_name == 'LUNA16':
-        img_array_zyx, old_spacing_zyx, old_origin_zyx, acquisition_exception = get_img_array_mhd(pipe.patients_raw_data_paths[patient])
-    elif pipe.dataset_name == 'dsb3':
-        img_array_zyx, old_spacing_zyx, old_origin_zyx, acquisition_exception = get_img_array_dcom(pipe.patients_raw_data_paths[patient])
+        prediction = np.reshape(prediction, tuple([self.batch_size] + self.config['label_shape'][:2] + [1]))
+        prediction = seg_postprocessing(prediction)
+        # evaluate prediction -> get crop idx
+        for patient, slices, offset in parts:
+            found, crop_coords_yx = get_crop_idx_yx_stack(prediction[offset : offset + len(slices)],
+                                                          patient['crop_coords_seg_yx'], patient['inverse_scale_yx'])
+            for layer_in_batch_cnt, coords in zip(found, crop_coords_yx.tolist()):
+                patient['crop_coords_by_z'][slices[layer_in_batch_cnt]] = coords
+            patient['segmented_slices'].update(slices)
+            self.schedule(patient)
+
+    def finish_segmented(self):
+        while self.queue and self.queue[0]['slice_stage'] == 'done':
+            patient = self.queue.popleft()
+            patient['crop_coords_z_list_yx_px'] = [patient['crop_coords_by_z'][z] for z in sorted(patient['crop_coords_by_z'])]
+            self.finish(patient)
+
+def plan_slices(prepared, slice_step, tolerance_px=2):
+    """Next slices to segment for the lung box of a patient.
+
+    At first every `slice_step`th and the last slice. Then the slices between
+    the samples where the lungs appear and disappear and around the samples
+    attaining the extremes of the box. If these move the box by more than
+    `tolerance_px` or no lungs are found, all remaining slices are segmented.
+    Sets 'slice_stage' of the patient to 'done' when the box is known.
+    """
+    n_slices = prepared['img_array_seg_zyx'].shape[0]
+    stage = prepared['slice_stage']
+    found = prepared['crop_coords_by_z']
+    remaining = [z for z in range(n_slices) if z not in prepared['segmented_slices']]
+    if stage is None and slice_step > 1 and n_slices > 0:
+        prepared['slice_stage'] = 'sparse'
+        return sorted(set(range(0, n_slices, slice_step)) | {n_slices - 1})
+    if stage == 'sparse' and found:
+        prepared['sparse_box_yx_px'] = get_union_box(found.values())
+        ends = sorted(found)
+        refine = set(range(ends[0] - slice_step + 1, ends[0])) | set(range(ends[-1] + 1, ends[-1] + slice_step))
+        for coord, extreme in enumerate(prepared['sparse_box_yx_px']):
+            for z in [z for z in found if found[z][coord] == extreme]:
+                refine |= set(range(z - slice_step + 1, z + slice_step))
+        prepared['slice_stage'] = 'refine'
+        return sorted(refine.intersection(remaining))
+    if stage == 'refine':
+        moved = np.abs(np.array(get_union_box(found.values())) - prepared['sparse_box_yx_px'])
+        if moved.max() <= tolerance_px:
+            prepared['slice_stage'] = 'done'
+            return []
+        pipe.log.info('lung box of patient ' + prepared['patient'] + ' moved by ' + str(moved.max())
+                      + ' px after refinement, segmenting all slices')
+    if stage == 'dense':
+        prepared['slice_stage'] = 'done'
+        return []
+    prepared['slice_stage'] = 'dense'
+    return remaining
+
+def get_union_box(crop_coords_yx):
+    crop_coords_yx = np.array(list(crop_coords_yx))
+    return [crop_coords_yx[:, 0].min(), crop_coords_yx[:, 1].max(), crop_coords_yx[:, 2].min(), crop_coords_yx[:, 3].max()]
+
+def get_bound_box(prepared, bounding_box_buffer_yx_px):
+    """Bounding box around the segmented lung wings, also set in the out.json record."""
+    patient = prepared['patient']
+    pa_json = prepared['pa_json']
+    img_array_zyx = prepared['img_array_zyx']
+    crop_coords_z_list_yx_px = prepared['crop_coords_z_list_yx_px']
+    layers_coords = [[yx_coords[x] for yx_coords in crop_coords_z_list_yx_px] for x in range(4)]
+    if [True, True, True, True] == [True if len(x) > 0 else False for x in layers_coords]:
+        bound_box_coords_yx_px = [max(0, min(layers_coords[0]) - bounding_box_buffer_yx_px[0]),
+                                  min(img_array_zyx.shape[1], max(layers_coords[1]) + bounding_box_buffer_yx_px[0]),
+                                  max(0, min(layers_coords[2]) - bounding_box_buffer_yx_px[1]),
+                                  min(img_array_zyx.shape[2], max(layers_coords[3]) + bounding_box_buffer_yx_px[1])]
+    else:
+        pipe.log.warning('No lung wings found in scan of patient ' + patient + '. Taking the whole scan.')
+        bound_box_coords_yx_px = [0, img_array_zyx.shape[0], 0, img_array_zyx.shape[1]]
+    pa_json['bound_box_coords_yx_px'] = bound_box_coords_yx_px
+    # '+1': bounding box convention is the same as in gen_nodule_masks and interpolate_candidates
+    pa_json['bound_box_shape_yx_px'] = [bound_box_coords_yx_px[1] + 1 - bound_box_coords_yx_px[0], 
+                                        bound_box_coords_yx_px[3] + 1 - bound_box_coords_yx_px[2]]
+    return bound_box_coords_yx_px
+
+def get_box_agreement(crop_coords_z_list_yx_px, lung_box_threshold_yx_px):
+    """Lung boxes [min_y, max_y, min_x, max_x] of both methods and their intersection over union."""
+    boxes = [[min(c[0] for c in crop_coords_z_list_yx_px), max(c[1] for c in crop_coords_z_list_yx_px),
+              min(c[2] for c in crop_coords_z_list_yx_px), max(c[3] for c in crop_coords_z_list_yx_px)]
+             if crop_coords_z_list_yx_px else [], lung_box_threshold_yx_px]
+    if not boxes[0] or not boxes[1]:
+        iou = float(boxes[0] == boxes[1])
+    else:
+        area = lambda b: max(0, b[1] + 1 - b[0]) * max(0, b[3] + 1 - b[2])
+        intersection = area([max(boxes[0][0], boxes[1][0]), min(boxes[0][1], boxes[1][1]),
+                             max(boxes[0][2], boxes[1][2]), min(boxes[0][3], boxes[1][3])])
+        iou = intersection / float(area(boxes[0]) + area(boxes[1]) - intersection)
+    return OrderedDict([('net_box_yx_px', boxes[0]), ('threshold_box_yx_px', boxes[1]), ('iou', iou)])
+
+def save_patient(patient, pa_json, img_array_zyx):
+    """Save the scan cropped to the lung bounding box."""
+    pa_json['basename'] = basename = patient + '_img.npy'
+    with pipe.timing('save', patient):
+        pa_json['pathname'] = pipe.save_array(basename, img_array_zyx)
+    pipe.append_journal(patient, pa_json)
+
+def resample_lung_box(patient, raw_img_array_zyx, old_spacing_zyx, new_spacing_zyx, bound_box_coords_yx_px,
+                      HU_tissue_range, resampling_kernel, resampling_n_threads):
+    """Resample and clip only the lung bounding box of the raw scan, the same as
+    cropping the resampled and clipped scan."""
+    new_shape = np.round(raw_img_array_zyx.shape * np.array(old_spacing_zyx) / np.array(new_spacing_zyx))
+    box = [(0, new_shape[0]), bound_box_coords_yx_px[:2], bound_box_coords_yx_px[2:]]
+    with pipe.timing('resample', patient):
+        img_array_zyx = resample.zoom(raw_img_array_zyx, new_shape, resampling_kernel,
+                                      n_threads=resampling_n_threads, box=box)
+    return clip_HU_range(img_array_zyx, HU_tissue_range)
+
+def process_patient(patient, new_spacing_zyx, data_type, save_raw_volume=False,
+                    resampling_kernel='zoom', resampling_n_threads=1, keep_raw=False, threshold_box=False):
+    with pipe.timing('load', patient):
+        if pipe.dataset_name == 'LUNA16':
+            img_array_zyx, old_spacing_zyx, old_origin_zyx, acquisition_exception = get_img_array_mhd(pipe.patients_raw_data_paths[patient])
+        elif pipe.dataset_name == 'dsb3':
+            img_array_zyx, old_spacing_zyx, old_origin_zyx, acquisition_exception = get_img_array_dcom(pipe.patients_raw_data_paths[patient])
     old_shape_zyx_px = img_array_zyx.shape
+    if save_raw_volume:
+        with pipe.timing('save', patient):
+            pipe.save_array(patient + '_raw.npy', img_array_zyx, mmap=True)
     if data_type != 'int16':
         array = array.astype(data_type)
-    img_array_zyx = resize_and_interpolate_array(img_array_zyx, old_spacing_zyx, new_spacing_zyx)
-    return patient, OrderedDict([('img_array_zyx', img_array_zyx), # new array
-                                 ('resampled_scan_spacing_zyx_mm', new_spacing_zyx),
-                                 ('resampled_scan_shape_zyx_px', img_array_zyx.shape),
-                                 ('raw_scan_spacing_zyx_mm', old_spacing_zyx), # info about original array
-                                 ('raw_scan_shape_zyx_px', old_shape_zyx_px),
-                                 ('raw_scan_origin_zyx_mm', old_origin_zyx),
-                                 ('acquisition_exception', acquisition_exception)])
-
-def resize_and_interpolate_array(img_array, old_spacing, new_spacing, order=3):
+    raw_img_array_zyx = img_array_zyx
+    with pipe.timing('resample', patient):
+        img_array_zyx = resize_and_interpolate_array(img_array_zyx, old_spacing_zyx, new_spacing_zyx,
+                                                     kernel=resampling_kernel, n_threads=resampling_n_threads)
+    pa_json = OrderedDict([('img_array_zyx', img_array_zyx), # new array
+                           ('resampled_scan_spacing_zyx_mm', new_spacing_zyx),
+                           ('resampled_scan_shape_zyx_px', img_array_zyx.shape),
+                           ('raw_scan_spacing_zyx_mm', old_spacing_zyx), # info about original array
+                           ('raw_scan_shape_zyx_px', old_shape_zyx_px),
+                           ('raw_scan_origin_zyx_mm', old_origin_zyx),
+                           ('acquisition_exception', acquisition_exception)])
+    if save_raw_volume:
+        pa_json['raw_basename'] = patient + '_raw.npy'
+    if keep_raw: # removed before the record is written
+        pa_json['raw_img_array_zyx'] = raw_img_array_zyx
+    if threshold_box:
+        with pipe.timing('lung_box', patient):
+            pa_json['lung_box_threshold_yx_px'] = get_lung_box_threshold(img_array_zyx)
+    return patient, pa_json
+
+def resize_and_interpolate_array(img_array, old_spacing, new_spacing, order=3, kernel='zoom', n_threads=1):
+    """Resample with scipy.ndimage.zoom or a kernel of dsb3/resample.py."""
     new_shape = np.round(img_array.shape * np.array(old_spacing) / np.array(new_spacing))
+    if kernel != 'zoom':
+        return resample.zoom(img_array, new_shape, kernel, n_threads=n_threads)
     resize_factor = new_shape / img_array.shape
     img_array = interpolate_array(img_array, resize_factor)
     return img_array
 
 def interpolate_array(array, resize_factor, order=3):
+    import scipy.ndimage
     return scipy.ndimage.interpolation.zoom(array, resize_factor, order=order, mode='nearest')
 
+def get_lung_box_threshold(img_array_zyx, threshold_HU=-400, min_fraction=0.1, stride=2):
+    """[min_y, max_y, min_x, max_x] of the lungs in a scan in HU, [] if none are found.
+
+    Air below `threshold_HU` that is not connected to the border of its slice
+    is inside the body. After a closing within slices, its largest 3d
+    components, with at least `min_fraction` of the volume of the largest,
+    are the lungs and the airways; smaller ones are, e.g., gas in the bowels.
+    Every `stride`th voxel is used, the box is accurate to `stride` pixels.
+    """
+    import scipy.ndimage
+    in_slice_4 = np.zeros((3, 3, 3), dtype=bool); in_slice_4[1, 1, :] = in_slice_4[1, :, 1] = True
+    in_slice_8 = np.zeros((3, 3, 3), dtype=bool); in_slice_8[1] = True
+    air = img_array_zyx[::stride, ::stride, ::stride] < threshold_HU
+    labels, n_labels = scipy.ndimage.label(air, in_slice_4)
+    border = np.ones(air.shape[1:], dtype=bool); border[1:-1, 1:-1] = False
+    is_outside = np.zeros(n_labels + 1, dtype=bool)
+    is_outside[0] = True
+    is_outside[labels[:, border]] = True
+    lungs = scipy.ndimage.binary_closing(~is_outside[labels], in_slice_8, iterations=2)
+    labels, n_labels = scipy.ndimage.label(lungs)
+    if n_labels == 0:
+        return []
+    volumes = np.bincount(labels.ravel())
+    volumes[0] = 0
+    lungs = (volumes >= min_fraction * volumes.max())[labels]
+    rows, cols = lungs.any(axis=(0, 2)), lungs.any(axis=(0, 1))
+    return [stride * int(rows.argmax()),
+            min(img_array_zyx.shape[1] - 1, stride * int(len(rows) - rows[::-1].argmax()) - 1),
+            stride * int(cols.argmax()),
+            min(img_array_zyx.shape[2] - 1, stride * int(len(cols) - cols[::-1].argmax()) - 1)]
+
 def get_pre_normed_value_hist(img_array):
     hist,ran = np.histogram(img_array.flatten(), bins=16*5,normed=True, range=[-1000,600])
     return hist, ran
 
 def get_img_array_mhd(img_file):
     """Image array in zyx convention with dtype = int16."""
+    import SimpleITK as sitk
     itk_img = sitk.ReadImage(img_file)
     img_array_zyx = sitk.GetArrayFromImage(itk_img) # indices are z, y, x 
     origin = itk_img.GetOrigin() # x, y, z  world coordinates (mm)
@@ -179,11 +490,22 @@ def get_img_array_mhd(img_file):
     acquisition_exception = None # no acquisition number found in object
     return img_array_zyx, spacing_zyx, origin_zyx, acquisition_exception
 
-def get_img_array_dcom(img_file):
-    """Image array in zyx convention with dtype = int16."""
+def get_img_array_dcom(img_file, n_threads=8):
+    """Image array in zyx convention with dtype = int16.
+
+    Only the headers of all files are read to select the acquisition and the
+    order of the slices, then the pixel data of the selected slices is
+    decoded. Files are read with `n_threads` threads.
+    """
+    import dicom
+    from concurrent.futures import ThreadPoolExecutor
+    def read_files(read, filenames):
+        with ThreadPoolExecutor(max(1, min(n_threads, len(filenames)))) as pool:
+            return list(pool.map(read, filenames))
     def load_scan(path):
         patient = path.split('/')[-2]
-        slices = [dicom.read_file(path + '/' + s) for s in os.listdir(path)]
+        slices = read_files(lambda f: dicom.read_file(f, stop_before_pixels=True),
+                            [path + '/' + s for s in os.listdir(path)])
         unique_ac_nums, counts = np.unique([s.AcquisitionNumber for s in slices], return_counts = True)
         if len(unique_ac_nums) > 1:
             counts = [int(i) for i in counts]
@@ -220,20 +542,20 @@ def get_img_array_dcom(img_file):
                     s.PixelSpacing[i] = np.argmax(np.bincount(cleaned_spacings))
         return slices, acquisition_exception
     def get_pixels_hu(slices):
-        image = np.stack([s.pixel_array for s in slices])
+        # the headers only have the filenames, decode the pixel data of the selected slices
+        image = np.stack(read_files(lambda f: dicom.read_file(f).pixel_array, [s.filename for s in slices]))
         # convert to int16 (from sometimes int16) should be possible as values should always be low enough (<32k).
         if np.max(image) > np.iinfo(np.int16).max:
             pipe.log.error('Controlled ransformation of pixel array to np.int16 failed: too high values!')
         image = image.astype(np.int16)
-        # convert to Hounsfield units (HU)
-        for slice_number in range(len(slices)):
-            intercept = slices[slice_number].RescaleIntercept
-            slope = slices[slice_number].RescaleSlope
-            if slope != 1:
-                image[slice_number] = slope * image[slice_number].astype(np.float64)
-                image[slice_number] = image[slice_number].astype(np.int16)
-            image[slice_number] += np.int16(intercept)
-        return np.array(image, dtype=np.int16)
+        # convert to Hounsfield units (HU), for all slices at once
+        slopes = np.array([float(s.RescaleSlope) for s in slices])
+        intercepts = np.array([float(s.RescaleIntercept) for s in slices]).astype(np.int16)
+        scaled = slopes != 1
+        if np.any(scaled):
+            image[scaled] = (slopes[scaled, None, None] * image[scaled].astype(np.float64)).astype(np.int16)
+        image += intercepts[:, None, None]
+        return image
     scan, acquisition_exception = load_scan(img_file)
     img_array_zyx = get_pixels_hu(scan) # z, y, x
     spacing_zyx = list(map(float, ([scan[0].SliceThickness] + scan[0].PixelSpacing))) # z, y, x
@@ -265,39 +587,53 @@ def zero_center(img_array):
     img_array = img_array - pixel_mean
     return img_array
 
-def get_crop_idx_yx(pred, crop_coords, invers_scale_yx):
-    _, thresh_pred = cv2.threshold(pred.copy(), 128, 255, cv2.THRESH_BINARY)
-    thresh_pred = thresh_pred.astype(np.uint8)
-    _, contours, _ = cv2.findContours(thresh_pred.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if len(thresh_pred.shape) == 2:
-        thresh_pred = np.expand_dims(thresh_pred,2)
-    min_y = []
-    max_y = []
-    min_x = []
-    max_x = []
-    # delete too small contours
-    for cnt in contours:
-        if cv2.contourArea(cnt) < 3: continue
-        if cnt.shape[0] < 3: continue
-        min_y.append(np.min(cnt[:, 0, 1]))
-        max_y.append(np.max(cnt[:, 0, 1]))
-        min_x.append(np.min(cnt[:, 0, 0]))
-        max_x.append(np.max(cnt[:, 0, 0]))
-    if min_y and min_x and max_y and max_x:
-        min_y = max(0, min(min_y))
-        max_y = min(max(max_y), crop_coords[0])
-        min_x = max(0, min(min_x))
-        max_x = min(max(max_x), crop_coords[1])
-        # scale back to original img_array.shape
-        min_y = int(min_y * float(invers_scale_yx[0]))
-        max_y = int(max_y * float(invers_scale_yx[0]))
-        min_x = int(min_x * float(invers_scale_yx[1]))
-        max_x = int(max_x * float(invers_scale_yx[1]))
-        return [min_y, max_y, min_x, max_x]
-    else:
-        return []
+def get_crop_idx_yx_stack(prediction, crop_coords, invers_scale_yx):
+    """Indices of the predicted slices of shape (n_slices, y, x, 1) with lung
+    wings and their [min_y, max_y, min_x, max_x].
+
+    Components are 8-connected within slices. As with the external contours
+    of cv2.findContours, components with a contour area below 3 are ignored.
+    The polygon through the centers of the boundary pixels covers each 2x2
+    window of pixels of the component with holes filled, and half of each
+    window with three of them.
+    """
+    import scipy.ndimage
+    mask = prediction[..., 0] > 128
+    in_slice_4 = np.zeros((3, 3, 3), dtype=bool); in_slice_4[1, 1, :] = in_slice_4[1, :, 1] = True
+    in_slice_8 = np.zeros((3, 3, 3), dtype=bool); in_slice_8[1] = True
+    # fill holes, background components that do not touch the border of their slice
+    background, n_background = scipy.ndimage.label(~mask, in_slice_4)
+    border = np.ones(mask.shape[1:], dtype=bool); border[1:-1, 1:-1] = False
+    is_outside = np.zeros(n_background + 1, dtype=bool)
+    is_outside[background[:, border]] = True
+    mask |= ~is_outside[background]
+    labels, n_labels = scipy.ndimage.label(mask, in_slice_8)
+    if n_labels == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.int64)
+    # pixels of a 2x2 window are 8-connected and belong to the same component
+    windows = [(slice(None), slice(dy, labels.shape[1] - 1 + dy), slice(dx, labels.shape[2] - 1 + dx))
+               for dy in [0, 1] for dx in [0, 1]]
+    n_in_window = sum(mask[w].astype(np.uint8) for w in windows)
+    window_labels = np.maximum.reduce([labels[w] for w in windows])
+    area = np.bincount(window_labels.ravel(), weights=((n_in_window == 4) + 0.5 * (n_in_window == 3)).ravel(),
+                       minlength=n_labels + 1)
+    keep = area >= 3
+    keep[0] = False
+    mask = keep[labels]
+    rows, cols = mask.any(axis=2), mask.any(axis=1) # z, y and z, x
+    found = rows.any(axis=1)
+    rows, cols = rows[found], cols[found]
+    min_y = rows.argmax(axis=1); max_y = rows.shape[1] - 1 - rows[:, ::-1].argmax(axis=1)
+    min_x = cols.argmax(axis=1); max_x = cols.shape[1] - 1 - cols[:, ::-1].argmax(axis=1)
+    # scale back to original img_array.shape
+    min_y = (np.maximum(0, min_y) * float(invers_scale_yx[0])).astype(np.int64)
+    max_y = (np.minimum(max_y, crop_coords[0]) * float(invers_scale_yx[0])).astype(np.int64)
+    min_x = (np.maximum(0, min_x) * float(invers_scale_yx[1])).astype(np.int64)
+    max_x = (np.minimum(max_x, crop_coords[1]) * float(invers_scale_yx[1])).astype(np.int64)
+    return np.flatnonzero(found), np.stack([min_y, max_y, min_x, max_x], axis=1)
 
 def seg_preprocessing(img_array_zyx, config, scale_yx, HU_tissue_range):
+    import cv2
     # transform to np.unit8 to apply cv2.imwrite
     if img_array_zyx.dtype == np.float32: # value range [-0.25, 0.75] -> [0, 255]
         img_array_zyx += 0.25
@@ -309,11 +645,11 @@ def seg_preprocessing(img_array_zyx, config, scale_yx, HU_tissue_range):
         img_array_zyx = ((img_array_zyx / float(HU_tissue_range[1] - HU_tissue_range[0])) * 255).astype(np.uint8)
     crop_coords_yx = [int(x) for x in np.array(img_array_zyx.shape[1:]) * scale_yx]
     img_array_zyx_out = np.zeros(([img_array_zyx.shape[0]] + config['image_shape'][:2]), dtype=np.float32) # config['image_shape'] is y, x, z
-    for layer_cnt in range(img_array_zyx.shape[0]):
-        img_array_zyx_out[layer_cnt, :crop_coords_yx[0], :crop_coords_yx[1]] = cv2.resize(img_array_zyx[layer_cnt, :, :],
-                                                                                          tuple(crop_coords_yx),
-                                                                                          interpolation=cv2.INTER_AREA)
-        # cv2.imwrite('layer{}.jpg'.format(layer_cnt), img_array_zyx_out[layer_cnt, :, :])
+    # resize all layers at once as the channels of one image, cv2 allows at most 512 channels
+    for start in range(0, img_array_zyx.shape[0], 512):
+        layers_yxz = np.ascontiguousarray(img_array_zyx[start : start + 512].transpose(1, 2, 0))
+        layers_yxz = cv2.resize(layers_yxz, tuple(crop_coords_yx), interpolation=cv2.INTER_AREA)
+        img_array_zyx_out[start : start + 512, :crop_coords_yx[0], :crop_coords_yx[1]] = np.atleast_3d(layers_yxz).transpose(2, 0, 1)
     if not len(img_array_zyx_out.shape) == 3:
         pipe.log.error('wrong shape of img_array_zyx_out in seg_preprocessing.')
     img_array_zyx_out = np.expand_dims(img_array_zyx_out, 3).astype(np.float32) # expand with channel dimension
@@ -0,0 +1,185 @@
+"""
+Storage backends for the arrays of `pipe.save_array` and `pipe.load_array`.
+
+Choose a backend with the `storage_backend` pipe parameter, either a single
+name for all steps or a dict that maps step names to names. Steps not in the
+dict use 'npy'.
+
+    npy     one uncompressed .npy file per array
+    mmap    .npy files that are loaded memory-mapped (read-only)
+    zlib    the array is split into chunks along its first axis and each
+            chunk is compressed with zlib; file ending .chunked
+    lz4     as zlib, but with lz4 compression (requires the lz4 package)
+
+Arrays are loaded with whichever backend wrote them, so changing the backend
+does not invalidate existing step directories. Arrays whose paths are read
+outside of the pipeline, e.g. the lists written by interpolate_candidates for
+the networks, need to be 'npy' or 'mmap'.
+
+With `storage_lru_bytes > 0`, the most recently saved or loaded arrays are
+kept in memory in each process up to that many bytes.
+
+`pipe.load_array(..., mmap=True)` returns read-only memory maps of .npy files
+with any backend, so that only the touched pages are read. Chunked arrays
+are loaded fully.
+"""
+import os
+import json
+import zlib
+import struct
+import numpy as np
+from collections import OrderedDict
+
+avail_backends = ['npy', 'mmap', 'zlib', 'lz4']
+
+class NpyBackend:
+    suffix = ''
+
+    def save(self, path, array):
+        np.save(path, array)
+        return path
+
+    def load(self, path):
+        return np.load(path)
+
+class MmapBackend(NpyBackend):
+
+    def load(self, path):
+        return np.load(path, mmap_mode='r')
+
+class ChunkedBackend:
+    """Chunks along the first axis compressed with zlib or lz4.
+
+    The file starts with `magic`, the length of a json header and the header
+    with dtype, shape, codec, number of rows per chunk and the sizes of the
+    compressed chunks, followed by the chunks.
+    """
+    suffix = '.chunked'
+    magic = b'DSB3CHUNKED1'
+
+    def __init__(self, codec='zlib', chunk_bytes=2**22, level=1):
+        self.codec = codec
+        self.chunk_bytes = chunk_bytes
+        self.level = level
+        self.compress, self.decompress = _get_codec(codec, level)
+
+    def save(self, path, array):
+        array = np.asarray(array)
+        rows = np.ascontiguousarray(array if array.ndim > 0 else array.reshape(1))
+        chunk_rows = max(1, self.chunk_bytes // max(1, rows[0].nbytes if len(rows) > 0 else 1))
+        chunks = [self.compress(rows[i:i+chunk_rows].tobytes()) for i in range(0, len(rows), chunk_rows)]
+        header = json.dumps(OrderedDict([('dtype', array.dtype.str),
+                                         ('shape', list(array.shape)),
+                                         ('codec', self.codec),
+                                         ('chunk_rows', chunk_rows),
+                                         ('chunk_sizes', [len(c) for c in chunks])])).encode()
+        path += self.suffix
+        with open(path, 'wb') as f:
+            f.write(self.magic + struct.pack('<I', len(header)) + header)
+            for chunk in chunks:
+                f.write(chunk)
+        return path
+
+    def load(self, path):
+        with open(path + self.suffix, 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError(path + self.suffix + ' is not a chunked array.')
+            header = json.loads(f.read(struct.unpack('<I', f.read(4))[0]).decode())
+            _, decompress = _get_codec(header['codec'])
+            array = np.empty(tuple(header['shape']), dtype=np.dtype(header['dtype']))
+            out = array.reshape(-1).view(np.uint8)
+            pos = 0
+            for size in header['chunk_sizes']:
+                data = decompress(f.read(size))
+                out[pos:pos+len(data)] = np.frombuffer(data, dtype=np.uint8)
+                pos += len(data)
+        return array
+
+class LRUTier:
+    """Keep the most recently used arrays in memory up to `max_bytes`.
+
+    Entries are invalidated if the file on disk changed. Copies are returned,
+    so that steps can modify loaded arrays in place.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.arrays = OrderedDict()
+
+    def get(self, path):
+        if path not in self.arrays:
+            return None
+        stat, array = self.arrays[path]
+        if stat != _get_stat(path):
+            self._remove(path)
+            return None
+        self.arrays.move_to_end(path)
+        return array.copy()
+
+    def put(self, path, array):
+        if isinstance(array, np.memmap) or array.nbytes > self.max_bytes:
+            return
+        if path in self.arrays:
+            self._remove(path)
+        self.arrays[path] = (_get_stat(path), array.copy())
+        self.n_bytes += array.nbytes
+        while self.n_bytes > self.max_bytes:
+            self._remove(next(iter(self.arrays)))
+
+    def _remove(self, path):
+        self.n_bytes -= self.arrays.pop(path)[1].nbytes
+
+def get_backend(name):
+    if name == 'npy':
+        return NpyBackend()
+    elif name == 'mmap':
+        return MmapBackend()
+    elif name in ['zlib', 'lz4']:
+        return ChunkedBackend(codec=name)
+    raise ValueError('storage_backend needs to be one of ' + str(avail_backends))
+
+def save(path, array, backend, lru=None):
+    """Save array to path with backend, return the written path."""
+    path_written = backend.save(path, array)
+    if lru is not None:
+        lru.put(path_written, array)
+    return path_written
+
+def load(path, backend, lru=None, mmap=False):
+    """Load array from path, written by backend or any other backend.
+
+    With mmap, .npy files are returned as read-only memory maps.
+    """
+    backends = [backend] + [b for b in _backends_by_suffix if b.suffix != backend.suffix]
+    for b in backends:
+        if os.path.exists(path + b.suffix):
+            backend = b
+            break
+    if mmap and backend.suffix == MmapBackend.suffix:
+        return MmapBackend().load(path)
+    path_written = path + backend.suffix
+    array = lru.get(path_written) if lru is not None else None
+    if array is None:
+        array = backend.load(path)
+        if lru is not None:
+            lru.put(path_written, array)
+    return array
+
+def _get_codec(codec, level=1):
+    if codec == 'zlib':
+        return (lambda data: zlib.compress(data, level)), zlib.decompress
+    elif codec == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('storage_backend "lz4" requires the lz4 package: pip install lz4')
+        return lz4.frame.compress, lz4.frame.decompress
+    raise ValueError('Unknown codec ' + codec)
+
+def _get_stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+_backends_by_suffix = [NpyBackend(), ChunkedBackend()]
+avail_suffixes = [b.suffix for b in _backends_by_suffix]
@@ -9,6 +9,17 @@ def ensure_dir(f):
         os.makedirs(d)
         os.system('chmod -R ugo+rw ' + d)
 
+def replace_file(filename, write):
+    """Write to a temporary file using `write(f)` and rename it to `filename`.
+
+    Concurrent readers see either the old or the new file, never a partially
+    written one.
+    """
+    tmp_filename = filename + '.tmp' + str(os.getpid())
+    with open(tmp_filename, 'w') as f:
+        write(f)
+    os.replace(tmp_filename, filename)
+
 def dir_is_empty(directory):
     for _, _, files in os.walk(directory):
         if files:
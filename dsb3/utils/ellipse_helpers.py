@@ -1,6 +1,4 @@
 from __future__ import division
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.pyplot as plt
 import sys
 import numpy as np
 from numpy import linalg
@@ -62,6 +60,8 @@ def getEllipsoidVolume(radii):
 
 def plotEllipsoid(center, radii, rotation, ax=None, plotAxes=False, cageColor='b', cageAlpha=0.2):
     """Plot an ellipsoid"""
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # registers projection='3d'
     make_ax = ax == None
     if make_ax:
         fig = plt.figure()
@@ -86,6 +86,8 @@ def plotEllipsoid(center, radii, rotation, ax=None, plotAxes=False, cageColor='b
     if make_ax:
         plt.show()
 def plot__ellipse(P):
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # registers projection='3d'
     # find the ellipsoid
     (center, radii, rotation) = getMinVolEllipse(P, .01)
     fig = plt.figure()
@@ -98,6 +100,8 @@ def plot__ellipse(P):
     plt.show()
 
 def plot__scatter(P):
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # registers projection='3d'
     print("plotting scatter")
     # find the ellipsoid
     fig = plt.figure()
@@ -107,6 +111,8 @@ def plot__scatter(P):
 
 
 def plot__both_scatters(new, old):
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # registers projection='3d'
     print("plotting scatter")
     # find the ellipsoid
     fig = plt.figure()
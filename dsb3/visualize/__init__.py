@@ -1,5 +1,4 @@
 import os
-import grip
 from collections import OrderedDict
 
 def write_figs_overview_html(figs_directory, show_image_info=True):
@@ -13,6 +12,7 @@ def write_figs_overview_html(figs_directory, show_image_info=True):
             if show_image_info:
                 write_col_img_info(f, irow, sorted_filenames_dict)
             write_col_img_inludes(f, irow, sorted_filenames_dict)
+    import grip
     grip.export(figs_directory.rstrip('/') + '.md')
     os.remove(figs_directory.rstrip('/') + '.md')
 
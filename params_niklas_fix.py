@@ -23,6 +23,9 @@ pipe = OrderedDict([
     ('n_CPUs', 10),
     ('GPU_ids', [0]),
     ('GPU_memory_fraction', 0.85),
+# array storage, see dsb3/storage.py
+    ('storage_backend', 'npy'), # 'npy', 'mmap', 'zlib', 'lz4' or a dict by step name, e.g. {'gen_prob_maps': 'zlib'}
+    ('storage_lru_bytes', 0), # keep recently used arrays in memory up to this many bytes per process
 ])
 # -----------------------------------------------------------------------------
 # step parameters
@@ -38,6 +41,14 @@ resample_lungs = OrderedDict([
     ('seg_max_shape_yx', [512, 512]), # y, x
     ('batch_size', 64), # 128 for new_spacing 0.5, 64 for new_spacing 1.0
     ('checkpoint_dir', './checkpoints/lung_wings_segmentation/'),
+    ('save_raw_volume', False), # read by interpolate_candidates instead of the raw data
+    ('resampling_kernel', 'zoom'), # 'zoom' (scipy) or 'cubic', 'linear', 'lanczos' (dsb3/resample.py), opt-in
+    ('resampling_n_threads', 1), # per patient, patients are processed in n_CPUs processes
+    ('crop_before_resample', False), # resample only the lung box, found on a resampling with lung_box_kernel
+    ('lung_box_kernel', None), # None for resampling_kernel, as without crop_before_resample, or e.g. 'linear'
+    ('lung_bbox_method', 'net'), # 'net' or 'threshold' (HU thresholds and morphology, no tensorflow)
+    ('lung_bbox_report_n_patients', 0), # with 'net', compare with 'threshold' in lung_bbox_agreement.json
+    ('seg_slice_step', 1), # with 'net', segment every nth slice and refine near the lung ends, 1: all slices
 ])
 batch_size_factor = 1
 gen_prob_maps = OrderedDict([
@@ -52,7 +63,13 @@ gen_prob_maps = OrderedDict([
     ('data_type', 'uint8'), # uint8, int16 or float32
     ('image_shape_max_ratio', 0.95),
     ('checkpoint_dir', './checkpoints/nodule_segmentation/'),
-    ('all_patients', validate_seg_net_on_all_patients)
+    ('all_patients', validate_seg_net_on_all_patients),
+    ('tile_shape_yx', None), # e.g. [512, 512]: one net for all scans in overlapping tiles instead of image_shapes
+    ('tile_overlap_px', 64),
+    ('tile_blending', 'gaussian'), # 'gaussian' or 'linear'
+    ('tile_batch_size', batch_size_factor*12),
+    ('rotate_volume', False), # rotate view planes once per view_angle in float32 instead of each batch in uint8
+    ('prefetch', True), # load the next scan and fill the next batch in threads while the net predicts
 ])
 
 